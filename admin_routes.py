@@ -1,28 +1,44 @@
-from flask import render_template, request, redirect, url_for, flash, jsonify, send_file
+from flask import render_template, request, redirect, url_for, flash, jsonify, send_file, Response, stream_with_context, abort
+from sqlalchemy import select, func
 from app import app, db
-from models import User, Registration, QuestProgress, StickerGeneration, AdminLog
-import pandas as pd
-import io
+from models import User, Registration, QuestProgress, QuestPhotoSubmission, StickerGeneration, AdminLog, BroadcastJob
+from broadcast import enqueue_broadcast
+from unit_of_work import unit_of_work
+from exporter import has_registrations, iter_csv, export_to_file, EXPORT_MIMETYPES
+from stats import stats_cache, STATS_TTL
+from quest_manager import quest_manager
+from quest_codes import sign_qr_payload
+from leaderboard import leaderboard
+from quest_photos import quest_photo_pipeline
+import os
+import json
+import time
+import click
 from datetime import datetime
 
+# Seconds a stats stream stays open; the browser reconnects after SSE_RETRY_MS.
+# Each open stream holds a worker thread, so streams are kept short
+SSE_STREAM_SECONDS = float(os.getenv("SSE_STREAM_SECONDS", "10"))
+SSE_RETRY_MS = int(os.getenv("SSE_RETRY_MS", "5000"))
+
+# Quest photos shown per page of the review screen
+QUEST_PHOTO_REVIEW_PAGE = 24
+
 @app.route('/')
 def index():
     """Admin dashboard"""
     with app.app_context():
-        total_users = User.query.count()
-        total_registrations = Registration.query.count()
-        total_stickers = StickerGeneration.query.count()
-        completed_quests = QuestProgress.query.filter_by(completed=True).count()
+        stats, _ = stats_cache.get()
         
         # Recent activity
         recent_users = User.query.order_by(User.created_at.desc()).limit(10).all()
         recent_registrations = db.session.query(Registration, User).join(User).order_by(Registration.created_at.desc()).limit(10).all()
         
         return render_template('admin_dashboard.html',
-                             total_users=total_users,
-                             total_registrations=total_registrations,
-                             total_stickers=total_stickers,
-                             completed_quests=completed_quests,
+                             total_users=stats['total_users'],
+                             total_registrations=stats['total_registrations'],
+                             total_stickers=stats['generated_stickers'],
+                             completed_quests=stats['completed_quests'],
                              recent_users=recent_users,
                              recent_registrations=recent_registrations)
 
@@ -40,45 +56,35 @@ def participants():
 
 @app.route('/export_csv')
 def export_csv():
-    """Export participants data as CSV"""
-    registrations = db.session.query(Registration, User).join(User).all()
-    
-    data = []
-    for reg, user in registrations:
-        data.append({
-            'telegram_id': user.telegram_id,
-            'username': user.username,
-            'first_name': user.first_name,
-            'last_name': user.last_name,
-            'activity': reg.activity_type,
-            'day': reg.day,
-            'time_slot': reg.time_slot,
-            'registered_at': reg.created_at.strftime('%Y-%m-%d %H:%M:%S')
-        })
+    """Export participants data as CSV (or Parquet with ?format=parquet)"""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_MIMETYPES:
+        abort(400, description=f"Unknown export format {fmt!r}; use one of {', '.join(EXPORT_MIMETYPES)}")
     
-    if not data:
+    if not has_registrations():
         flash('No data to export', 'warning')
         return redirect(url_for('index'))
     
-    df = pd.DataFrame(data)
-    
-    # Create CSV in memory
-    output = io.StringIO()
-    df.to_csv(output, index=False)
-    output.seek(0)
-    
-    # Convert to bytes
-    csv_bytes = io.BytesIO()
-    csv_bytes.write(output.getvalue().encode('utf-8'))
-    csv_bytes.seek(0)
+    filename = f"participants_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
     
-    filename = f"participants_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    if fmt == 'parquet':
+        try:
+            export_file = export_to_file('parquet')
+        except RuntimeError as e:
+            flash(str(e), 'error')
+            return redirect(url_for('index'))
+        return send_file(
+            export_file,
+            mimetype=EXPORT_MIMETYPES['parquet'],
+            as_attachment=True,
+            download_name=filename
+        )
     
-    return send_file(
-        csv_bytes,
-        mimetype='text/csv',
-        as_attachment=True,
-        download_name=filename
+    # Stream CSV chunks as rows are read from the database
+    return Response(
+        stream_with_context(iter_csv()),
+        mimetype=EXPORT_MIMETYPES['csv'],
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
     )
 
 @app.route('/broadcast', methods=['GET', 'POST'])
@@ -87,27 +93,141 @@ def broadcast():
     if request.method == 'POST':
         message = request.form.get('message')
         if message:
-            # In a real implementation, this would queue the message for the bot to send
-            flash(f'Broadcast message queued: {message}', 'success')
+            # Picked up by the bot's BroadcastEngine
+            with unit_of_work(write=True):
+                job = enqueue_broadcast(message)
+            flash(f'Broadcast #{job.id} queued for {job.total} users', 'success')
         else:
             flash('Message cannot be empty', 'error')
         
         return redirect(url_for('broadcast'))
     
-    return render_template('broadcast.html')
+    recent_jobs = BroadcastJob.query.order_by(BroadcastJob.created_at.desc()).limit(5).all()
+    return render_template('broadcast.html', recent_jobs=recent_jobs)
+
+@app.route('/quest_photos')
+def quest_photos():
+    """Quest photos waiting for review"""
+    submissions = db.session.execute(
+        select(QuestPhotoSubmission, QuestProgress.quest_id, User)
+        .join(QuestProgress, QuestPhotoSubmission.quest_progress_id == QuestProgress.id)
+        .join(User, QuestProgress.user_id == User.id)
+        .where(QuestPhotoSubmission.status == 'pending')
+        .order_by(QuestPhotoSubmission.id)
+        .limit(QUEST_PHOTO_REVIEW_PAGE)
+    ).all()
+    pending_total = db.session.scalar(
+        select(func.count()).select_from(QuestPhotoSubmission).where(QuestPhotoSubmission.status == 'pending')
+    )
+    return render_template('quest_photos.html', submissions=submissions, pending_total=pending_total,
+                           quest_manager=quest_manager)
+
+@app.route('/quest_photos/<int:submission_id>/image')
+def quest_photo_image(submission_id):
+    """Proxy the photo from Telegram so the bot token never reaches the browser"""
+    submission = db.get_or_404(QuestPhotoSubmission, submission_id)
+    if not quest_photo_pipeline.bot:
+        abort(503)
+    file_info = quest_photo_pipeline.bot.get_file(submission.photo_file_id)
+    response = Response(quest_photo_pipeline.bot.download_file(file_info.file_path), mimetype='image/jpeg')
+    response.cache_control.private = True
+    response.cache_control.max_age = 3600
+    return response
+
+@app.route('/quest_photos/<int:submission_id>/review', methods=['POST'])
+def review_quest_photo(submission_id):
+    """Approve or reject a quest photo"""
+    approved = request.form.get('decision') == 'approve'
+    if quest_photo_pipeline.apply_verdict(submission_id, approved, 'admin'):
+        flash(f'Photo #{submission_id} {"approved" if approved else "rejected"}', 'success')
+    else:
+        flash(f'Photo #{submission_id} was already reviewed', 'error')
+    return redirect(url_for('quest_photos'))
 
 @app.route('/api/stats')
 def api_stats():
     """API endpoint for real-time stats"""
-    stats = {
-        'total_users': User.query.count(),
-        'total_registrations': Registration.query.count(),
-        'dance_registrations': Registration.query.filter_by(activity_type='dance').count(),
-        'yoga_registrations': Registration.query.filter_by(activity_type='yoga').count(),
-        'completed_quests': QuestProgress.query.filter_by(completed=True).count(),
-        'generated_stickers': StickerGeneration.query.count()
-    }
-    return jsonify(stats)
+    stats, etag = stats_cache.get()
+    response = jsonify(stats)
+    response.set_etag(etag)
+    response.cache_control.max_age = int(STATS_TTL)
+    return response.make_conditional(request)
+
+@app.route('/api/stats/stream')
+def api_stats_stream():
+    """Server-Sent Events: full stats first, then only the counters that changed.
+
+    The stream ends after SSE_STREAM_SECONDS and EventSource reconnects, so an
+    open dashboard tab never pins a gunicorn worker.
+    """
+    def events():
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        last = {}
+        deadline = time.monotonic() + SSE_STREAM_SECONDS
+        while True:
+            stats, _ = stats_cache.get()
+            delta = {key: value for key, value in stats.items() if last.get(key) != value}
+            if delta:
+                yield f"event: stats\ndata: {json.dumps(delta)}\n\n"
+                last = stats
+            if time.monotonic() + STATS_TTL > deadline:
+                return
+            time.sleep(STATS_TTL)
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/quest_analytics')
+def api_quest_analytics():
+    """Per-step quest funnel and median step times; ?quest_id= picks the variant"""
+    return jsonify(quest_manager.get_step_analytics(request.args.get('quest_id')))
+
+@app.route('/api/leaderboard')
+def api_leaderboard():
+    """Quest leaderboard as JSON; ?telegram_id= adds that user's rank"""
+    limit = max(1, min(request.args.get('limit', 10, type=int), 100))
+    result = {'top': []}
+    for entry in leaderboard.top(limit):
+        result['top'].append(dict(entry, completed_at=entry['completed_at'].isoformat() if entry['completed_at'] else None))
+    
+    telegram_id = request.args.get('telegram_id')
+    if telegram_id:
+        user = User.query.filter_by(telegram_id=telegram_id).first()
+        rank, total = leaderboard.rank(user.id if user else None)
+        result['rank'] = rank
+        result['total'] = total
+    return jsonify(result)
+
+@app.cli.command('quest-qr')
+@click.argument('quest_id')
+@click.argument('step', type=int)
+@click.option('--day', help='Festival day the code is valid on, e.g. day1')
+@click.option('--user', 'telegram_id', help='Telegram id of the only user the code is valid for')
+def quest_qr_command(quest_id, step, day, telegram_id):
+    """Print a signed quest QR deep link"""
+    quest = quest_manager.get_quest(quest_id)
+    if quest.quest_id != quest_id or not quest.get_step(step):
+        raise click.ClickException(f"Unknown quest step {quest_id}/{step}")
+    
+    if day and day not in quest_manager.catalog.day_dates:
+        raise click.ClickException(f"Day {day} has no date in quests.json, its codes would never be accepted")
+    
+    user_id = None
+    if telegram_id:
+        user = User.query.filter_by(telegram_id=telegram_id).first()
+        if not user:
+            raise click.ClickException(f"Unknown user {telegram_id}")
+        user_id = user.id
+    
+    try:
+        payload = sign_qr_payload(quest_id, step, day=day, user_id=user_id)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    bot_username = os.getenv("BOT_USERNAME")
+    click.echo(f"https://t.me/{bot_username}?start={payload}" if bot_username else payload)
 
 @app.route('/user/<telegram_id>')
 def user_detail(telegram_id):
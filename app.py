@@ -2,6 +2,7 @@ import os
 import logging
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 
@@ -18,12 +19,46 @@ app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-for-festival-bot")
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
+# Connections kept by the pool; every dispatcher, sticker, photo and broadcast worker may hold one
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+
+# Milliseconds a SQLite writer waits for the database lock before "database is locked"
+SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT", "5000"))
+
 # Configure the database
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///festival_bot.db")
 app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_recycle": 300,
     "pool_pre_ping": True,
 }
+if ":memory:" not in app.config["SQLALCHEMY_DATABASE_URI"]:
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"].update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+
+def configure_sqlite(engine):
+    """WAL so readers never block the writer, a busy timeout instead of instant lock errors,
+    and explicit BEGIN so SAVEPOINTs (begin_nested) work with pysqlite"""
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def on_begin(connection):
+        # Writing units of work take the write lock up front (waiting up to busy_timeout);
+        # a deferred read transaction that later writes fails at once in WAL mode if another
+        # writer committed in between. Read-only units stay deferred and never block anyone
+        if connection.get_execution_options().get("sqlite_begin_immediate"):
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+        else:
+            connection.exec_driver_sql("BEGIN")
 
 # Initialize the app with the extension
 db.init_app(app)
@@ -32,6 +67,11 @@ db.init_app(app)
 from admin_routes import *
 
 with app.app_context():
+    configure_sqlite(db.engine)
+
     # Import models so their tables are created
     import models
     db.create_all()
+    
+    from migrations import run_migrations
+    run_migrations(db)
@@ -0,0 +1,173 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+import aiohttp
+from sticker_generator import REMOVE_BG_TOKEN, REMOVE_BG_URL, removebg_form
+
+# Background removal is a paid call, so it is opt-in
+REMOVE_BG_ENABLED = os.getenv("REMOVE_BG_ENABLED", "0") == "1"
+
+# Connection pool and request limits for the Remove.bg session
+REMOVE_BG_CONCURRENCY = int(os.getenv("REMOVE_BG_CONCURRENCY", "4"))
+REMOVE_BG_TIMEOUT = float(os.getenv("REMOVE_BG_TIMEOUT", "20"))
+REMOVE_BG_RETRIES = int(os.getenv("REMOVE_BG_RETRIES", "2"))
+
+# HTTP statuses worth retrying
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class CircuitBreaker:
+    """Opens after consecutive failures and lets one probe through after a cool-down"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        """Whether a request may be attempted now"""
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                if self.opened_at is None:
+                    logging.warning("Remove.bg circuit breaker opened")
+                self.opened_at = time.monotonic()
+
+class BackgroundRemovalService:
+    """Long-lived Remove.bg client running on its own event loop thread.
+
+    One pooled aiohttp session with keep-alive is shared by all requests.
+    submit() is thread-safe and returns a concurrent.futures.Future that
+    resolves to the cutout PNG bytes, or None when the request failed or the
+    circuit breaker is open (callers then fall back to the simple sticker).
+    """
+
+    def __init__(self, api_url=REMOVE_BG_URL, api_key=REMOVE_BG_TOKEN,
+                 concurrency=REMOVE_BG_CONCURRENCY, timeout=REMOVE_BG_TIMEOUT,
+                 retries=REMOVE_BG_RETRIES, breaker=None):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.breaker = breaker or CircuitBreaker()
+        self.loop = None
+        self.session = None
+        self.semaphore = None
+        self.ready = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start the event loop thread and open the shared session"""
+        if self.thread:
+            return
+        self.thread = threading.Thread(target=self._run_loop, name="removebg-loop", daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        logging.info(f"Background removal service started ({self.api_url})")
+
+    def stop(self):
+        """Close the session and stop the loop"""
+        if not self.thread:
+            return
+        asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.thread = None
+
+    def submit(self, image_bytes):
+        """Queue a background removal from any thread"""
+        return asyncio.run_coroutine_threadsafe(self._remove(image_bytes), self.loop)
+
+    def remove(self, image_bytes):
+        """Blocking helper around submit()"""
+        return self.submit(image_bytes).result()
+
+    def _run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._open_session())
+        self.ready.set()
+        self.loop.run_forever()
+        self.loop.close()
+
+    async def _open_session(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers={'X-Api-Key': self.api_key},
+            timeout=aiohttp.ClientTimeout(total=self.timeout)
+        )
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def _remove(self, image_bytes):
+        if not self.breaker.allow():
+            logging.info("Remove.bg circuit open, skipping background removal")
+            return None
+
+        # Recorded in finally, so an unexpected error or cancellation never leaves a probe in flight
+        healthy = False
+        try:
+            cutout_bytes, healthy = await self._request(image_bytes)
+            return cutout_bytes
+        finally:
+            if healthy:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+    async def _request(self, image_bytes):
+        """(cutout bytes or None, whether the service is healthy) after up to retries + 1 attempts"""
+        async with self.semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    async with self.session.post(self.api_url, data=removebg_form(image_bytes)) as response:
+                        if response.status == 200:
+                            return await response.read(), True
+                        logging.error(f"Remove.bg API error: {response.status}")
+                        if response.status not in RETRY_STATUSES:
+                            # The service answered; the image itself was rejected
+                            return None, True
+                        retry_after = response.headers.get('Retry-After')
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logging.error(f"Error removing background: {e!r}")
+                    retry_after = None
+
+                if attempt < self.retries:
+                    # Exponential backoff with jitter, honouring Retry-After when present
+                    if retry_after and retry_after.isdigit():
+                        delay = int(retry_after) + random.uniform(0, 0.5)
+                    else:
+                        delay = random.uniform(0, 0.5 * 2 ** attempt)
+                    await asyncio.sleep(delay)
+        return None, False
@@ -0,0 +1,136 @@
+"""Benchmark: callback handling throughput with per-tap keyboards vs the screen registry.
+
+The Bot API is mocked with zero latency, so the numbers are the bot's own
+CPU cost per tap: routing, building text and markup, serializing the
+request. The legacy path rebuilds keyboards on every tap and routes
+through an if/elif chain, as bot.py did before the screen registry.
+
+Usage: BOT_TOKEN=1:test DATABASE_URL=sqlite:////tmp/bench.db python bench_callbacks.py [taps]
+"""
+import os
+import sys
+import json
+import time
+from types import SimpleNamespace
+
+os.environ.setdefault("BOT_TOKEN", "1:test")
+# Measure the bot, not the outbound rate limits
+os.environ.setdefault("TELEGRAM_GLOBAL_RATE", "1000000")
+os.environ.setdefault("TELEGRAM_CHAT_RATE", "1000000")
+
+from telebot import apihelper, types
+
+def fake_bot_api(method, url, **kwargs):
+    """Stand-in for api.telegram.org that answers instantly"""
+    api_method = url.rsplit('/', 1)[-1]
+    result = True
+    if api_method.startswith(('send', 'edit')):
+        result = {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}}
+    body = {'ok': True, 'result': result}
+    return SimpleNamespace(status_code=200, text=json.dumps(body), json=lambda: body, reason='OK')
+
+apihelper.CUSTOM_REQUEST_SENDER = fake_bot_api
+
+import bot as festival_bot
+from app import app
+from registrations import ensure_slots, slot_snapshot
+from unit_of_work import unit_of_work
+
+bot = festival_bot.bot
+BUTTONS = ["map", "schedule", "dance", "yoga", "sticker", "back_to_menu"]
+
+def legacy_back_markup():
+    markup = types.InlineKeyboardMarkup()
+    markup.row(types.InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu"))
+    return markup
+
+def legacy_map(call):
+    text = "🗺️ Карта фестиваля\n\n📍 Основные зоны:\n🎵 Главная сцена\n💃 Танцевальная площадка\n"
+    text += "🧘 Йога-зона\n🍽️ Фуд-корт\n🏮 Маяк (для квеста)\n\nНажмите на локацию на карте, чтобы узнать больше!"
+    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=legacy_back_markup())
+
+def legacy_schedule(call):
+    text = festival_bot.schedule_screen()[0]
+    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=legacy_back_markup())
+
+def legacy_sticker(call):
+    festival_bot.conversation_states.set(call.from_user.id, 'awaiting_photo')
+    text = festival_bot.sticker_screen()[0]
+    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=legacy_back_markup())
+
+def legacy_registration(call, activity_type):
+    with app.app_context():
+        remaining = slot_snapshot.get()
+    activity_name = "Танцы" if activity_type == "dance" else "Йога"
+    text = f"💫 Регистрация на {activity_name}\n\nВыберите день и время:\n\n"
+    markup = types.InlineKeyboardMarkup()
+    for day_num, day in enumerate(festival_bot.DAYS, 1):
+        for time_slot in festival_bot.TIME_SLOTS:
+            seats = remaining.get((activity_type, day, time_slot), 0)
+            seats_text = f"мест: {seats}" if seats > 0 else "лист ожидания"
+            markup.row(types.InlineKeyboardButton(f"День {day_num} - {time_slot} ({seats_text})",
+                                                  callback_data=f"register_{activity_type}_{day}_{time_slot}"))
+    markup.row(types.InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu"))
+    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+
+def legacy_main_menu(call):
+    markup = types.InlineKeyboardMarkup()
+    markup.row(types.InlineKeyboardButton("📍 Карта", callback_data="map"))
+    markup.row(types.InlineKeyboardButton("💃 Танцы", callback_data="dance"),
+               types.InlineKeyboardButton("🧘 Йога", callback_data="yoga"))
+    markup.row(types.InlineKeyboardButton("🧩 Квест", callback_data="quest"),
+               types.InlineKeyboardButton("🤳 Стикер", callback_data="sticker"))
+    markup.row(types.InlineKeyboardButton("📅 Расписание", callback_data="schedule"))
+    bot.edit_message_text("🎪 Главное меню фестиваля\n\nВыберите действие:",
+                          call.message.chat.id, call.message.message_id, reply_markup=markup)
+
+def legacy_callback(call):
+    data = call.data
+    if data == "map":
+        legacy_map(call)
+    elif data == "dance":
+        legacy_registration(call, "dance")
+    elif data == "yoga":
+        legacy_registration(call, "yoga")
+    elif data == "sticker":
+        legacy_sticker(call)
+    elif data == "schedule":
+        legacy_schedule(call)
+    elif data == "back_to_menu":
+        legacy_main_menu(call)
+    bot.answer_callback_query(call.id)
+
+def make_calls(taps):
+    calls = []
+    for n in range(taps):
+        user = {'id': n % 100 + 1, 'is_bot': False, 'first_name': 'Bench'}
+        calls.append(types.CallbackQuery.de_json(json.dumps({
+            'id': str(n), 'from': user, 'chat_instance': '1', 'data': BUTTONS[n % len(BUTTONS)],
+            'message': {'message_id': 1, 'date': 0, 'chat': {'id': user['id'], 'type': 'private'}, 'text': 'menu'},
+        })))
+    return calls
+
+def run(handler, calls):
+    start = time.perf_counter()
+    for call in calls:
+        handler(call)
+    return time.perf_counter() - start
+
+def main():
+    taps = int(sys.argv[1]) if len(sys.argv) > 1 else 6000
+    with unit_of_work(write=True):
+        ensure_slots(festival_bot.DAYS, festival_bot.TIME_SLOTS)
+    calls = make_calls(taps)
+
+    # Warm both paths once
+    run(legacy_callback, calls[:len(BUTTONS)])
+    run(festival_bot.callback_handler, calls[:len(BUTTONS)])
+
+    legacy = run(legacy_callback, calls)
+    registry = run(festival_bot.callback_handler, calls)
+    print(f"{taps} taps over {', '.join(BUTTONS)}")
+    print(f"legacy (rebuild per tap): {legacy:.2f} s ({taps / legacy:.0f} taps/s)")
+    print(f"screen registry:          {registry:.2f} s ({taps / registry:.0f} taps/s), {legacy / registry:.1f}x")
+
+if __name__ == "__main__":
+    main()
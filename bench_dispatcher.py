@@ -0,0 +1,108 @@
+"""Load test: replay a synthetic burst of updates against a mocked Bot API.
+
+Compares handling the burst one update at a time (telebot's old behaviour)
+with the per-chat UpdateDispatcher, and checks that each chat's updates are
+handled in the order they arrived.
+
+Usage: BOT_TOKEN=1:test DATABASE_URL=sqlite:////tmp/bench.db python bench_dispatcher.py [chats] [taps_per_chat] [api_ms]
+"""
+import os
+import sys
+import json
+import time
+import threading
+from collections import defaultdict
+from types import SimpleNamespace
+
+os.environ.setdefault("BOT_TOKEN", "1:test")
+# Measure the bot, not the outbound rate limits
+os.environ.setdefault("TELEGRAM_GLOBAL_RATE", "1000000")
+os.environ.setdefault("TELEGRAM_CHAT_RATE", "1000000")
+
+from telebot import apihelper, types
+
+API_LATENCY = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.02
+answered = defaultdict(list)
+answered_lock = threading.Lock()
+
+def fake_bot_api(method, url, **kwargs):
+    """Stand-in for api.telegram.org with a fixed round-trip latency"""
+    time.sleep(API_LATENCY)
+    api_method = url.rsplit('/', 1)[-1]
+    params = kwargs.get('params') or {}
+    if api_method == 'editMessageText':
+        # message_id is seq + 1, so edits show the order each chat was handled in
+        with answered_lock:
+            answered[str(params['chat_id'])].append(int(params['message_id']))
+    result = True
+    if api_method.startswith(('send', 'edit')):
+        result = {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}}
+    body = {'ok': True, 'result': result}
+    return SimpleNamespace(status_code=200, text=json.dumps(body), json=lambda: body, reason='OK')
+
+apihelper.CUSTOM_REQUEST_SENDER = fake_bot_api
+
+import bot as festival_bot
+
+MENU_BUTTONS = ["map", "schedule", "dance", "yoga", "back_to_menu"]
+
+def make_burst(chats, taps):
+    updates = []
+    update_id = 0
+    for seq in range(taps):
+        for chat_id in range(1, chats + 1):
+            update_id += 1
+            user = {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'}
+            updates.append(types.Update.de_json(json.dumps({
+                'update_id': update_id,
+                'callback_query': {
+                    'id': f'{chat_id}:{seq}',
+                    'from': user,
+                    'chat_instance': str(chat_id),
+                    'data': MENU_BUTTONS[seq % len(MENU_BUTTONS)],
+                    # One message per tap so taps are not coalesced as double taps
+                    'message': {'message_id': seq + 1, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'},
+                                'from': user, 'text': 'menu'},
+                },
+            })))
+    return updates
+
+def run_serial(updates):
+    start = time.perf_counter()
+    for update in updates:
+        festival_bot.bot._process_update(update)
+    return time.perf_counter() - start
+
+def run_dispatched(updates):
+    dispatcher = festival_bot.bot.dispatcher
+    start = time.perf_counter()
+    festival_bot.bot.process_new_updates(updates)
+    while True:
+        with answered_lock:
+            done = sum(len(seqs) for seqs in answered.values())
+        if done >= len(updates):
+            break
+        time.sleep(0.001)
+    return time.perf_counter() - start, dispatcher.metrics()
+
+def main():
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    taps = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    updates = make_burst(chats, taps)
+    print(f"{len(updates)} updates from {chats} chats, {API_LATENCY * 1000:.0f} ms per API call")
+
+    serial = run_serial(updates)
+    print(f"serial:     {serial:.2f} s ({len(updates) / serial:.0f} updates/s)")
+
+    answered.clear()
+    dispatched, metrics = run_dispatched(updates)
+    print(f"dispatched: {dispatched:.2f} s ({len(updates) / dispatched:.0f} updates/s), "
+          f"{serial / dispatched:.1f}x")
+
+    in_order = all(seqs == sorted(seqs) for seqs in answered.values())
+    print(f"per-chat order preserved: {in_order}")
+    for label, stats in sorted(metrics["handlers"].items()):
+        print(f"  {label:<22} n={stats['count']:<5} avg={stats['avg_ms']:.1f} ms p95={stats['p95_ms']:.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Benchmark: hot lookup queries on a seeded database before and after the model indexes.
+
+Seeds a throwaway SQLite database, times the queries with the indexes
+dropped, then creates them and times again.
+
+Usage: python bench_indexes.py [users]   (default 200000)
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+from datetime import datetime, timedelta
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "bench_indexes.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{DB_PATH}"
+
+from sqlalchemy import select, func, insert, text
+from app import app, db
+from models import User, Registration, QuestProgress, StickerGeneration
+
+DAYS = ["day1", "day2", "day3"]
+TIME_SLOTS = ["12:00", "14:00", "16:00", "18:00", "20:00"]
+BATCH = 20000
+
+def seed(users):
+    now = datetime.utcnow()
+    for start in range(0, users, BATCH):
+        ids = range(start + 1, min(start + BATCH, users) + 1)
+        db.session.execute(insert(User), [{"id": i, "telegram_id": str(10**9 + i), "first_name": "Guest"} for i in ids])
+        db.session.execute(insert(Registration), [
+            {"user_id": i, "activity_type": random.choice(["dance", "yoga"]),
+             "day": DAYS[n % 3], "time_slot": TIME_SLOTS[(i + n) % 5], "created_at": now}
+            for i in ids for n in range(2)
+        ])
+        db.session.execute(insert(QuestProgress), [
+            {"user_id": i, "quest_step": 5, "completed": i % 4 == 0,
+             "completed_at": now - timedelta(seconds=i) if i % 4 == 0 else None}
+            for i in ids
+        ])
+        db.session.execute(insert(StickerGeneration), [
+            {"user_id": i, "template_used": "template1", "created_at": now} for i in ids if i % 3 == 0
+        ])
+        db.session.commit()
+
+def queries(users):
+    probe = [random.randint(1, users) for _ in range(200)]
+    return {
+        "duplicate registration check": lambda: [
+            db.session.execute(select(Registration.id).filter_by(
+                user_id=i, activity_type="dance", day="day1", time_slot="12:00")).first()
+            for i in probe
+        ],
+        "user_detail (registrations, quest, stickers)": lambda: [
+            (db.session.execute(select(Registration).filter_by(user_id=i)).all(),
+             db.session.execute(select(QuestProgress).filter_by(user_id=i)).first(),
+             db.session.execute(select(StickerGeneration).filter_by(user_id=i)).all())
+            for i in probe
+        ],
+        "leaderboard top 10": lambda: db.session.execute(
+            select(QuestProgress, User).join(User).where(QuestProgress.completed == True)
+            .order_by(QuestProgress.completed_at.asc()).limit(10)).all(),
+        "count dance registrations": lambda: db.session.scalar(
+            select(func.count()).select_from(Registration).filter_by(activity_type="dance")),
+        "count completed quests": lambda: db.session.scalar(
+            select(func.count()).select_from(QuestProgress).filter_by(completed=True)),
+    }
+
+def time_all(users, repeat=3):
+    timings = {}
+    for name, query in queries(users).items():
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            query()
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best * 1000
+    return timings
+
+def model_indexes():
+    return [index for table in db.metadata.sorted_tables for index in table.indexes
+            if table.name in ("registration", "quest_progress", "sticker_generation")]
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    random.seed(1)
+    with app.app_context():
+        for index in model_indexes():
+            index.drop(db.engine)
+        print(f"Seeding {users} users into {DB_PATH} ...")
+        seed(users)
+        db.session.execute(text("ANALYZE"))
+        before = time_all(users)
+
+        for index in model_indexes():
+            index.create(db.engine)
+        db.session.execute(text("ANALYZE"))
+        after = time_all(users)
+
+    print(f"{'query':<46}{'before ms':>12}{'after ms':>12}{'speedup':>10}")
+    for name in before:
+        print(f"{name:<46}{before[name]:>12.2f}{after[name]:>12.2f}{before[name] / after[name]:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
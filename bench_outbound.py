@@ -0,0 +1,109 @@
+"""Benchmark: the outbound client against a local fake Bot API server.
+
+Starts an HTTP server on 127.0.0.1 that speaks enough of the Bot API for
+sendMessage and answerCallbackQuery, answering every Nth sendMessage with a
+429 and retry_after. Sends the same burst with a fresh connection per
+request (no pooling) and through the OutboundClient, then prints the
+per-method latency histograms and how many 429s were retried.
+
+Usage: python bench_outbound.py [requests] [threads] [throttle_every]
+"""
+import os
+import sys
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import requests
+
+os.environ.setdefault("TELEGRAM_GLOBAL_RATE", "1000000")
+os.environ.setdefault("TELEGRAM_CHAT_RATE", "1000000")
+
+import telebot
+from telebot import apihelper
+from telegram_client import OutboundClient
+
+THROTTLE_EVERY = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+
+class FakeBotApi(BaseHTTPRequestHandler):
+    """/bot<token>/<method> answering like api.telegram.org, keep-alive enabled"""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    counter = 0
+    lock = threading.Lock()
+
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        api_method = self.path.split('?', 1)[0].rsplit('/', 1)[-1]
+        if api_method == 'sendMessage':
+            with FakeBotApi.lock:
+                FakeBotApi.counter += 1
+                throttled = THROTTLE_EVERY and FakeBotApi.counter % THROTTLE_EVERY == 0
+            if throttled:
+                self._reply(429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                                  'parameters': {'retry_after': 1}})
+                return
+            result = {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': 'ok'}
+        else:
+            result = True
+        self._reply(200, {'ok': True, 'result': result})
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+def unpooled_sender(method, url, **kwargs):
+    """One connection per request, as with a plain requests.request call"""
+    return requests.request(method, url, headers={'Connection': 'close'}, **kwargs)
+
+def burst(bot, total, threads):
+    def send(n):
+        bot.send_message(n % 50 + 1, f"message {n}")
+        bot.answer_callback_query(str(n))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(send, range(total)))
+    return time.perf_counter() - start
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBotApi)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_url = f"http://127.0.0.1:{server.server_address[1]}"
+    bot = telebot.TeleBot("1:bench", threaded=False)
+
+    plain = OutboundClient(pool_size=threads)
+    plain.install(api_url)
+    plain.transport = unpooled_sender
+    unpooled = burst(bot, total, threads)
+
+    apihelper.CUSTOM_REQUEST_SENDER = None
+    client = OutboundClient(pool_size=threads)
+    client.install(api_url)
+    pooled = burst(bot, total, threads)
+
+    calls = total * 2
+    print(f"{total} sendMessage + {total} answerCallbackQuery, {threads} threads, 429 every {THROTTLE_EVERY} sends")
+    print(f"new connection per request: {unpooled:.2f} s ({calls / unpooled:.0f} calls/s)")
+    print(f"pooled outbound client:     {pooled:.2f} s ({calls / pooled:.0f} calls/s), {unpooled / pooled:.1f}x")
+    metrics = client.metrics()
+    print(f"429 retries: {metrics['retries_429']}")
+    for name, stats in metrics["methods"].items():
+        filled = {bound: n for bound, n in stats["buckets"].items() if n}
+        print(f"  {name:<20} n={stats['count']:<6} avg={stats['avg_ms']:.1f} ms {filled}")
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Micro-benchmark: legacy per-row template/mask rendering vs rendering.py
+
+Usage: python bench_rendering.py [iterations]
+"""
+import io
+import sys
+import time
+from PIL import Image, ImageDraw
+import sticker_generator
+from sticker_generator import TEMPLATES, get_fonts, create_festival_template, generate_simple_sticker
+from rendering import circle_mask, vertical_gradient
+
+def legacy_gradient(template_info, size):
+    """Gradient as it was drawn before rendering.py: one rectangle per row"""
+    img = Image.new('RGBA', size, (255, 255, 255, 0))
+    draw = ImageDraw.Draw(img)
+    for y in range(size[1]):
+        alpha = int(255 * (1 - y / size[1]) * 0.8)
+        color = tuple(int(template_info["color"][i:i+2], 16) for i in (1, 3, 5)) + (alpha,)
+        draw.rectangle([(0, y), (size[0], y+1)], fill=color)
+    return img
+
+def legacy_template(template_info, size):
+    """Full template rendering as it was before rendering.py"""
+    img = legacy_gradient(template_info, size)
+    draw = ImageDraw.Draw(img)
+    border_width = 20
+    draw.rectangle([(0, 0), (size[0], border_width)], fill=template_info["color"])
+    draw.rectangle([(0, size[1]-border_width), (size[0], size[1])], fill=template_info["color"])
+    draw.rectangle([(0, 0), (border_width, size[1])], fill=template_info["color"])
+    draw.rectangle([(size[0]-border_width, 0), (size[0], size[1])], fill=template_info["color"])
+    font_large, font_small = get_fonts()
+    draw.text((100, size[1] - 120), sticker_generator.FESTIVAL_TEXT, fill=template_info["text_color"], font=font_large)
+    draw.text((100, size[1] - 60), sticker_generator.AVITO_TEXT, fill=template_info["text_color"], font=font_small)
+    return img
+
+def legacy_mask(size):
+    """Circular mask as it was drawn per sticker"""
+    mask = Image.new('L', size, 0)
+    ImageDraw.Draw(mask).ellipse((0, 0, size[0], size[1]), fill=255)
+    return mask
+
+def timeit(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1000
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    size = (600, 800)
+    mask_size = (500, 600)
+
+    print(f"{'gradient':<12}{'legacy ms':>12}{'vectorized ms':>16}{'speedup':>10}")
+    for template_info in TEMPLATES:
+        old = timeit(lambda: legacy_gradient(template_info, size), iterations)
+        new = timeit(lambda: vertical_gradient(template_info["color"], size), iterations)
+        print(f"{template_info['name']:<12}{old:>12.2f}{new:>16.2f}{old / new:>9.1f}x")
+
+    print(f"\n{'template':<12}{'legacy ms':>12}{'vectorized ms':>16}{'speedup':>10}")
+    for template_info in TEMPLATES:
+        old = timeit(lambda: legacy_template(template_info, size), iterations)
+        new = timeit(lambda: create_festival_template(template_info, size), iterations)
+        print(f"{template_info['name']:<12}{old:>12.2f}{new:>16.2f}{old / new:>9.1f}x")
+
+    old = timeit(lambda: legacy_mask(mask_size), iterations)
+    circle_mask(mask_size)
+    new = timeit(lambda: circle_mask(mask_size), iterations)
+    print(f"{'mask':<12}{old:>12.2f}{new:>16.4f}{old / new:>9.1f}x")
+
+    # Per sticker: legacy rebuilt the template and the mask every time
+    buffer = io.BytesIO()
+    Image.new('RGB', (1280, 960), '#808080').save(buffer, format='JPEG')
+    photo_bytes = buffer.getvalue()
+    sticker_generator.warm_template_cache()
+    per_sticker = timeit(lambda: generate_simple_sticker(photo_bytes, TEMPLATES[0]), iterations)
+    legacy_overhead = timeit(lambda: (legacy_template(TEMPLATES[0], size), legacy_mask(mask_size)), iterations)
+    print(f"\nper sticker: {per_sticker:.2f} ms now, ~{per_sticker + legacy_overhead:.2f} ms with legacy "
+          f"template+mask ({(per_sticker + legacy_overhead) / per_sticker:.1f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Stress test: concurrent registrations against a single capacity-limited slot.
+
+Many threads register distinct users for the same slot at once; the seat
+counter must end exactly at capacity with the rest on the waitlist.
+
+Usage: python bench_slots.py [users] [capacity]   (default 300 users, 25 seats)
+"""
+import os
+import sys
+import time
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "bench_slots.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{DB_PATH}"
+
+from sqlalchemy import select, func, insert
+from app import app, db
+from models import User, Registration, SlotInventory, SlotWaitlist
+from registrations import register, ensure_slots, release_registrations
+from unit_of_work import unit_of_work
+
+SLOT = ("dance", "day1", "12:00")
+WORKERS = 32
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    capacity = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+
+    with app.app_context():
+        ensure_slots([SLOT[1]], [SLOT[2]], capacity=capacity)
+        db.session.execute(insert(User), [{"id": i, "telegram_id": str(10**9 + i), "first_name": "Guest"}
+                                          for i in range(1, users + 1)])
+        db.session.commit()
+
+    barrier = threading.Barrier(WORKERS)
+
+    def attempt(user_id):
+        if user_id <= WORKERS:
+            barrier.wait()
+        # Each user taps twice, each tap its own unit of work; the second must not take another seat
+        with unit_of_work(write=True):
+            first = register(user_id, *SLOT)
+        with unit_of_work(write=True):
+            return first, register(user_id, *SLOT)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        results = list(pool.map(attempt, range(1, users + 1)))
+    elapsed = time.perf_counter() - start
+
+    first = [r[0] for r in results]
+    with app.app_context():
+        taken = db.session.scalar(select(SlotInventory.taken).filter_by(activity_type=SLOT[0], day=SLOT[1], time_slot=SLOT[2]))
+        registrations = db.session.scalar(select(func.count()).select_from(Registration))
+        waitlisted = db.session.scalar(select(func.count()).select_from(SlotWaitlist))
+
+        print(f"{users} users x 2 taps, {WORKERS} threads, capacity {capacity}: {elapsed:.2f}s "
+              f"({2 * users / elapsed:.0f} registrations/s)")
+        print(f"registered={first.count('registered')} waitlisted={first.count('waitlisted')} "
+              f"duplicate_taps={sum(r[1] == 'duplicate' for r in results)}")
+        print(f"seats taken={taken} registration rows={registrations} waitlist rows={waitlisted}")
+        assert taken == registrations == min(capacity, users)
+        assert waitlisted == max(users - capacity, 0)
+
+        # Freeing a seat promotes the first user on the waitlist
+        holder = db.session.scalar(select(Registration.user_id).order_by(Registration.id))
+        promoted = release_registrations(holder)
+        taken = db.session.scalar(select(SlotInventory.taken))
+        print(f"released user {holder}: promoted {len(promoted)}, seats taken={taken}")
+        assert taken == min(capacity, users)
+    print("OK: no overbooking")
+
+if __name__ == "__main__":
+    main()
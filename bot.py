@@ -3,99 +3,111 @@ import logging
 import json
 import threading
 from datetime import datetime
-import telebot
-from telebot import types
-from app import app, db
-from models import User, Registration, QuestProgress, StickerGeneration, AdminLog
-from sticker_generator import generate_sticker
-from quest_manager import QuestManager
-import pandas as pd
-import io
+from telebot import types, util
+from sqlalchemy import select
+from app import db
+from models import QuestProgress, QuestStepCompletion, QuestPhotoSubmission, StickerGeneration, AdminLog
+from sticker_generator import generate_sticker, warm_template_cache, pick_photo_size
+from quest_manager import quest_manager
+from quest_codes import is_qr_payload
+from quest_photos import quest_photo_pipeline
+from state_store import conversation_states, state_sweeper
+from screens import ScreenRegistry
+from leaderboard import leaderboard, format_duration
+from dispatcher import DispatchingTeleBot
+from unit_of_work import unit_of_work, on_commit
+from telegram_client import outbound_client
+from user_cache import user_cache
+from sticker_jobs import StickerJobQueue
+from sticker_cache import StickerCache
+from background_service import BackgroundRemovalService, REMOVE_BG_ENABLED
+from broadcast import BroadcastEngine, enqueue_broadcast
+from registrations import register, release_registrations, ensure_slots, slot_snapshot
+from exporter import has_registrations, export_to_file
 
 # Bot token from environment
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
-# Initialize bot
-bot = telebot.TeleBot(BOT_TOKEN)
+# 'polling' for local development, 'webhook' behind gunicorn in production
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # e.g. https://bot.example.com/telegram/webhook
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
 
-# Initialize quest manager
-quest_manager = QuestManager()
+# Bot API requests share a pooled, rate-limited client that retries 429s
+outbound_client.install()
+
+# Initialize bot; updates run concurrently across chats, in order within a chat.
+# Handlers commit their database work in a unit of work before calling the Bot API,
+# so no lock is held across a Telegram round-trip.
+bot = DispatchingTeleBot(BOT_TOKEN, outbound=outbound_client)
+
+# Optional Remove.bg cutouts; stickers fall back to the simple template when unavailable
+background_service = BackgroundRemovalService() if REMOVE_BG_ENABLED else None
+
+# Sticker rendering runs off the polling thread
+sticker_jobs = StickerJobQueue(bot, background_service=background_service, cache=StickerCache())
 
 # Available time slots
 TIME_SLOTS = ["12:00", "14:00", "16:00", "18:00", "20:00"]
 DAYS = ["day1", "day2", "day3"]
 
-# User states for photo upload
-user_states = {}
+# Rate-limited, resumable broadcasts (also picks up jobs queued from the web dashboard)
+broadcast_engine = BroadcastEngine(bot, outbound=outbound_client)
+
+# Number of past stickers shown by /mystickers (Telegram albums hold at most 10)
+MY_STICKERS_LIMIT = 10
+
+# Entries shown by /leaderboard
+LEADERBOARD_SIZE = 10
+
+# Keyboards and static texts are built once and served from here
+screens = ScreenRegistry()
+
+def back_keyboard():
+    markup = types.InlineKeyboardMarkup()
+    markup.row(types.InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu"))
+    return markup
+
+@screens.screen("back")
+def back_screen():
+    return "", back_keyboard()
 
 @bot.message_handler(commands=['start'])
 def start_command(message):
     """Handle /start command"""
-    user_id = str(message.from_user.id)
-    
-    with app.app_context():
-        # Create or get user
-        db_user = User.query.filter_by(telegram_id=user_id).first()
-        if not db_user:
-            db_user = User(
-                telegram_id=user_id,
-                username=message.from_user.username,
-                first_name=message.from_user.first_name,
-                last_name=message.from_user.last_name
-            )
-            db.session.add(db_user)
-            db.session.commit()
+    # Create or get user (cached after the first /start)
+    identity = user_cache.upsert(message.from_user)
+    
+    # Quest QR codes are deep links: t.me/<bot>?start=<signed payload>
+    payload = util.extract_arguments(message.text or "")
+    if is_qr_payload(payload):
+        handle_quest_scan(message, identity, payload)
+        return
     
     # Send welcome message
     welcome_text = f"🎪 Добро пожаловать на фестиваль Avito × Dikaya Myata, {message.from_user.first_name}!\n\n"
     welcome_text += "Выберите действие из меню ниже:"
     
-    # Create inline keyboard
-    markup = types.InlineKeyboardMarkup()
-    markup.row(types.InlineKeyboardButton("📍 Карта", callback_data="map"))
-    markup.row(
-        types.InlineKeyboardButton("💃 Танцы", callback_data="dance"),
-        types.InlineKeyboardButton("🧘 Йога", callback_data="yoga")
-    )
-    markup.row(
-        types.InlineKeyboardButton("🧩 Квест", callback_data="quest"),
-        types.InlineKeyboardButton("🤳 Стикер", callback_data="sticker")
-    )
-    markup.row(types.InlineKeyboardButton("📅 Расписание", callback_data="schedule"))
-    
-    bot.send_message(message.chat.id, welcome_text, reply_markup=markup)
+    bot.send_message(message.chat.id, welcome_text, reply_markup=screens.get("main_menu").markup)
 
 @bot.callback_query_handler(func=lambda call: True)
 def callback_handler(call):
     """Handle button callbacks"""
-    user_id = str(call.from_user.id)
     data = call.data
     
     try:
-        if data == "map":
-            handle_map(call)
-        elif data == "dance":
-            handle_activity_registration(call, "dance")
-        elif data == "yoga":
-            handle_activity_registration(call, "yoga")
-        elif data == "quest":
-            handle_quest(call)
-        elif data == "sticker":
-            handle_sticker_request(call)
-        elif data == "schedule":
-            handle_schedule(call)
-        elif data.startswith("register_"):
-            handle_registration_selection(call)
-        elif data == "back_to_menu":
-            show_main_menu(call)
+        # Exact matches first, then the prefix before the first "_" (e.g. register_<slot>)
+        handler = CALLBACK_HANDLERS.get(data) or CALLBACK_PREFIX_HANDLERS.get(data.partition("_")[0])
+        if handler:
+            handler(call)
         
         bot.answer_callback_query(call.id)
     except Exception as e:
         logging.error(f"Error in callback handler: {e}")
         bot.answer_callback_query(call.id, "Произошла ошибка")
 
-def handle_map(call):
-    """Send festival map"""
+@screens.screen("map")
+def map_screen():
     map_text = "🗺️ Карта фестиваля\n\n"
     map_text += "📍 Основные зоны:\n"
     map_text += "🎵 Главная сцена\n"
@@ -104,30 +116,42 @@ def handle_map(call):
     map_text += "🍽️ Фуд-корт\n"
     map_text += "🏮 Маяк (для квеста)\n\n"
     map_text += "Нажмите на локацию на карте, чтобы узнать больше!"
-    
-    markup = types.InlineKeyboardMarkup()
-    markup.row(types.InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu"))
-    
-    bot.edit_message_text(map_text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    return map_text, back_keyboard()
 
-def handle_activity_registration(call, activity_type):
-    """Handle dance/yoga registration"""
+def handle_map(call):
+    """Send festival map"""
+    screen = screens.get("map")
+    bot.edit_message_text(screen.text, call.message.chat.id, call.message.message_id, reply_markup=screen.markup)
+
+@screens.screen("registration")
+def registration_screen(activity_type):
     activity_name = "Танцы" if activity_type == "dance" else "Йога"
     
     text = f"💫 Регистрация на {activity_name}\n\n"
     text += "Выберите день и время:\n\n"
     
+    remaining = slot_snapshot.remaining
     markup = types.InlineKeyboardMarkup()
     for day_num, day in enumerate(DAYS, 1):
         day_name = f"День {day_num}"
         for time_slot in TIME_SLOTS:
-            button_text = f"{day_name} - {time_slot}"
+            seats = remaining.get((activity_type, day, time_slot), 0)
+            seats_text = f"мест: {seats}" if seats > 0 else "лист ожидания"
+            button_text = f"{day_name} - {time_slot} ({seats_text})"
             callback_data = f"register_{activity_type}_{day}_{time_slot}"
             markup.row(types.InlineKeyboardButton(button_text, callback_data=callback_data))
     
     markup.row(types.InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu"))
+    return text, markup
+
+def handle_activity_registration(call, activity_type):
+    """Handle dance/yoga registration"""
+    with unit_of_work():
+        slot_snapshot.get()
     
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    # Rebuilt only when the remaining seats changed
+    screen = screens.get("registration", activity_type, version=slot_snapshot.version)
+    bot.edit_message_text(screen.text, call.message.chat.id, call.message.message_id, reply_markup=screen.markup)
 
 def handle_registration_selection(call):
     """Handle specific registration selection"""
@@ -136,90 +160,134 @@ def handle_registration_selection(call):
     day = data_parts[2]
     time_slot = data_parts[3]
     
-    user_id = str(call.from_user.id)
-    
-    with app.app_context():
-        db_user = User.query.filter_by(telegram_id=user_id).first()
-        if db_user:
-            # Check if already registered for this slot
-            existing = Registration.query.filter_by(
-                user_id=db_user.id,
-                activity_type=activity_type,
-                day=day,
-                time_slot=time_slot
-            ).first()
-            
-            if existing:
+    identity = user_cache.get(call.from_user.id)
+    text = "Сначала нажмите /start, чтобы зарегистрироваться."
+    
+    with unit_of_work(write=True):
+        if identity:
+            # Seat and registration are taken in one transaction; full slots go to the waitlist
+            status = register(identity.id, activity_type, day, time_slot)
+            activity_name = "Танцы" if activity_type == "dance" else "Йога"
+            day_num = day.replace("day", "")
+            if status == 'duplicate':
                 text = "❌ Вы уже зарегистрированы на это время!"
+            elif status == 'waitlisted':
+                text = f"⏳ Все места заняты: {activity_name}, День {day_num}, {time_slot}.\n\n"
+                text += "Вы в листе ожидания — напишу, как только освободится место."
             else:
-                registration = Registration(
-                    user_id=db_user.id,
-                    activity_type=activity_type,
-                    day=day,
-                    time_slot=time_slot
-                )
-                db.session.add(registration)
-                db.session.commit()
-                
-                activity_name = "Танцы" if activity_type == "dance" else "Йога"
-                day_num = day.replace("day", "")
                 text = f"✅ Успешно зарегистрированы!\n\n"
                 text += f"📅 {activity_name}\n"
                 text += f"🗓️ День {day_num}\n"
                 text += f"🕒 {time_slot}\n\n"
                 text += "Увидимся на фестивале! 🎉"
     
+    # Only reached once the registration is committed
+    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=screens.get("back").markup)
+
+def get_quest_progress(user_id):
+    """User's quest progress, starting today's quest variant on first use; runs in the caller's unit of work"""
+    quest_progress = QuestProgress.query.filter_by(user_id=user_id).first()
+    if not quest_progress:
+        quest = quest_manager.quest_for_today()
+        quest_progress = QuestProgress(user_id=user_id, quest_id=quest.quest_id,
+                                       quest_step=quest.available(0)[0].number)
+        db.session.add(quest_progress)
+        db.session.flush()
+    return quest_progress
+
+def quest_status_text(quest_progress):
+    """Completion message or the descriptions of every step available now"""
+    if quest_progress.completed:
+        text = "🎉 Поздравляем! Вы успешно завершили квест!\n\n"
+        text += "Покажите этот код организаторам для получения приза: QUEST_COMPLETE_2024"
+        return text
+    
+    quest = quest_manager.get_quest(quest_progress.quest_id)
+    available = quest_manager.available_steps(quest_progress)
+    text = f"🧭 {quest.title} - Шаг {quest_progress.quest_step}\n\n"
+    if len(available) > 1:
+        text += "Можно выполнять в любом порядке:\n\n"
+    text += "\n\n".join(step.description for step in available) if available else "Квест завершен"
+    return text
+
+def quest_keyboard(quest_progress):
+    """Back button, plus one button per photo step when several can be done in parallel"""
+    photo_steps = quest_manager.photo_steps(quest_progress)
+    if len(photo_steps) < 2:
+        return back_keyboard()
     markup = types.InlineKeyboardMarkup()
+    for step in photo_steps:
+        markup.row(types.InlineKeyboardButton(f"📸 Фото для шага {step.number}", callback_data=f"questphoto_{step.number}"))
     markup.row(types.InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu"))
-    
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    return markup
 
 def handle_quest(call):
     """Handle quest system"""
-    user_id = str(call.from_user.id)
+    identity = user_cache.get(call.from_user.id)
+    if not identity:
+        return
     
-    with app.app_context():
-        db_user = User.query.filter_by(telegram_id=user_id).first()
-        if not db_user:
-            return
-        
-        quest_progress = QuestProgress.query.filter_by(user_id=db_user.id).first()
-        if not quest_progress:
-            quest_progress = QuestProgress(user_id=db_user.id)
-            db.session.add(quest_progress)
-            db.session.commit()
-        
-        current_step = quest_progress.quest_step
-        quest_info = quest_manager.get_quest_step(current_step)
+    with unit_of_work(write=True):
+        quest_progress = get_quest_progress(identity.id)
+        text = quest_status_text(quest_progress)
+        markup = quest_keyboard(quest_progress)
+    
+    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+
+def handle_quest_photo_choice(call):
+    """Remember which parallel photo step the next photo is for"""
+    identity = user_cache.get(call.from_user.id)
+    if not identity:
+        return
+    step_number = int(call.data.split("_")[1])
+    
+    with unit_of_work():
+        quest_progress = QuestProgress.query.filter_by(user_id=identity.id).first()
+        step = quest_progress and next((step for step in quest_manager.photo_steps(quest_progress)
+                                        if step.number == step_number), None)
+    
+    if not step:
+        bot.edit_message_text("Это задание уже неактуально. Откройте «🧩 Квест» в меню еще раз.",
+                              call.message.chat.id, call.message.message_id, reply_markup=back_keyboard())
+        return
+    conversation_states.set(call.from_user.id, f"quest_photo_{step.number}")
+    bot.edit_message_text(f"📸 Пришлите фото для задания:\n\n{step.description}",
+                          call.message.chat.id, call.message.message_id, reply_markup=back_keyboard())
+
+def handle_quest_scan(message, identity, payload):
+    """Apply a scanned quest QR code"""
+    with unit_of_work(write=True):
+        quest_progress = get_quest_progress(identity.id)
+        success, result = quest_manager.advance_quest_step(quest_progress, "qr", payload)
         
-        if quest_progress.completed:
-            text = "🎉 Поздравляем! Вы успешно завершили квест!\n\n"
-            text += "Покажите этот код организаторам для получения приза: QUEST_COMPLETE_2024"
+        if success:
+            text = "✅ QR-код принят!\n\n" + quest_status_text(quest_progress)
+        elif result == "Invalid QR code":
+            text = "❌ Этот QR-код недействителен или относится к другому дню."
+        elif result == "Quest already completed":
+            text = quest_status_text(quest_progress)
         else:
-            text = f"🧭 Квест - Шаг {current_step}\n\n"
-            text += quest_info['description'] if quest_info else "Квест завершен"
-        
-        markup = types.InlineKeyboardMarkup()
-        markup.row(types.InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu"))
-        
-        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+            text = "⏳ Этот QR-код пока не подходит. Сначала выполните текущие задания:\n\n" + quest_status_text(quest_progress)
+    
+    bot.send_message(message.chat.id, text)
 
-def handle_sticker_request(call):
-    """Handle sticker generation request"""
+@screens.screen("sticker")
+def sticker_screen():
     text = "🤳 Генерация персонального стикера\n\n"
     text += "Отправьте свое фото, и я создам для вас уникальный стикер с рамкой фестиваля!\n\n"
     text += "💡 Совет: Лучше всего работают фото с четким изображением лица на однотонном фоне."
-    
-    markup = types.InlineKeyboardMarkup()
-    markup.row(types.InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu"))
-    
+    return text, back_keyboard()
+
+def handle_sticker_request(call):
+    """Handle sticker generation request"""
     # Set user state for photo upload
-    user_states[call.from_user.id] = 'awaiting_photo'
+    conversation_states.set(call.from_user.id, 'awaiting_photo')
     
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    screen = screens.get("sticker")
+    bot.edit_message_text(screen.text, call.message.chat.id, call.message.message_id, reply_markup=screen.markup)
 
-def handle_schedule(call):
-    """Show festival schedule"""
+@screens.screen("schedule")
+def schedule_screen():
     text = "📅 Расписание фестиваля\n\n"
     text += "🎪 День 1\n"
     text += "12:00 - Открытие фестиваля\n"
@@ -241,66 +309,148 @@ def handle_schedule(call):
     text += "16:00 - Финальное шоу\n"
     text += "18:00 - Закрытие фестиваля"
     
-    markup = types.InlineKeyboardMarkup()
-    markup.row(types.InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu"))
-    
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    return text, back_keyboard()
+
+def handle_schedule(call):
+    """Show festival schedule"""
+    screen = screens.get("schedule")
+    bot.edit_message_text(screen.text, call.message.chat.id, call.message.message_id, reply_markup=screen.markup)
 
 @bot.message_handler(content_types=['photo'])
 def handle_photo(message):
-    """Handle photo uploads for sticker generation"""
-    if message.from_user.id not in user_states or user_states[message.from_user.id] != 'awaiting_photo':
+    """Handle photo uploads for sticker generation and quest photo steps"""
+    # Claiming the state atomically lets exactly one photo start a sticker
+    if not conversation_states.compare_and_set(message.from_user.id, 'awaiting_photo', None):
+        handle_quest_photo(message)
         return
     
-    user_id = str(message.from_user.id)
+    # Smallest resolution that still fills the sticker frame
+    photo = pick_photo_size(message.photo)
+    status, position = sticker_jobs.submit(
+        message.from_user.id, message.chat.id, photo.file_id,
+        largest_file_size=message.photo[-1].file_size,
+        photo_unique_id=photo.file_unique_id
+    )
     
-    bot.send_message(message.chat.id, "🔄 Обрабатываю ваше фото... Это может занять несколько секунд.")
+    if status == "full":
+        # Restore the state so the user can simply resend the photo
+        conversation_states.set(message.from_user.id, 'awaiting_photo')
+        bot.send_message(message.chat.id, "⏳ Сейчас очень много желающих получить стикер. Отправьте фото еще раз через минуту.")
+        return
     
-    try:
-        # Get the highest resolution photo
-        photo = message.photo[-1]
-        file_info = bot.get_file(photo.file_id)
-        photo_bytes = bot.download_file(file_info.file_path)
+    if status == "duplicate":
+        bot.send_message(message.chat.id, "🔄 Мы уже обрабатываем ваше предыдущее фото. Стикер скоро будет готов!")
+    elif position and position > 1:
+        bot.send_message(message.chat.id, f"🔄 Фото принято! Вы #{position} в очереди, стикер скоро будет готов.")
+    else:
+        bot.send_message(message.chat.id, "🔄 Обрабатываю ваше фото... Это может занять несколько секунд.")
+
+def handle_quest_photo(message):
+    """Queue a photo for the user's current quest photo step"""
+    identity = user_cache.get(message.from_user.id)
+    if not identity:
+        return
+    
+    # A step picked with the quest screen buttons wins; otherwise the first photo step not under review
+    state = conversation_states.get(message.from_user.id)
+    chosen = int(state.rsplit("_", 1)[1]) if state and state.startswith("quest_photo_") else None
+    
+    with unit_of_work():
+        quest_progress = QuestProgress.query.filter_by(user_id=identity.id).first()
+        if not quest_progress or quest_progress.completed:
+            return
+        photo_steps = [step for step in quest_manager.photo_steps(quest_progress) if chosen in (None, step.number)]
+        under_review = set(db.session.scalars(select(QuestPhotoSubmission.step).filter_by(
+            quest_progress_id=quest_progress.id, status='pending'
+        )))
+        progress_id = quest_progress.id
+    
+    if not photo_steps:
+        bot.send_message(message.chat.id, "🧭 Сейчас в квесте нужно отсканировать QR-код, а не прислать фото.")
+        return
+    step = next((step for step in photo_steps if step.number not in under_review), None)
+    if not step:
+        bot.send_message(message.chat.id, "⏳ Ваше фото для этого задания уже на проверке.")
+        return
+    
+    # The largest size is kept for review; the smallest thumbnail is enough for the duplicate hash
+    status = quest_photo_pipeline.submit(
+        progress_id, step.number, message.chat.id,
+        message.photo[-1].file_id, message.photo[-1].file_unique_id, message.photo[0].file_id
+    )
+    if chosen is not None and status == "queued":
+        conversation_states.compare_and_set(message.from_user.id, state, None)
+    if status == "full":
+        bot.send_message(message.chat.id, "⏳ Сейчас очень много фото на проверке. Отправьте фото еще раз через минуту.")
+    elif status == "duplicate":
+        bot.send_message(message.chat.id, "🔄 Мы уже проверяем ваше предыдущее фото.")
+    else:
+        bot.send_message(message.chat.id, "📸 Фото получено! Проверяем его, результат придет сюда.")
+
+@bot.message_handler(commands=['mystickers'])
+def my_stickers_command(message):
+    """Resend previously generated stickers by file_id (admins may pass a telegram_id)"""
+    identity = user_cache.get(message.from_user.id)
+    command_parts = message.text.split()
+    if not identity:
+        return
+    
+    if len(command_parts) > 1:
+        if not user_cache.is_admin(message.from_user.id):
+            bot.send_message(message.chat.id, "❌ У вас нет прав доступа к этой команде.")
+            return
+        identity = user_cache.get(command_parts[1])
+        if not identity:
+            bot.send_message(message.chat.id, "❌ Пользователь не найден.")
+            return
+    
+    with unit_of_work():
+        stickers = StickerGeneration.query.filter(
+            StickerGeneration.user_id == identity.id,
+            StickerGeneration.generated_sticker_file_id.isnot(None)
+        ).order_by(StickerGeneration.created_at.desc()).limit(MY_STICKERS_LIMIT).all()
         
-        with app.app_context():
-            # Generate sticker (simplified version without external APIs for now)
-            from sticker_generator import generate_simple_sticker, TEMPLATES
-            import random
-            
-            template_info = random.choice(TEMPLATES)
-            sticker_bytes = generate_simple_sticker(photo_bytes, template_info)
-            
-            if sticker_bytes:
-                # Save to database
-                db_user = User.query.filter_by(telegram_id=user_id).first()
-                if db_user:
-                    sticker_gen = StickerGeneration(
-                        user_id=db_user.id,
-                        template_used=template_info['name'],
-                        original_photo_file_id=photo.file_id
-                    )
-                    db.session.add(sticker_gen)
-                    db.session.commit()
-                
-                # Send sticker
-                bot.send_photo(
-                    message.chat.id,
-                    sticker_bytes,
-                    caption="🎉 Ваш персональный стикер готов!\n\n\"Хорошие истории начинаются с тебя\" ✨"
-                )
-            else:
-                bot.send_message(message.chat.id, "❌ Не удалось обработать фото. Попробуйте другое изображение.")
+        gallery = [(s.generated_sticker_file_id, s.output_mode) for s in stickers]
     
-    except Exception as e:
-        logging.error(f"Error generating sticker: {e}")
-        bot.send_message(message.chat.id, "❌ Произошла ошибка при обработке фото. Попробуйте позже.")
+    if not gallery:
+        bot.send_message(message.chat.id, "🤳 Стикеров пока нет. Нажмите «Стикер» в меню, чтобы создать первый!")
+        return
     
-    finally:
-        if message.from_user.id in user_states:
-            del user_states[message.from_user.id]
+    # Photos go out as one album, Telegram stickers one by one; nothing is re-uploaded
+    photo_ids = [file_id for file_id, mode in gallery if mode != "tg_sticker"]
+    if len(photo_ids) > 1:
+        bot.send_media_group(message.chat.id, [types.InputMediaPhoto(file_id) for file_id in photo_ids])
+    elif photo_ids:
+        bot.send_photo(message.chat.id, photo_ids[0])
+    for file_id, mode in gallery:
+        if mode == "tg_sticker":
+            bot.send_sticker(message.chat.id, file_id)
 
-def show_main_menu(call):
-    """Show main menu"""
+@bot.message_handler(commands=['leaderboard'])
+def leaderboard_command(message):
+    """Show the fastest quest finishers and the user's own rank"""
+    identity = user_cache.get(message.from_user.id)
+    
+    with unit_of_work():
+        top = quest_manager.get_leaderboard(LEADERBOARD_SIZE)
+        my_rank, total = leaderboard.rank(identity.id) if identity else (None, 0)
+    
+    if not top:
+        bot.send_message(message.chat.id, "🏆 Пока никто не прошел квест. Станьте первым!")
+        return
+    
+    text = "🏆 Самые быстрые участники квеста:\n\n"
+    for entry in top:
+        text += f"{entry['rank']}. {entry['username'] or 'Участник'} — {format_duration(entry['total_time'])}\n"
+    if my_rank:
+        text += f"\nВаше место: {my_rank} из {total}"
+    else:
+        text += "\nВы еще не прошли квест."
+    
+    bot.send_message(message.chat.id, text)
+
+@screens.screen("main_menu")
+def main_menu_screen():
     welcome_text = "🎪 Главное меню фестиваля\n\nВыберите действие:"
     
     markup = types.InlineKeyboardMarkup()
@@ -314,112 +464,154 @@ def show_main_menu(call):
         types.InlineKeyboardButton("🤳 Стикер", callback_data="sticker")
     )
     markup.row(types.InlineKeyboardButton("📅 Расписание", callback_data="schedule"))
-    
-    bot.edit_message_text(welcome_text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    return welcome_text, markup
+
+def show_main_menu(call):
+    """Show main menu"""
+    screen = screens.get("main_menu")
+    bot.edit_message_text(screen.text, call.message.chat.id, call.message.message_id, reply_markup=screen.markup)
+
+# Callback data -> handler; CALLBACK_PREFIX_HANDLERS is keyed by the part before the first "_"
+CALLBACK_HANDLERS = {
+    "map": handle_map,
+    "dance": lambda call: handle_activity_registration(call, "dance"),
+    "yoga": lambda call: handle_activity_registration(call, "yoga"),
+    "quest": handle_quest,
+    "sticker": handle_sticker_request,
+    "schedule": handle_schedule,
+    "back_to_menu": show_main_menu,
+}
+
+CALLBACK_PREFIX_HANDLERS = {
+    "register": handle_registration_selection,
+    "questphoto": handle_quest_photo_choice,
+}
 
 # Admin commands
 @bot.message_handler(commands=['admin_log'])
 def admin_log_command(message):
-    """Export participant data as CSV"""
-    user_id = str(message.from_user.id)
+    """Export participant data as CSV (/admin_log parquet for Parquet)"""
+    if not user_cache.is_admin(message.from_user.id):
+        bot.send_message(message.chat.id, "❌ У вас нет прав доступа к этой команде.")
+        return
     
-    with app.app_context():
-        user = User.query.filter_by(telegram_id=user_id).first()
-        if not user or not user.is_admin:
-            bot.send_message(message.chat.id, "❌ У вас нет прав доступа к этой команде.")
-            return
-        
-        # Get all registrations with user data
-        registrations = db.session.query(Registration, User).join(User).all()
-        
-        data = []
-        for reg, user in registrations:
-            data.append({
-                'telegram_id': user.telegram_id,
-                'username': user.username,
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-                'activity': reg.activity_type,
-                'day': reg.day,
-                'time_slot': reg.time_slot,
-                'registered_at': reg.created_at
-            })
-        
-        if data:
-            df = pd.DataFrame(data)
-            csv_buffer = io.StringIO()
-            df.to_csv(csv_buffer, index=False)
-            csv_bytes = csv_buffer.getvalue().encode('utf-8')
-            
-            filename = f"participants_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-            bot.send_document(message.chat.id, csv_bytes, visible_file_name=filename)
+    command_parts = message.text.split()
+    fmt = 'parquet' if len(command_parts) > 1 and command_parts[1] == 'parquet' else 'csv'
+    
+    export_file = None
+    with unit_of_work():
+        if not has_registrations():
+            error_text = "📊 Нет данных для экспорта."
         else:
-            bot.send_message(message.chat.id, "📊 Нет данных для экспорта.")
+            try:
+                export_file = export_to_file(fmt)
+            except RuntimeError as e:
+                error_text = f"❌ {e}"
+    
+    if export_file is None:
+        bot.send_message(message.chat.id, error_text)
+        return
+    
+    with export_file:
+        filename = f"participants_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+        bot.send_document(message.chat.id, export_file, visible_file_name=filename)
 
 @bot.message_handler(commands=['reset'])
 def reset_user_command(message):
     """Reset user data"""
-    user_id = str(message.from_user.id)
+    if not user_cache.is_admin(message.from_user.id):
+        bot.send_message(message.chat.id, "❌ У вас нет прав доступа к этой команде.")
+        return
     
-    with app.app_context():
-        admin_user = User.query.filter_by(telegram_id=user_id).first()
-        if not admin_user or not admin_user.is_admin:
-            bot.send_message(message.chat.id, "❌ У вас нет прав доступа к этой команде.")
-            return
-        
-        command_parts = message.text.split()
-        if len(command_parts) < 2:
-            bot.send_message(message.chat.id, "Использование: /reset <telegram_id>")
-            return
-        
-        target_telegram_id = command_parts[1]
-        target_user = User.query.filter_by(telegram_id=target_telegram_id).first()
-        
-        if not target_user:
-            bot.send_message(message.chat.id, "❌ Пользователь не найден.")
-            return
-        
-        # Delete all user data
-        Registration.query.filter_by(user_id=target_user.id).delete()
+    command_parts = message.text.split()
+    if len(command_parts) < 2:
+        bot.send_message(message.chat.id, "Использование: /reset <telegram_id>")
+        return
+    
+    target_telegram_id = command_parts[1]
+    target_user = user_cache.get(target_telegram_id)
+    
+    if not target_user:
+        bot.send_message(message.chat.id, "❌ Пользователь не найден.")
+        return
+    
+    with unit_of_work(write=True):
+        # Delete all user data; freed seats go to the waitlist
+        promoted = release_registrations(target_user.id)
+        progress_ids = select(QuestProgress.id).filter_by(user_id=target_user.id)
+        QuestStepCompletion.query.filter(QuestStepCompletion.quest_progress_id.in_(progress_ids)).delete(synchronize_session=False)
+        QuestPhotoSubmission.query.filter(QuestPhotoSubmission.quest_progress_id.in_(progress_ids)).delete(synchronize_session=False)
         QuestProgress.query.filter_by(user_id=target_user.id).delete()
         StickerGeneration.query.filter_by(user_id=target_user.id).delete()
-        db.session.commit()
         
-        bot.send_message(message.chat.id, f"✅ Данные пользователя {target_telegram_id} сброшены.")
+        # Caches and waitlist notifications follow the committed data
+        on_commit(lambda: user_cache.invalidate(target_telegram_id))
+        on_commit(lambda: leaderboard.remove(target_user.id))
+        on_commit(lambda: notify_promoted(promoted))
+    
+    bot.send_message(message.chat.id, f"✅ Данные пользователя {target_telegram_id} сброшены.")
+
+def notify_promoted(promoted):
+    """Tell users moved from the waitlist into a freed seat"""
+    for telegram_id, activity_type, day, time_slot in promoted:
+        activity_name = "Танцы" if activity_type == "dance" else "Йога"
+        try:
+            bot.send_message(telegram_id, f"🎉 Освободилось место! Вы зарегистрированы: {activity_name}, День {day.replace('day', '')}, {time_slot}.")
+        except Exception as e:
+            logging.error(f"Error notifying waitlisted user {telegram_id}: {e}")
 
 @bot.message_handler(commands=['broadcast'])
 def broadcast_command(message):
     """Broadcast message to all users"""
-    user_id = str(message.from_user.id)
+    if not user_cache.is_admin(message.from_user.id):
+        bot.send_message(message.chat.id, "❌ У вас нет прав доступа к этой команде.")
+        return
     
-    with app.app_context():
-        admin_user = User.query.filter_by(telegram_id=user_id).first()
-        if not admin_user or not admin_user.is_admin:
-            bot.send_message(message.chat.id, "❌ У вас нет прав доступа к этой команде.")
-            return
-        
-        command_parts = message.text.split(maxsplit=1)
-        if len(command_parts) < 2:
-            bot.send_message(message.chat.id, "Использование: /broadcast <сообщение>")
-            return
-        
-        broadcast_message = command_parts[1]
-        users = User.query.all()
-        
-        sent_count = 0
-        for user in users:
-            try:
-                bot.send_message(int(user.telegram_id), f"📢 {broadcast_message}")
-                sent_count += 1
-            except Exception as e:
-                logging.error(f"Failed to send message to {user.telegram_id}: {e}")
-        
-        bot.send_message(message.chat.id, f"✅ Сообщение отправлено {sent_count} пользователям.")
+    command_parts = message.text.split(maxsplit=1)
+    if len(command_parts) < 2:
+        bot.send_message(message.chat.id, "Использование: /broadcast <сообщение>")
+        return
+    
+    with unit_of_work(write=True):
+        job = enqueue_broadcast(command_parts[1], created_by=str(message.from_user.id))
+        total = job.total
+        # The engine must not look for the job before it is committed
+        on_commit(broadcast_engine.notify)
+    
+    bot.send_message(message.chat.id, f"📨 Рассылка поставлена в очередь: {total} получателей. Сообщу, когда закончу.")
+
+def start_bot_services():
+    """Start the background workers used by the handlers"""
+    quest_manager.catalog.check_day_dates()
+    warm_template_cache()
+    with unit_of_work(write=True):
+        ensure_slots(DAYS, TIME_SLOTS)
+        leaderboard.rebuild()
+    if background_service:
+        background_service.start()
+    sticker_jobs.start()
+    quest_photo_pipeline.start(bot)
+    state_sweeper.start()
+    broadcast_engine.start()
+
+def configure_webhook():
+    """Point Telegram at the webhook route of the Flask app"""
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise RuntimeError("BOT_MODE=webhook requires WEBHOOK_URL and WEBHOOK_SECRET")
+    bot.remove_webhook()
+    bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, drop_pending_updates=False)
+    logging.info(f"Telegram webhook set to {WEBHOOK_URL}")
 
 def start_bot():
     """Start the Telegram bot"""
-    logging.info("Starting Telegram bot...")
+    logging.info(f"Starting Telegram bot in {BOT_MODE} mode...")
+    start_bot_services()
     try:
-        bot.infinity_polling(timeout=10, long_polling_timeout=5)
+        if BOT_MODE == "webhook":
+            # Updates arrive through webhook_routes; nothing to poll
+            configure_webhook()
+        else:
+            bot.remove_webhook()
+            bot.infinity_polling(timeout=10, long_polling_timeout=5)
     except Exception as e:
         logging.error(f"Bot polling error: {e}")
@@ -0,0 +1,246 @@
+import os
+import uuid
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import select, insert, update, func, literal, or_, and_
+from telebot.apihelper import ApiTelegramException
+from app import db
+from models import User, BroadcastJob, BroadcastRecipient
+from telegram_client import outbound_client
+from unit_of_work import unit_of_work
+
+# Broadcasts are sent in the outbound client's bulk mode, see TELEGRAM_BULK_RATE
+BROADCAST_SENDERS = int(os.getenv("BROADCAST_SENDERS", "8"))
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "500"))
+BROADCAST_MAX_ATTEMPTS = 5
+
+# How often the engine looks for jobs queued by other processes (e.g. the web dashboard)
+BROADCAST_POLL_INTERVAL = 5
+
+# Seconds a claimed job stays with its engine without a renewal; every gunicorn
+# worker runs an engine, and a job whose owner died is taken over after this
+BROADCAST_LEASE = int(os.getenv("BROADCAST_LEASE", "120"))
+
+def enqueue_broadcast(message, created_by=None):
+    """Persist a broadcast job and its recipient list; returns the job.
+
+    Recipients are copied from the user table with a single INSERT ... SELECT,
+    so no user rows are loaded into Python. Runs in the caller's unit of work.
+    """
+    job = BroadcastJob(message=message, created_by=created_by)
+    db.session.add(job)
+    db.session.flush()
+
+    db.session.execute(
+        insert(BroadcastRecipient).from_select(
+            ['job_id', 'telegram_id', 'status'],
+            select(literal(job.id), User.telegram_id, literal('pending'))
+        )
+    )
+    job.total = db.session.scalar(
+        select(func.count()).select_from(BroadcastRecipient).filter_by(job_id=job.id)
+    )
+    logging.info(f"Broadcast job {job.id} queued for {job.total} users")
+    return job
+
+class BroadcastEngine:
+    """Sends persisted broadcast jobs under a global rate limit.
+
+    Every process runs an engine, so work is claimed in the database: a job
+    by a conditional UPDATE that sets its owner and lease, and recipients in
+    batches by moving them from 'pending' to 'sending' under the engine's id.
+    Only the rows an engine claimed are recorded as sent or failed, so
+    counters are not inflated. A job whose lease expired is taken over and its
+    unfinished 'sending' rows are retried. Every recipient is a separate chat,
+    so one message per chat per job keeps the per-chat limit. Sends go
+    through the outbound client in bulk mode, which holds them to the bulk
+    rate and retries 429 responses after retry_after.
+    """
+
+    def __init__(self, bot, outbound=outbound_client, senders=BROADCAST_SENDERS, batch_size=BROADCAST_BATCH_SIZE,
+                 lease=BROADCAST_LEASE):
+        self.bot = bot
+        self.outbound = outbound
+        self.senders = senders
+        self.batch_size = batch_size
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread:
+            return
+        self.thread = threading.Thread(target=self._run, name="broadcast", daemon=True)
+        self.thread.start()
+
+    def notify(self):
+        """Wake the engine after a job was queued in this process"""
+        self.wakeup.set()
+
+    def _run(self):
+        executor = ThreadPoolExecutor(max_workers=self.senders, thread_name_prefix="broadcast-send")
+        while True:
+            try:
+                job_id = self._claim_job()
+                if job_id:
+                    self._run_job(job_id, executor)
+                    continue
+            except Exception as e:
+                logging.error(f"Broadcast engine error: {e}")
+            self.wakeup.wait(BROADCAST_POLL_INTERVAL)
+            self.wakeup.clear()
+
+    def _claimable(self, now):
+        """Jobs nobody is sending: pending, or running with an expired (or no) lease"""
+        return or_(
+            BroadcastJob.status == 'pending',
+            and_(BroadcastJob.status == 'running',
+                 or_(BroadcastJob.lease_until.is_(None), BroadcastJob.lease_until < now)),
+        )
+
+    def _claim_job(self):
+        """Take the oldest claimable job; returns its id, or None if there is none or another engine won"""
+        now = datetime.utcnow()
+        with unit_of_work(write=True):
+            job_id = db.session.scalar(
+                select(BroadcastJob.id).where(self._claimable(now)).order_by(BroadcastJob.id).limit(1)
+            )
+            if not job_id:
+                return None
+            claimed = db.session.execute(
+                update(BroadcastJob)
+                .where(BroadcastJob.id == job_id, self._claimable(now))
+                .values(status='running', owner=self.owner, lease_until=now + timedelta(seconds=self.lease))
+            ).rowcount
+            if not claimed:
+                return None
+            # Recipients claimed by an engine that lost the lease were never recorded; send them again
+            retried = db.session.execute(
+                update(BroadcastRecipient)
+                .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.status == 'sending')
+                .values(status='pending', claimed_by=None)
+            ).rowcount
+        if retried:
+            logging.info(f"Broadcast job {job_id}: {retried} unrecorded recipients queued again")
+        return job_id
+
+    def _renew_lease(self, job_id):
+        """Extend the lease; False if another engine took the job over"""
+        with unit_of_work(write=True):
+            return db.session.execute(
+                update(BroadcastJob)
+                .where(BroadcastJob.id == job_id, BroadcastJob.owner == self.owner, BroadcastJob.status == 'running')
+                .values(lease_until=datetime.utcnow() + timedelta(seconds=self.lease))
+            ).rowcount == 1
+
+    def _claim_batch(self, job_id):
+        """Move up to batch_size pending recipients to 'sending' for this engine and return them"""
+        with unit_of_work(write=True):
+            pending = (
+                select(BroadcastRecipient.id)
+                .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.status == 'pending')
+                .order_by(BroadcastRecipient.id)
+                .limit(self.batch_size)
+            )
+            if db.session.get_bind().dialect.name == 'postgresql':
+                pending = pending.with_for_update(skip_locked=True)
+            db.session.execute(
+                update(BroadcastRecipient)
+                .where(BroadcastRecipient.id.in_(pending), BroadcastRecipient.status == 'pending')
+                .values(status='sending', claimed_by=self.owner)
+                .execution_options(synchronize_session=False)
+            )
+            return db.session.execute(
+                select(BroadcastRecipient.id, BroadcastRecipient.telegram_id)
+                .where(
+                    BroadcastRecipient.job_id == job_id,
+                    BroadcastRecipient.status == 'sending',
+                    BroadcastRecipient.claimed_by == self.owner
+                )
+                .order_by(BroadcastRecipient.id)
+            ).all()
+
+    def _run_job(self, job_id, executor):
+        with unit_of_work():
+            job = db.session.get(BroadcastJob, job_id)
+            if job.sent or job.failed:
+                logging.info(f"Resuming broadcast job {job_id} ({job.sent + job.failed}/{job.total} done)")
+            text = f"📢 {job.message}"
+            created_by = job.created_by
+
+        while True:
+            batch = self._claim_batch(job_id)
+            if not batch:
+                break
+            results = list(executor.map(lambda r: (r.id, self._send(r.telegram_id, text)), batch))
+            self._record_batch(job_id, results)
+            if not self._renew_lease(job_id):
+                logging.warning(f"Broadcast job {job_id} was taken over by another engine")
+                return
+
+        with unit_of_work(write=True):
+            finished = db.session.execute(
+                update(BroadcastJob)
+                .where(BroadcastJob.id == job_id, BroadcastJob.owner == self.owner, BroadcastJob.status == 'running')
+                .values(status='done', finished_at=datetime.utcnow(), lease_until=None)
+            ).rowcount
+            job = db.session.get(BroadcastJob, job_id)
+            sent, failed = job.sent, job.failed
+        if not finished:
+            return
+        logging.info(f"Broadcast job {job_id} finished: {sent} sent, {failed} failed")
+
+        if created_by:
+            try:
+                self.bot.send_message(int(created_by), f"✅ Сообщение отправлено {sent} пользователям.")
+            except Exception as e:
+                logging.error(f"Failed to report broadcast {job_id} to {created_by}: {e}")
+
+    def _send(self, telegram_id, text):
+        """Send one message; returns None on success or the error text"""
+        for _ in range(BROADCAST_MAX_ATTEMPTS):
+            try:
+                with self.outbound.bulk():
+                    self.bot.send_message(int(telegram_id), text)
+                return None
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    # The outbound client already waited retry_after and ran out of retries
+                    logging.warning(f"Broadcast to {telegram_id} still rate limited, trying again")
+                    continue
+                return str(e.description)[:200]
+            except Exception as e:
+                logging.error(f"Failed to send message to {telegram_id}: {e}")
+                return str(e)[:200]
+        return "rate limited"
+
+    def _record_batch(self, job_id, results):
+        """Record the outcome of this engine's claimed rows; counters grow by the rows actually updated"""
+        now = datetime.utcnow()
+        sent_ids = [recipient_id for recipient_id, error in results if error is None]
+        failures = [(recipient_id, error) for recipient_id, error in results if error is not None]
+        mine = (BroadcastRecipient.status == 'sending', BroadcastRecipient.claimed_by == self.owner)
+        with unit_of_work(write=True):
+            sent = 0
+            if sent_ids:
+                sent = db.session.execute(
+                    update(BroadcastRecipient)
+                    .where(BroadcastRecipient.id.in_(sent_ids), *mine)
+                    .values(status='sent', sent_at=now)
+                ).rowcount
+            failed = 0
+            for recipient_id, error in failures:
+                failed += db.session.execute(
+                    update(BroadcastRecipient)
+                    .where(BroadcastRecipient.id == recipient_id, *mine)
+                    .values(status='failed', error=error)
+                ).rowcount
+            db.session.execute(
+                update(BroadcastJob)
+                .where(BroadcastJob.id == job_id)
+                .values(sent=BroadcastJob.sent + sent, failed=BroadcastJob.failed + failed)
+            )
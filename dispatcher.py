@@ -0,0 +1,225 @@
+import os
+import time
+import logging
+import threading
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import telebot
+from telebot.apihelper import ApiTelegramException
+from render_cache import RenderCache, render_fingerprint
+
+# Threads running bot handlers
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "16"))
+
+# Latency samples kept per handler for the metrics snapshot
+LATENCY_SAMPLES = 1000
+
+# The first tap on a message is handled at once; a further tap on it within this many
+# seconds is held this long, and taps arriving meanwhile replace it, so the rest of a
+# burst collapses into its last tap
+TAP_DEBOUNCE = float(os.getenv("TAP_DEBOUNCE", "0.3"))
+
+def update_chat_id(update):
+    """Chat an update belongs to; updates of one chat are handled in order"""
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return None
+
+def tapped_message_id(update):
+    """Message a callback button belongs to, or None for other updates"""
+    if update.callback_query and update.callback_query.message:
+        return update.callback_query.message.message_id
+    return None
+
+def update_label(update):
+    """Handler name used for latency metrics"""
+    if update.message:
+        text = update.message.text or ""
+        if text.startswith("/"):
+            return "command:" + text.split()[0].split("@")[0]
+        return update.message.content_type
+    if update.callback_query:
+        data = update.callback_query.data or ""
+        return "callback:" + data.split("_")[0]
+    return "other"
+
+class UpdateDispatcher:
+    """Runs updates on a thread pool with one serial queue per chat.
+
+    Different chats are handled concurrently, while updates of the same
+    chat keep their arrival order. A queued button tap is replaced by a newer
+    tap on the same message; the replaced update goes to on_superseded.
+    A held tap is resumed by a timer, so no worker thread waits for it.
+    """
+
+    def __init__(self, handler, workers=DISPATCH_WORKERS, on_superseded=None, debounce=TAP_DEBOUNCE):
+        self.handler = handler
+        self.on_superseded = on_superseded
+        self.debounce = debounce
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dispatch")
+        self.queues = {}
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.coalesced = 0
+        # chat_id -> (message_id, monotonic time) of the latest tap
+        self.last_tap = {}
+        self.latencies = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+        self.counts = defaultdict(int)
+
+    def submit(self, update):
+        chat_id = update_chat_id(update)
+        message_id = tapped_message_id(update)
+        now = time.monotonic()
+        not_before = 0
+        superseded = None
+        with self.lock:
+            if message_id is not None:
+                last = self.last_tap.get(chat_id)
+                if last and last[0] == message_id and now - last[1] < self.debounce:
+                    not_before = now + self.debounce
+                if len(self.last_tap) > 10000:
+                    self.last_tap.clear()
+                self.last_tap[chat_id] = (message_id, now)
+
+            chat_queue = self.queues.get(chat_id)
+            if chat_queue is not None:
+                if message_id is not None:
+                    for index, (queued, _) in enumerate(chat_queue):
+                        if tapped_message_id(queued) == message_id:
+                            superseded = queued
+                            del chat_queue[index]
+                            self.pending -= 1
+                            self.coalesced += 1
+                            break
+                # A drain for this chat is already scheduled and will pick it up
+                chat_queue.append((update, not_before))
+                self.pending += 1
+            else:
+                self.queues[chat_id] = deque([(update, not_before)])
+                self.pending += 1
+                self.executor.submit(self._drain, chat_id)
+        if superseded is not None and self.on_superseded:
+            self.executor.submit(self.on_superseded, superseded)
+
+    def _drain(self, chat_id):
+        while True:
+            with self.lock:
+                chat_queue = self.queues[chat_id]
+                if not chat_queue:
+                    del self.queues[chat_id]
+                    return
+                update, not_before = chat_queue[0]
+                wait = not_before - time.monotonic()
+                if wait <= 0:
+                    chat_queue.popleft()
+                    self.pending -= 1
+            if wait > 0:
+                # The queue stays registered, so new updates for the chat wait for this timer
+                timer = threading.Timer(wait, self.executor.submit, (self._drain, chat_id))
+                timer.daemon = True
+                timer.start()
+                return
+            self._run(update)
+
+    def _run(self, update):
+        label = update_label(update)
+        start = time.perf_counter()
+        try:
+            self.handler(update)
+        except Exception as e:
+            logging.error(f"Error handling update {update.update_id} ({label}): {e}")
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self.lock:
+                self.latencies[label].append(elapsed_ms)
+                self.counts[label] += 1
+
+    def metrics(self):
+        """Queue depth and per-handler latency (ms) snapshot"""
+        with self.lock:
+            handlers = {}
+            for label, samples in self.latencies.items():
+                ordered = sorted(samples)
+                handlers[label] = {
+                    "count": self.counts[label],
+                    "avg_ms": round(sum(ordered) / len(ordered), 2),
+                    "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2),
+                    "max_ms": round(ordered[-1], 2),
+                }
+            return {
+                "queue_depth": self.pending,
+                "active_chats": len(self.queues),
+                "coalesced_taps": self.coalesced,
+                "handlers": handlers,
+            }
+
+class DispatchingTeleBot(telebot.TeleBot):
+    """TeleBot that hands polled and webhook updates to an UpdateDispatcher.
+
+    Edits that would not change the tapped message, as the callback update
+    shows it, are skipped using a RenderCache.
+    With an outbound client, callback answers are sent in the background.
+    """
+
+    def __init__(self, token, workers=DISPATCH_WORKERS, outbound=None, **kwargs):
+        # Handlers run inline on the dispatcher threads
+        super().__init__(token, threaded=False, **kwargs)
+        self.dispatcher = UpdateDispatcher(self._process_update, workers, on_superseded=self._answer_superseded)
+        self.render_cache = RenderCache()
+        self.outbound = outbound
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            # Polling asks for updates after last_update_id; advancing it only once a
+            # worker ran the update would fetch queued or debounced updates again
+            self.last_update_id = max(self.last_update_id, update.update_id)
+            self.dispatcher.submit(update)
+
+    def _process_update(self, update):
+        message = update.callback_query.message if update.callback_query else None
+        if message is None:
+            super().process_new_updates([update])
+            return
+        self.render_cache.track(message)
+        try:
+            super().process_new_updates([update])
+        finally:
+            self.render_cache.clear()
+
+    def _answer_superseded(self, update):
+        """Stop the button spinner for a tap that was replaced by a newer one"""
+        try:
+            self.answer_callback_query(update.callback_query.id)
+        except Exception as e:
+            logging.error(f"Error answering superseded callback {update.callback_query.id}: {e}")
+
+    def answer_callback_query(self, callback_query_id, *args, **kwargs):
+        """Fire-and-forget when an outbound client is set; the handler does not wait for Telegram"""
+        if self.outbound is None:
+            return super().answer_callback_query(callback_query_id, *args, **kwargs)
+        self.outbound.fire_and_forget(super().answer_callback_query, callback_query_id, *args, **kwargs)
+        return True
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        """edit_message_text that skips the API call when the message already shows this content"""
+        if chat_id is None or message_id is None:
+            return super().edit_message_text(text, chat_id, message_id, **kwargs)
+
+        key = (str(chat_id), message_id)
+        fingerprint = render_fingerprint(text, **kwargs)
+        if self.render_cache.is_current(key, fingerprint):
+            return None
+        try:
+            result = super().edit_message_text(text, chat_id, message_id, **kwargs)
+        except ApiTelegramException as e:
+            if "message is not modified" in str(e.description):
+                self.render_cache.remember(key, fingerprint, not_modified=True)
+                return None
+            self.render_cache.forget(key)
+            raise
+        self.render_cache.remember(key, fingerprint)
+        return result
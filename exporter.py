@@ -0,0 +1,80 @@
+import io
+import csv
+import tempfile
+from sqlalchemy import select, exists
+from app import db
+from models import User, Registration
+
+EXPORT_COLUMNS = ['telegram_id', 'username', 'first_name', 'last_name', 'activity', 'day', 'time_slot', 'registered_at']
+
+# Rows fetched per round-trip and written per CSV chunk / Parquet row group
+EXPORT_BATCH_SIZE = 2000
+
+# Exports larger than this spill from memory to a temporary file
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+def has_registrations():
+    return db.session.scalar(select(exists().where(Registration.id.isnot(None))))
+
+def iter_registration_rows(batch_size=EXPORT_BATCH_SIZE):
+    """Stream (registration, user) columns as tuples without building ORM objects"""
+    stmt = (
+        select(
+            User.telegram_id, User.username, User.first_name, User.last_name,
+            Registration.activity_type, Registration.day, Registration.time_slot, Registration.created_at
+        )
+        .join(User, Registration.user_id == User.id)
+        .order_by(Registration.id)
+        .execution_options(yield_per=batch_size)
+    )
+    for row in db.session.execute(stmt):
+        registered_at = row.created_at.strftime('%Y-%m-%d %H:%M:%S') if row.created_at else None
+        yield tuple(row[:-1]) + (registered_at,)
+
+def iter_csv(batch_size=EXPORT_BATCH_SIZE):
+    """Yield the CSV export as UTF-8 chunks of batch_size rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(EXPORT_COLUMNS)
+    for count, row in enumerate(iter_registration_rows(batch_size), 1):
+        writer.writerow(row)
+        if count % batch_size == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+def write_parquet(fileobj, batch_size=EXPORT_BATCH_SIZE):
+    """Write the export as Parquet, one row group per batch (needs pyarrow)"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export requires the pyarrow package (install the parquet extra)")
+
+    schema = pa.schema([(name, pa.string()) for name in EXPORT_COLUMNS])
+    with pq.ParquetWriter(fileobj, schema) as writer:
+        batch = []
+        for row in iter_registration_rows(batch_size):
+            batch.append(row)
+            if len(batch) == batch_size:
+                writer.write_table(pa.Table.from_pylist([dict(zip(EXPORT_COLUMNS, r)) for r in batch], schema))
+                batch = []
+        if batch:
+            writer.write_table(pa.Table.from_pylist([dict(zip(EXPORT_COLUMNS, r)) for r in batch], schema))
+
+def export_to_file(fmt='csv'):
+    """Export into a spooled temp file (kept in memory while small); caller closes it"""
+    spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    if fmt == 'parquet':
+        write_parquet(spooled)
+    else:
+        for chunk in iter_csv():
+            spooled.write(chunk)
+    spooled.seek(0)
+    return spooled
@@ -0,0 +1,124 @@
+import os
+import time
+import bisect
+import threading
+from sqlalchemy import select, func
+from app import db
+from models import User, QuestProgress, QuestStepCompletion
+
+# Seconds before the ranking is reloaded from the database, picking up quests
+# completed in other processes
+LEADERBOARD_TTL = float(os.getenv("LEADERBOARD_TTL", "30"))
+
+class QuestLeaderboard:
+    """In-memory quest ranking by duration from first step to completion.
+
+    Entries are kept sorted by (seconds, completed_at, user_id) so top-N and
+    rank lookups need no query; the list is updated as this process completes
+    quests and rebuilt from the database every ttl seconds.
+    """
+
+    def __init__(self, ttl=LEADERBOARD_TTL):
+        self.ttl = ttl
+        self.keys = []
+        self.entries = {}
+        self.expires_at = 0
+        self.lock = threading.Lock()
+        self.reload_lock = threading.Lock()
+
+    def _first_step_times(self, progress_filter=None):
+        stmt = select(QuestStepCompletion.quest_progress_id, func.min(QuestStepCompletion.completed_at)) \
+            .group_by(QuestStepCompletion.quest_progress_id)
+        if progress_filter is not None:
+            stmt = stmt.where(progress_filter)
+        return dict(db.session.execute(stmt).all())
+
+    def rebuild(self):
+        """Load every completed quest; must be called in an app context"""
+        first_steps = self._first_step_times()
+        rows = db.session.execute(
+            select(QuestProgress.id, QuestProgress.user_id, QuestProgress.created_at, QuestProgress.completed_at,
+                   User.telegram_id, User.username, User.first_name)
+            .join(User, QuestProgress.user_id == User.id)
+            .where(QuestProgress.completed == True)
+        ).all()
+        with self.lock:
+            self.keys = []
+            self.entries = {}
+            for row in rows:
+                self._insert(row, first_steps.get(row.id))
+            self.keys.sort()
+            self.expires_at = time.monotonic() + self.ttl
+
+    def _insert(self, row, first_step_at):
+        started_at = first_step_at or row.created_at
+        completed_at = row.completed_at or started_at
+        seconds = max((completed_at - started_at).total_seconds(), 0) if started_at else 0
+        key = (seconds, completed_at, row.user_id)
+        self.entries[row.user_id] = {
+            "key": key,
+            "telegram_id": row.telegram_id,
+            "username": row.username or row.first_name,
+            "completed_at": completed_at,
+            "total_time": seconds,
+        }
+        self.keys.append(key)
+
+    def _ensure_loaded(self):
+        if time.monotonic() < self.expires_at:
+            return
+        # One thread reloads; the others wait for it instead of querying too
+        with self.reload_lock:
+            if time.monotonic() >= self.expires_at:
+                self.rebuild()
+
+    def record(self, quest_progress):
+        """Add a just-completed quest; must be called in an app context"""
+        self._ensure_loaded()
+        first_step_at = self._first_step_times(QuestStepCompletion.quest_progress_id == quest_progress.id).get(quest_progress.id)
+        row = db.session.execute(
+            select(QuestProgress.id, QuestProgress.user_id, QuestProgress.created_at, QuestProgress.completed_at,
+                   User.telegram_id, User.username, User.first_name)
+            .join(User, QuestProgress.user_id == User.id)
+            .where(QuestProgress.id == quest_progress.id)
+        ).one()
+        with self.lock:
+            self._remove(row.user_id)
+            self._insert(row, first_step_at)
+            key = self.keys.pop()
+            bisect.insort(self.keys, key)
+
+    def _remove(self, user_id):
+        entry = self.entries.pop(user_id, None)
+        if entry:
+            index = bisect.bisect_left(self.keys, entry["key"])
+            del self.keys[index]
+
+    def remove(self, user_id):
+        with self.lock:
+            self._remove(user_id)
+
+    def top(self, limit=10):
+        """[{rank, username, completed_at, total_time}] for the fastest finishers"""
+        self._ensure_loaded()
+        with self.lock:
+            return [
+                {"rank": rank, **{k: v for k, v in self.entries[key[2]].items() if k != "key"}}
+                for rank, key in enumerate(self.keys[:limit], 1)
+            ]
+
+    def rank(self, user_id):
+        """(rank, total_finishers) for a user, or (None, total) if they have not finished"""
+        self._ensure_loaded()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if not entry:
+                return None, len(self.keys)
+            return bisect.bisect_left(self.keys, entry["key"]) + 1, len(self.keys)
+
+leaderboard = QuestLeaderboard()
+
+def format_duration(seconds):
+    """Render seconds as H:MM:SS"""
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
@@ -1,7 +1,8 @@
 import logging
 import threading
 from app import app
-from bot import start_bot
+from bot import start_bot, BOT_MODE
+import webhook_routes
 
 if __name__ == "__main__":
     # Start the Telegram bot in a separate thread
@@ -9,7 +10,7 @@ if __name__ == "__main__":
     bot_thread.start()
     
     logging.info("Starting Flask application on port 5000")
-    logging.info("Starting Telegram bot in background thread")
+    logging.info(f"Starting Telegram bot ({BOT_MODE} mode) in background thread")
     
     # Start Flask app
     app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=False)
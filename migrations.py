@@ -0,0 +1,130 @@
+import json
+import logging
+from datetime import datetime
+from sqlalchemy import inspect, text, select, insert, update, BigInteger
+
+def add_column_if_missing(db, table, column, ddl):
+    """ALTER TABLE ... ADD COLUMN unless the column already exists"""
+    columns = {c["name"] for c in inspect(db.engine).get_columns(table)}
+    if column in columns:
+        return False
+    with db.engine.begin() as conn:
+        conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl}'))
+    logging.info(f"Migration: added {table}.{column}")
+    return True
+
+def widen_column_to_bigint(db, table, column):
+    """ALTER COLUMN ... TYPE BIGINT on PostgreSQL; SQLite integers are already 64-bit"""
+    if db.engine.dialect.name != 'postgresql':
+        return False
+    columns = {c["name"]: c["type"] for c in inspect(db.engine).get_columns(table)}
+    if column not in columns or isinstance(columns[column], BigInteger):
+        return False
+    with db.engine.begin() as conn:
+        conn.execute(text(f'ALTER TABLE "{table}" ALTER COLUMN {column} TYPE BIGINT'))
+    logging.info(f"Migration: widened {table}.{column} to BIGINT")
+    return True
+
+def remove_duplicate_registrations(db):
+    """Keep the first registration per (user, activity, day, slot) so the unique index can be built"""
+    with db.engine.begin() as conn:
+        result = conn.execute(text(
+            'DELETE FROM registration WHERE id NOT IN ('
+            'SELECT MIN(id) FROM registration GROUP BY user_id, activity_type, day, time_slot)'
+        ))
+    if result.rowcount:
+        logging.info(f"Migration: removed {result.rowcount} duplicate registrations")
+
+def create_missing_indexes(db):
+    """Create indexes declared on the models that older tables do not have yet"""
+    existing_tables = set(inspect(db.engine).get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {index["name"] for index in inspect(db.engine).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                if index.name == 'uq_registration_user_slot':
+                    remove_duplicate_registrations(db)
+                index.create(db.engine)
+                logging.info(f"Migration: created index {index.name}")
+
+def _parse_timestamp(value):
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+def migrate_quest_completed_steps(db):
+    """Copy the legacy completed_steps JSON into quest_step_completion rows.
+
+    Only progress rows with steps_completed = 0 are converted, so this is a no-op once done.
+    """
+    progress = db.metadata.tables['quest_progress']
+    completions = db.metadata.tables['quest_step_completion']
+    with db.engine.begin() as conn:
+        rows = conn.execute(
+            select(progress.c.id, progress.c.completed_steps)
+            .where(progress.c.steps_completed == 0, progress.c.completed_steps.isnot(None))
+        ).all()
+        converted = 0
+        for progress_id, completed_steps in rows:
+            try:
+                steps = json.loads(completed_steps or "[]")
+            except ValueError:
+                logging.warning(f"Migration: unreadable completed_steps on quest_progress {progress_id}")
+                continue
+            # Keep the first completion of each step; the unique index allows one
+            seen = {}
+            for entry in steps:
+                if isinstance(entry, dict) and entry.get("step") is not None and entry["step"] not in seen:
+                    seen[entry["step"]] = {
+                        "quest_progress_id": progress_id,
+                        "step": entry["step"],
+                        "action": entry.get("action"),
+                        "data": None if entry.get("data") is None else str(entry["data"]),
+                        "completed_at": _parse_timestamp(entry.get("completed_at")),
+                    }
+            if not seen:
+                continue
+            conn.execute(insert(completions), list(seen.values()))
+            conn.execute(update(progress).where(progress.c.id == progress_id).values(steps_completed=len(seen)))
+            converted += 1
+    if converted:
+        logging.info(f"Migration: converted completed_steps JSON for {converted} quest_progress rows")
+
+def backfill_quest_completed_mask(db):
+    """Set completed_mask from the step completions of progress rows that predate it"""
+    progress = db.metadata.tables['quest_progress']
+    completions = db.metadata.tables['quest_step_completion']
+    with db.engine.begin() as conn:
+        rows = conn.execute(
+            select(completions.c.quest_progress_id, completions.c.step)
+            .join(progress, completions.c.quest_progress_id == progress.c.id)
+            .where(progress.c.completed_mask == 0, progress.c.steps_completed > 0)
+        ).all()
+        masks = {}
+        for progress_id, step in rows:
+            masks[progress_id] = masks.get(progress_id, 0) | (1 << (step - 1))
+        for progress_id, mask in masks.items():
+            conn.execute(update(progress).where(progress.c.id == progress_id).values(completed_mask=mask))
+    if masks:
+        logging.info(f"Migration: backfilled completed_mask for {len(masks)} quest_progress rows")
+
+def run_migrations(db):
+    """Bring tables created by older versions up to date; safe to run on every start.
+
+    db.create_all() only creates missing tables, so new columns and indexes
+    on existing tables are added here.
+    """
+    add_column_if_missing(db, "sticker_generation", "output_mode", "VARCHAR(20)")
+    add_column_if_missing(db, "quest_progress", "steps_completed", "INTEGER NOT NULL DEFAULT 0")
+    migrate_quest_completed_steps(db)
+    add_column_if_missing(db, "quest_progress", "quest_id", "VARCHAR(16) NOT NULL DEFAULT 'main'")
+    add_column_if_missing(db, "quest_progress", "completed_mask", "BIGINT NOT NULL DEFAULT 0")
+    widen_column_to_bigint(db, "quest_progress", "completed_mask")
+    backfill_quest_completed_mask(db)
+    add_column_if_missing(db, "broadcast_job", "owner", "VARCHAR(64)")
+    add_column_if_missing(db, "broadcast_job", "lease_until", "TIMESTAMP")
+    add_column_if_missing(db, "broadcast_recipient", "claimed_by", "VARCHAR(64)")
+    create_missing_indexes(db)
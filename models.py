@@ -1,6 +1,6 @@
 from app import db
 from datetime import datetime
-from sqlalchemy import String, Integer, DateTime, Text, Boolean
+from sqlalchemy import String, Integer, BigInteger, DateTime, Text, Boolean
 
 class User(db.Model):
     id = db.Column(Integer, primary_key=True)
@@ -19,20 +19,63 @@ class User(db.Model):
 class Registration(db.Model):
     id = db.Column(Integer, primary_key=True)
     user_id = db.Column(Integer, db.ForeignKey('user.id'), nullable=False)
-    activity_type = db.Column(String(50), nullable=False)  # 'dance' or 'yoga'
+    activity_type = db.Column(String(50), nullable=False, index=True)  # 'dance' or 'yoga'
     time_slot = db.Column(String(10), nullable=False)  # '12:00', '14:00', etc.
     day = db.Column(String(20), nullable=False)  # 'day1', 'day2', 'day3'
     created_at = db.Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # One registration per user and slot; also serves lookups by user_id
+        db.Index('uq_registration_user_slot', 'user_id', 'activity_type', 'day', 'time_slot', unique=True),
+    )
 
 class QuestProgress(db.Model):
     id = db.Column(Integer, primary_key=True)
-    user_id = db.Column(Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    quest_id = db.Column(String(16), nullable=False, default='main', index=True)  # Variant from quests.json
     quest_step = db.Column(Integer, default=1)
-    completed_steps = db.Column(Text)  # JSON string of completed steps
+    completed_steps = db.Column(Text)  # Legacy JSON list, migrated into QuestStepCompletion
+    steps_completed = db.Column(Integer, nullable=False, default=0)  # Denormalized count of QuestStepCompletion rows
+    completed_mask = db.Column(BigInteger, nullable=False, default=0)  # Bit (step - 1) set per completed step, up to step 62
     photo_submissions = db.Column(Text)  # JSON string of photo file IDs
     completed = db.Column(Boolean, default=False)
     completed_at = db.Column(DateTime)
     created_at = db.Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_quest_progress_completed', 'completed', 'completed_at'),
+    )
+
+class QuestStepCompletion(db.Model):
+    id = db.Column(Integer, primary_key=True)
+    quest_progress_id = db.Column(Integer, db.ForeignKey('quest_progress.id'), nullable=False)
+    step = db.Column(Integer, nullable=False)
+    action = db.Column(String(20))
+    data = db.Column(Text)
+    completed_at = db.Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('uq_quest_step_completion_progress_step', 'quest_progress_id', 'step', unique=True),
+        db.Index('ix_quest_step_completion_step', 'step'),
+    )
+
+class QuestPhotoSubmission(db.Model):
+    id = db.Column(Integer, primary_key=True)
+    quest_progress_id = db.Column(Integer, db.ForeignKey('quest_progress.id'), nullable=False)
+    step = db.Column(Integer, nullable=False)
+    chat_id = db.Column(String(20), nullable=False)
+    photo_file_id = db.Column(String(200), nullable=False)
+    photo_unique_id = db.Column(String(100))
+    dhash = db.Column(String(16))  # 64-bit perceptual hash as hex
+    status = db.Column(String(20), nullable=False, default='pending')  # 'pending', 'approved', 'rejected', 'duplicate'
+    reviewed_by = db.Column(String(50))
+    created_at = db.Column(DateTime, default=datetime.utcnow)
+    reviewed_at = db.Column(DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_quest_photo_submission_progress_step', 'quest_progress_id', 'step', 'status'),
+        db.Index('ix_quest_photo_submission_status', 'status', 'id'),
+    )
 
 class StickerGeneration(db.Model):
     id = db.Column(Integer, primary_key=True)
@@ -40,7 +83,12 @@ class StickerGeneration(db.Model):
     template_used = db.Column(String(50), nullable=False)
     original_photo_file_id = db.Column(String(200))
     generated_sticker_file_id = db.Column(String(200))
+    output_mode = db.Column(String(20))  # sticker_generator output mode; 'tg_sticker' is sent with send_sticker
     created_at = db.Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_sticker_generation_user_created', 'user_id', 'created_at'),
+    )
 
 class AdminLog(db.Model):
     id = db.Column(Integer, primary_key=True)
@@ -49,3 +97,59 @@ class AdminLog(db.Model):
     target_user_id = db.Column(Integer)
     details = db.Column(Text)
     created_at = db.Column(DateTime, default=datetime.utcnow)
+
+class BroadcastJob(db.Model):
+    id = db.Column(Integer, primary_key=True)
+    message = db.Column(Text, nullable=False)
+    status = db.Column(String(20), default='pending', index=True)  # 'pending', 'running', 'done'
+    created_by = db.Column(String(20))  # admin telegram_id, or None for the web dashboard
+    owner = db.Column(String(64))  # engine sending the job while its lease lasts
+    lease_until = db.Column(DateTime)
+    total = db.Column(Integer, default=0)
+    sent = db.Column(Integer, default=0)
+    failed = db.Column(Integer, default=0)
+    created_at = db.Column(DateTime, default=datetime.utcnow)
+    finished_at = db.Column(DateTime)
+
+class BroadcastRecipient(db.Model):
+    id = db.Column(Integer, primary_key=True)
+    job_id = db.Column(Integer, db.ForeignKey('broadcast_job.id'), nullable=False)
+    telegram_id = db.Column(String(20), nullable=False)
+    status = db.Column(String(10), default='pending')  # 'pending', 'sending', 'sent', 'failed'
+    claimed_by = db.Column(String(64))  # engine that claimed the recipient for sending
+    error = db.Column(String(200))
+    sent_at = db.Column(DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_broadcast_recipient_job_status', 'job_id', 'status', 'id'),
+    )
+
+class SlotInventory(db.Model):
+    id = db.Column(Integer, primary_key=True)
+    activity_type = db.Column(String(50), nullable=False)
+    day = db.Column(String(20), nullable=False)
+    time_slot = db.Column(String(10), nullable=False)
+    capacity = db.Column(Integer, nullable=False)
+    taken = db.Column(Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        db.Index('uq_slot_inventory_slot', 'activity_type', 'day', 'time_slot', unique=True),
+    )
+
+class SlotWaitlist(db.Model):
+    id = db.Column(Integer, primary_key=True)
+    user_id = db.Column(Integer, db.ForeignKey('user.id'), nullable=False)
+    activity_type = db.Column(String(50), nullable=False)
+    day = db.Column(String(20), nullable=False)
+    time_slot = db.Column(String(10), nullable=False)
+    created_at = db.Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('uq_slot_waitlist_user_slot', 'user_id', 'activity_type', 'day', 'time_slot', unique=True),
+        db.Index('ix_slot_waitlist_slot', 'activity_type', 'day', 'time_slot', 'id'),
+    )
+
+class ConversationState(db.Model):
+    key = db.Column(String(64), primary_key=True)
+    value = db.Column(String(50), nullable=False)
+    expires_at = db.Column(DateTime, nullable=False, index=True)
@@ -0,0 +1,62 @@
+import os
+import hmac
+import logging
+import base64
+import hashlib
+
+# Key for QR payload signatures; required to print or accept codes. Rotating it
+# invalidates every printed code
+QUEST_QR_SECRET = os.getenv("QUEST_QR_SECRET")
+
+# Signature characters kept in the payload (12 bytes of HMAC-SHA256)
+SIGNATURE_LENGTH = 16
+
+# Telegram deep-link /start parameters: at most 64 characters of [A-Za-z0-9_-]
+PAYLOAD_PREFIX = "q"
+MAX_PAYLOAD_LENGTH = 64
+
+def _secret():
+    # Never fall back to the Flask secret key: its default is public in the repo
+    if not QUEST_QR_SECRET:
+        raise ValueError("QUEST_QR_SECRET is not set")
+    return QUEST_QR_SECRET
+
+def _signature(body):
+    digest = hmac.new(_secret().encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode("ascii")[:SIGNATURE_LENGTH]
+
+def sign_qr_payload(quest_id, step, day=None, user_id=None):
+    """Signed payload for one quest step, scoped to a festival day or to one user"""
+    if bool(day) == bool(user_id):
+        raise ValueError("QR payloads are scoped to exactly one of day or user_id")
+    scope = f"u{user_id}" if user_id else day
+    body = f"{PAYLOAD_PREFIX}_{quest_id}_{step}_{scope}"
+    payload = f"{body}_{_signature(body)}"
+    if len(payload) > MAX_PAYLOAD_LENGTH:
+        raise ValueError(f"QR payload is longer than {MAX_PAYLOAD_LENGTH} characters")
+    return payload
+
+def verify_qr_payload(payload):
+    """(quest_id, step, day, user_id) for a genuine payload, else None; no database lookup"""
+    if not payload or len(payload) > MAX_PAYLOAD_LENGTH:
+        return None
+    if not QUEST_QR_SECRET:
+        logging.error("QUEST_QR_SECRET is not set, rejecting quest QR code")
+        return None
+    # The signature alphabet includes "_", so split by its fixed length
+    body, separator, signature = payload[:-SIGNATURE_LENGTH - 1], payload[-SIGNATURE_LENGTH - 1:-SIGNATURE_LENGTH], payload[-SIGNATURE_LENGTH:]
+    if separator != "_":
+        return None
+    if not hmac.compare_digest(signature.encode("ascii", "replace"), _signature(body).encode("ascii")):
+        return None
+
+    parts = body.split("_")
+    if len(parts) != 4 or parts[0] != PAYLOAD_PREFIX or not parts[2].isdigit():
+        return None
+    _, quest_id, step, scope = parts
+    if scope.startswith("u") and scope[1:].isdigit():
+        return quest_id, int(step), None, int(scope[1:])
+    return quest_id, int(step), scope, None
+
+def is_qr_payload(text):
+    return bool(text) and text.startswith(PAYLOAD_PREFIX + "_")
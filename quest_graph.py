@@ -0,0 +1,185 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+from datetime import date
+
+# Quest definitions; edited in place and picked up without a restart
+QUESTS_FILE = os.getenv("QUESTS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "quests.json"))
+
+# Seconds between mtime checks of QUESTS_FILE
+QUESTS_RELOAD_INTERVAL = float(os.getenv("QUESTS_RELOAD_INTERVAL", "2"))
+
+# Step numbers become bits of QuestProgress.completed_mask
+MAX_STEP = 62
+
+QUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9-]{1,16}$')
+ACTIONS = ("qr", "photo")
+
+class QuestConfigError(ValueError):
+    pass
+
+class QuestStep:
+    """One compiled step: prerequisites are bitmasks over step numbers"""
+
+    def __init__(self, number, description, action, after, after_any, final):
+        self.number = number
+        self.bit = 1 << (number - 1)
+        self.description = description
+        self.action = action
+        self.after = after
+        self.after_any = after_any
+        self.final = final
+        self.all_mask = sum(1 << (n - 1) for n in after)
+        self.any_mask = sum(1 << (n - 1) for n in after_any)
+
+    def is_available(self, completed_mask):
+        if completed_mask & self.bit:
+            return False
+        if completed_mask & self.all_mask != self.all_mask:
+            return False
+        return not self.any_mask or bool(completed_mask & self.any_mask)
+
+class QuestGraph:
+    """A quest variant compiled from its definition"""
+
+    def __init__(self, quest_id, title, days, steps):
+        self.quest_id = quest_id
+        self.title = title
+        self.days = days
+        self.steps = steps
+        self.ordered = [steps[n] for n in sorted(steps)]
+
+    def available(self, completed_mask):
+        """Steps that can be completed next, in step order"""
+        return [step for step in self.ordered if step.is_available(completed_mask)]
+
+    def get_step(self, number):
+        return self.steps.get(number)
+
+def compile_quest(quest_id, definition):
+    """Validate one quest definition and build its QuestGraph"""
+    if not QUEST_ID_PATTERN.match(quest_id):
+        raise QuestConfigError(f"Quest id {quest_id!r} must be 1-16 characters of A-Z, a-z, 0-9 or '-'")
+
+    raw_steps = definition.get("steps") or {}
+    numbers = set()
+    for key in raw_steps:
+        if not str(key).isdigit() or not 1 <= int(key) <= MAX_STEP:
+            raise QuestConfigError(f"{quest_id}: step ids must be integers 1..{MAX_STEP}, got {key!r}")
+        numbers.add(int(key))
+
+    steps = {}
+    for key, raw in raw_steps.items():
+        number = int(key)
+        action = raw.get("action")
+        if action not in ACTIONS:
+            raise QuestConfigError(f"{quest_id}/{number}: action must be one of {ACTIONS}")
+        after = [int(n) for n in raw.get("after", [])]
+        after_any = [int(n) for n in raw.get("after_any", [])]
+        unknown = set(after + after_any) - numbers
+        if unknown:
+            raise QuestConfigError(f"{quest_id}/{number}: unknown prerequisite steps {sorted(unknown)}")
+        steps[number] = QuestStep(number, raw.get("description", ""), action, after, after_any, bool(raw.get("final")))
+
+    if not any(step.final for step in steps.values()):
+        raise QuestConfigError(f"{quest_id}: no final step")
+
+    # Every step must be reachable from the start; this also rejects cycles
+    mask = 0
+    while True:
+        ready = [step for step in steps.values() if step.is_available(mask)]
+        if not ready:
+            break
+        for step in ready:
+            mask |= step.bit
+    unreachable = sorted(n for n, step in steps.items() if not mask & step.bit)
+    if unreachable:
+        raise QuestConfigError(f"{quest_id}: steps {unreachable} can never become available")
+
+    return QuestGraph(quest_id, definition.get("title", quest_id), definition.get("days", []), steps)
+
+class QuestCatalog:
+    """Compiled quests from QUESTS_FILE, recompiled when the file changes.
+
+    A definition that fails to compile is logged and the previous catalog is kept.
+    """
+
+    def __init__(self, path=QUESTS_FILE, reload_interval=QUESTS_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.quests = {}
+        self.default_quest = None
+        self.day_dates = {}
+        self.mtime = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+
+    def _load(self):
+        with open(self.path, encoding="utf-8") as f:
+            config = json.load(f)
+        quests = {quest_id: compile_quest(quest_id, definition)
+                  for quest_id, definition in config.get("quests", {}).items()}
+        default_quest = config.get("default_quest")
+        if default_quest not in quests:
+            raise QuestConfigError(f"default_quest {default_quest!r} is not defined")
+        day_dates = {day: date.fromisoformat(value) for day, value in config.get("days", {}).items() if value}
+        return quests, default_quest, day_dates
+
+    def refresh(self):
+        """Recompile if the file changed since the last check"""
+        now = time.monotonic()
+        if self.quests and now - self.checked_at < self.reload_interval:
+            return
+        with self.lock:
+            if self.quests and now - self.checked_at < self.reload_interval:
+                return
+            self.checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime == self.mtime:
+                    return
+                self.quests, self.default_quest, self.day_dates = self._load()
+                self.mtime = mtime
+                logging.info(f"Loaded {len(self.quests)} quests from {self.path}")
+            except (OSError, ValueError) as e:
+                if not self.quests:
+                    raise
+                logging.error(f"Keeping previous quest definitions, reload failed: {e}")
+
+    def get(self, quest_id):
+        """Compiled quest, falling back to the default for unknown ids"""
+        self.refresh()
+        return self.quests.get(quest_id) or self.quests[self.default_quest]
+
+    def current_day(self, today=None):
+        """Festival day id for today's date, or None if dates are not configured"""
+        self.refresh()
+        today = today or date.today()
+        for day, day_date in self.day_dates.items():
+            if day_date == today:
+                return day
+        return None
+
+    def check_day_dates(self):
+        """Raise QuestConfigError when a quest runs on festival days that have no date.
+
+        Day-scoped QR codes are only accepted on their day, so without dates
+        every printed location code would be refused.
+        """
+        self.refresh()
+        undated = sorted({day for quest in self.quests.values() for day in quest.days if day not in self.day_dates})
+        if undated:
+            raise QuestConfigError(f"{self.path}: days {', '.join(undated)} have no date; set the festival dates "
+                                   "so day-scoped quest QR codes can be accepted")
+
+    def quest_for_today(self):
+        """Quest variant new players get today"""
+        day = self.current_day()
+        if day:
+            for quest in self.quests.values():
+                if day in quest.days:
+                    return quest
+        return self.quests[self.default_quest]
@@ -1,160 +1,201 @@
-import json
 import logging
+import statistics
 from datetime import datetime
+from quest_graph import QuestCatalog
+from quest_codes import verify_qr_payload
 
 class QuestManager:
-    def __init__(self):
-        self.quest_steps = {
-            1: {
-                "description": "🏮 Найдите маяк на территории фестиваля и отсканируйте QR-код, расположенный у его основания.",
-                "requires_qr": True,
-                "requires_photo": False,
-                "next_step": 2
-            },
-            2: {
-                "description": "📸 Отлично! Теперь сделайте селфи рядом с маяком и загрузите фото.",
-                "requires_qr": False,
-                "requires_photo": True,
-                "next_step": 3
-            },
-            3: {
-                "description": "🎵 Найдите главную сцену и сфотографируйте табличку с названиями выступающих артистов.",
-                "requires_qr": False,
-                "requires_photo": True,
-                "next_step": 4
-            },
-            4: {
-                "description": "🍽️ Посетите фуд-корт и найдите стенд с логотипом Avito. Сфотографируйте его.",
-                "requires_qr": False,
-                "requires_photo": True,
-                "next_step": 5
-            },
-            5: {
-                "description": "💃 Последнее задание! Найдите танцевальную площадку и отсканируйте финальный QR-код.",
-                "requires_qr": True,
-                "requires_photo": False,
-                "next_step": "complete"
-            }
-        }
-    
-    def get_quest_step(self, step_number):
+    def __init__(self, catalog=None):
+        # Quest variants are compiled from quests.json and reloaded when it changes
+        self.catalog = catalog or QuestCatalog()
+
+    def get_quest(self, quest_id=None):
+        """Compiled quest graph for a variant (the default one if unknown)"""
+        return self.catalog.get(quest_id)
+
+    def quest_for_today(self):
+        """Quest variant assigned to players starting today"""
+        self.catalog.refresh()
+        return self.catalog.quest_for_today()
+
+    def get_quest_step(self, step_number, quest_id=None):
         """Get quest step information"""
-        if step_number in self.quest_steps:
-            return self.quest_steps[step_number]
-        return None
-    
-    def validate_qr_code(self, qr_data, current_step):
-        """Validate QR code for current step"""
-        expected_codes = {
-            1: "LIGHTHOUSE_QUEST_START",
-            5: "DANCE_FLOOR_QUEST_END"
-        }
-        
-        return qr_data == expected_codes.get(current_step, "")
-    
-    def process_photo_submission(self, user_id, step_number, photo_file_id):
-        """Process photo submission for quest step"""
-        # In a real implementation, this might involve:
-        # - AI-powered image recognition to verify the photo content
-        # - Manual review queue for admin approval
-        # - Automatic approval for demo purposes
-        
-        valid_photo_steps = [2, 3, 4]
-        
-        if step_number in valid_photo_steps:
-            logging.info(f"Photo submitted for user {user_id}, step {step_number}: {photo_file_id}")
-            return True
-        
-        return False
-    
-    def advance_quest_step(self, quest_progress, action_type, data=None):
-        """Advance user's quest progress"""
+        return self.get_quest(quest_id).get_step(step_number)
+
+    def available_steps(self, quest_progress):
+        """Steps the user can complete next; several when the quest has parallel branches"""
+        if quest_progress.completed:
+            return []
+        return self.get_quest(quest_progress.quest_id).available(quest_progress.completed_mask or 0)
+
+    def validate_qr_code(self, qr_data, quest_progress):
+        """Verify a signed QR payload; returns the step number it unlocks or None.
+
+        The signature is checked in constant time without touching the database.
+        Day-scoped codes only work on that festival day (never when quests.json
+        has no dates), user-scoped codes only for that user.
+        """
+        verified = verify_qr_payload(qr_data)
+        if not verified:
+            return None
+        quest_id, step, day, user_id = verified
+
+        if quest_id != self.get_quest(quest_progress.quest_id).quest_id:
+            return None
+        if user_id is not None and user_id != quest_progress.user_id:
+            return None
+        if day is not None:
+            # Without configured festival dates no day can be checked, so day codes are refused
+            if day != self.catalog.current_day():
+                return None
+        return step
+
+    def photo_steps(self, quest_progress):
+        """Available steps that are completed with a photo; several when they run in parallel"""
+        return [step for step in self.available_steps(quest_progress) if step.action == "photo"]
+
+    def advance_quest_step(self, quest_progress, action_type, data=None, step_number=None):
+        """Advance user's quest progress.
+
+        Photos must already be verified (see quest_photos); step_number is the
+        step the photo was submitted for. Runs in the caller's write unit of
+        work and locks the progress row until it commits.
+        """
         from app import db
-        from models import QuestProgress
-        
-        current_step = quest_progress.quest_step
-        step_info = self.get_quest_step(current_step)
-        
-        if not step_info:
-            return False, "Invalid quest step"
-        
+        from models import QuestStepCompletion
+        from unit_of_work import on_commit
+
+        # Re-read the row under FOR UPDATE so parallel verdicts cannot both rewrite the mask
+        # from a stale copy (SQLite write units are already serialised by BEGIN IMMEDIATE)
+        db.session.refresh(quest_progress, with_for_update=True)
+        available = self.available_steps(quest_progress)
+        if not available:
+            return False, "Quest already completed" if quest_progress.completed else "Invalid quest step"
+
         # Validate action
-        if action_type == "qr" and step_info["requires_qr"]:
-            if not self.validate_qr_code(data, current_step):
+        if action_type == "qr":
+            step_number = self.validate_qr_code(data, quest_progress)
+            if step_number is None:
                 return False, "Invalid QR code"
-        elif action_type == "photo" and step_info["requires_photo"]:
-            if not self.process_photo_submission(quest_progress.user_id, current_step, data):
-                return False, "Photo validation failed"
+            step_info = next((step for step in available if step.number == step_number and step.action == "qr"), None)
+            if not step_info:
+                return False, "Invalid action for this step"
+        elif action_type == "photo":
+            step_info = next((step for step in available if step.action == "photo"
+                              and step_number in (None, step.number)), None)
+            if not step_info:
+                return False, "Invalid action for this step"
         else:
             return False, "Invalid action for this step"
-        
-        # Update progress
-        completed_steps = json.loads(quest_progress.completed_steps or "[]")
-        completed_steps.append({
-            "step": current_step,
-            "action": action_type,
-            "data": data,
-            "completed_at": datetime.utcnow().isoformat()
-        })
-        
-        quest_progress.completed_steps = json.dumps(completed_steps)
-        
-        # Advance to next step
-        if step_info["next_step"] == "complete":
-            quest_progress.completed = True
-            quest_progress.completed_at = datetime.utcnow()
-            quest_progress.quest_step = current_step  # Keep at final step
-        else:
-            quest_progress.quest_step = step_info["next_step"]
-        
+
         try:
-            db.session.commit()
-            return True, "Quest step completed successfully"
+            # Append the completion; the unique (progress, step) index rejects a double advance
+            with db.session.begin_nested():
+                db.session.add(QuestStepCompletion(
+                    quest_progress_id=quest_progress.id,
+                    step=step_info.number,
+                    action=action_type,
+                    data=None if data is None else str(data),
+                    completed_at=datetime.utcnow()
+                ))
+                quest_progress.steps_completed = (quest_progress.steps_completed or 0) + 1
+                quest_progress.completed_mask = (quest_progress.completed_mask or 0) | step_info.bit
+
+                # Advance to next step
+                if step_info.final:
+                    quest_progress.completed = True
+                    quest_progress.completed_at = datetime.utcnow()
+                    quest_progress.quest_step = step_info.number  # Keep at final step
+                else:
+                    next_steps = self.get_quest(quest_progress.quest_id).available(quest_progress.completed_mask)
+                    quest_progress.quest_step = next_steps[0].number if next_steps else step_info.number
         except Exception as e:
-            db.session.rollback()
             logging.error(f"Error updating quest progress: {e}")
             return False, "Database error"
-    
+
+        if quest_progress.completed:
+            from leaderboard import leaderboard
+            on_commit(lambda: leaderboard.record(quest_progress))
+        return True, "Quest step completed successfully"
+
     def get_quest_summary(self, quest_progress):
         """Get summary of user's quest progress"""
         if not quest_progress:
             return {
                 "current_step": 1,
-                "total_steps": len(self.quest_steps),
+                "total_steps": len(self.quest_for_today().steps),
                 "completed_steps": 0,
                 "is_completed": False,
                 "completion_code": None
             }
-        
-        completed_steps = json.loads(quest_progress.completed_steps or "[]")
-        
+
         summary = {
             "current_step": quest_progress.quest_step,
-            "total_steps": len(self.quest_steps),
-            "completed_steps": len(completed_steps),
+            "total_steps": len(self.get_quest(quest_progress.quest_id).steps),
+            "completed_steps": quest_progress.steps_completed or 0,
             "is_completed": quest_progress.completed,
             "completion_code": "QUEST_COMPLETE_2024" if quest_progress.completed else None
         }
-        
+
         return summary
-    
+
     def get_leaderboard(self, limit=10):
-        """Get quest completion leaderboard"""
-        from models import QuestProgress, User
+        """Get quest leaderboard, fastest first-step-to-completion time first"""
+        from leaderboard import leaderboard
+
+        return leaderboard.top(limit)
+
+    def get_step_analytics(self, quest_id=None):
+        """Per-step reach, drop-off and median seconds spent on the step for one quest variant"""
+        from models import QuestProgress, QuestStepCompletion
         from app import db
-        
-        # Get users who completed the quest, ordered by completion time
-        completed_quests = db.session.query(QuestProgress, User).join(User).filter(
-            QuestProgress.completed == True
-        ).order_by(QuestProgress.completed_at.asc()).limit(limit).all()
-        
-        leaderboard = []
-        for quest, user in completed_quests:
-            leaderboard.append({
-                "rank": len(leaderboard) + 1,
-                "username": user.username or user.first_name,
-                "completed_at": quest.completed_at,
-                "total_time": None  # Could calculate from first step to completion
+        from sqlalchemy import select, func
+
+        quest = self.get_quest(quest_id)
+        started = db.session.scalar(
+            select(func.count()).select_from(QuestProgress).where(QuestProgress.quest_id == quest.quest_id)
+        )
+        reached = dict(db.session.execute(
+            select(QuestStepCompletion.step, func.count())
+            .join(QuestProgress, QuestStepCompletion.quest_progress_id == QuestProgress.id)
+            .where(QuestProgress.quest_id == quest.quest_id)
+            .group_by(QuestStepCompletion.step)
+        ).all())
+
+        # Time on a step runs from the previous completion (or quest start) to this one
+        durations = {}
+        previous_id, previous_at = None, None
+        rows = db.session.execute(
+            select(QuestStepCompletion.quest_progress_id, QuestStepCompletion.step,
+                   QuestStepCompletion.completed_at, QuestProgress.created_at)
+            .join(QuestProgress, QuestStepCompletion.quest_progress_id == QuestProgress.id)
+            .where(QuestProgress.quest_id == quest.quest_id)
+            .order_by(QuestStepCompletion.quest_progress_id, QuestStepCompletion.completed_at)
+        )
+        for progress_id, step, completed_at, started_at in rows:
+            if progress_id != previous_id:
+                previous_id, previous_at = progress_id, started_at
+            if completed_at and previous_at:
+                durations.setdefault(step, []).append((completed_at - previous_at).total_seconds())
+            previous_at = completed_at
+
+        # A step is entered once its prerequisites are done: all of "after", any of "after_any"
+        analytics = []
+        for step in quest.ordered:
+            entered = started
+            if step.after:
+                entered = min(reached.get(n, 0) for n in step.after)
+            if step.after_any:
+                entered = min(entered, sum(reached.get(n, 0) for n in step.after_any))
+            completed = reached.get(step.number, 0)
+            analytics.append({
+                "step": step.number,
+                "entered": entered,
+                "completed": completed,
+                "drop_off": max(entered - completed, 0),
+                "median_seconds": statistics.median(durations[step.number]) if step.number in durations else None
             })
-        
-        return leaderboard
+
+        return analytics
+
+quest_manager = QuestManager()
@@ -0,0 +1,291 @@
+import io
+import os
+import time
+import queue
+import logging
+import threading
+from datetime import datetime
+from PIL import Image
+from sqlalchemy import select, update, text
+from app import app, db
+from models import QuestProgress, QuestPhotoSubmission
+from quest_manager import quest_manager
+from unit_of_work import unit_of_work
+
+# Maximum number of quest photos waiting to be hashed
+QUEST_PHOTO_QUEUE_SIZE = int(os.getenv("QUEST_PHOTO_QUEUE_SIZE", "500"))
+
+# Threads downloading and hashing quest photos
+QUEST_PHOTO_WORKERS = int(os.getenv("QUEST_PHOTO_WORKERS", "4"))
+
+# Photos handed to the verifier at once, and how long to wait for a batch to fill
+QUEST_PHOTO_BATCH_SIZE = int(os.getenv("QUEST_PHOTO_BATCH_SIZE", "16"))
+QUEST_PHOTO_BATCH_WAIT = float(os.getenv("QUEST_PHOTO_BATCH_WAIT", "1"))
+
+# 'auto' approves every new photo; 'admin' leaves them for the /quest_photos review screen
+QUEST_PHOTO_VERIFIER = os.getenv("QUEST_PHOTO_VERIFIER", "auto")
+
+# Times a photo is handed to the verifier before it is left for admin review
+QUEST_PHOTO_VERIFY_ATTEMPTS = int(os.getenv("QUEST_PHOTO_VERIFY_ATTEMPTS", "3"))
+
+# dHash bits that may differ for two photos to count as the same picture
+DHASH_DUPLICATE_DISTANCE = int(os.getenv("DHASH_DUPLICATE_DISTANCE", "6"))
+
+# PostgreSQL advisory lock key serialising duplicate checks between processes
+PHOTO_HASH_LOCK = 7301
+
+def dhash(image_bytes, size=8):
+    """64-bit difference hash: sign of the horizontal gradient on a 9x8 grayscale thumbnail"""
+    img = Image.open(io.BytesIO(image_bytes))
+    # JPEG decoders can downscale while decoding
+    img.draft('L', (size * 4, size * 4))
+    pixels = list(img.convert('L').resize((size + 1, size), Image.Resampling.BILINEAR).getdata())
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+def lock_photo_hashes():
+    """Serialise duplicate checks between processes until the unit of work ends"""
+    # SQLite units of work already begin with BEGIN IMMEDIATE
+    if db.session.get_bind().dialect.name == 'postgresql':
+        db.session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": PHOTO_HASH_LOCK})
+
+def is_duplicate_photo(photo_hash, unique_id, max_distance=DHASH_DUPLICATE_DISTANCE):
+    """True if a pending or approved submission has this photo or a near copy.
+
+    Reads the stored hashes, so every process sees photos accepted by the
+    others and rejected photos are free again.
+    """
+    used = QuestPhotoSubmission.status.in_(('pending', 'approved'))
+    if unique_id and db.session.execute(
+        select(QuestPhotoSubmission.id).where(used, QuestPhotoSubmission.photo_unique_id == unique_id).limit(1)
+    ).first():
+        return True
+    hashes = db.session.execute(
+        select(QuestPhotoSubmission.dhash).where(used, QuestPhotoSubmission.dhash.isnot(None))
+    ).scalars()
+    return any((photo_hash ^ int(hash_hex, 16)).bit_count() <= max_distance for hash_hex in hashes)
+
+class AutoApproveVerifier:
+    """Stand-in verifier that accepts every photo that is not a duplicate"""
+    name = 'auto'
+
+    def verify_batch(self, submissions):
+        return [True] * len(submissions)
+
+class AdminReviewVerifier:
+    """Leaves every photo pending for a human on the /quest_photos screen"""
+    name = 'admin'
+
+    def verify_batch(self, submissions):
+        return [None] * len(submissions)
+
+VERIFIERS = {
+    'auto': AutoApproveVerifier,
+    'admin': AdminReviewVerifier,
+}
+
+class PhotoSubmission:
+    def __init__(self, quest_progress_id, step, chat_id, photo_file_id, photo_unique_id, hash_file_id):
+        self.quest_progress_id = quest_progress_id
+        self.step = step
+        self.chat_id = chat_id
+        self.photo_file_id = photo_file_id
+        self.photo_unique_id = photo_unique_id
+        # Smallest thumbnail; plenty for a 9x8 hash
+        self.hash_file_id = hash_file_id
+        self.photo_bytes = None
+        self.photo_hash = None
+        self.submission_id = None
+        self.attempts = 0
+
+class QuestPhotoPipeline:
+    """Queue for quest photo steps.
+
+    Handlers only call submit(). Worker threads download a thumbnail,
+    dHash it and reject photos already used by anyone; the rest are
+    recorded as pending and passed to the verifier in batches. Photos the
+    verifier fails on are retried and then left for admin review. Progress
+    advances when a verdict arrives, from the verifier or an admin.
+    """
+
+    def __init__(self, verifier=None, max_queue=QUEST_PHOTO_QUEUE_SIZE, workers=QUEST_PHOTO_WORKERS,
+                 batch_size=QUEST_PHOTO_BATCH_SIZE, batch_wait=QUEST_PHOTO_BATCH_WAIT):
+        self.verifier = verifier or VERIFIERS[QUEST_PHOTO_VERIFIER]()
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.pending = queue.Queue(maxsize=max_queue)
+        self.to_verify = queue.Queue()
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.bot = None
+        self.started = False
+
+    def start(self, bot):
+        """Requeue unverified photos and start the worker threads"""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        self.bot = bot
+        with app.app_context():
+            unverified = db.session.execute(
+                select(QuestPhotoSubmission).where(QuestPhotoSubmission.status == 'pending').order_by(QuestPhotoSubmission.id)
+            ).scalars().all()
+            for row in unverified:
+                submission = PhotoSubmission(row.quest_progress_id, row.step, row.chat_id,
+                                             row.photo_file_id, row.photo_unique_id, None)
+                submission.submission_id = row.id
+                self.to_verify.put(submission)
+        for n in range(self.workers):
+            threading.Thread(target=self._hash_loop, name=f"quest-photo-{n}", daemon=True).start()
+        threading.Thread(target=self._verify_loop, name="quest-photo-verifier", daemon=True).start()
+        logging.info(f"Quest photo pipeline started ({self.verifier.name} verifier, {len(unverified)} pending)")
+
+    def submit(self, quest_progress_id, step, chat_id, photo_file_id, photo_unique_id, hash_file_id):
+        """Enqueue a photo for a quest step; returns 'queued', 'duplicate' or 'full'"""
+        with self.lock:
+            if quest_progress_id in self.in_flight:
+                return "duplicate"
+            try:
+                self.pending.put_nowait(PhotoSubmission(
+                    quest_progress_id, step, str(chat_id), photo_file_id, photo_unique_id, hash_file_id
+                ))
+            except queue.Full:
+                return "full"
+            self.in_flight.add(quest_progress_id)
+            return "queued"
+
+    def _hash_loop(self):
+        while True:
+            submission = self.pending.get()
+            try:
+                self._record(submission)
+            except Exception as e:
+                logging.error(f"Error hashing quest photo for progress {submission.quest_progress_id}: {e}")
+                self._notify(submission.chat_id, "❌ Не удалось обработать фото. Попробуйте отправить его еще раз.")
+            finally:
+                with self.lock:
+                    self.in_flight.discard(submission.quest_progress_id)
+
+    def _record(self, submission):
+        """Hash the photo, store the submission and queue it for verification unless it is a duplicate"""
+        file_info = self.bot.get_file(submission.hash_file_id)
+        submission.photo_bytes = self.bot.download_file(file_info.file_path)
+        submission.photo_hash = dhash(submission.photo_bytes)
+
+        with unit_of_work(write=True):
+            lock_photo_hashes()
+            is_new = not is_duplicate_photo(submission.photo_hash, submission.photo_unique_id)
+            row = QuestPhotoSubmission(
+                quest_progress_id=submission.quest_progress_id,
+                step=submission.step,
+                chat_id=submission.chat_id,
+                photo_file_id=submission.photo_file_id,
+                photo_unique_id=submission.photo_unique_id,
+                dhash=f"{submission.photo_hash:016x}",
+                status='pending' if is_new else 'duplicate'
+            )
+            db.session.add(row)
+            db.session.flush()
+            submission.submission_id = row.id
+
+        if is_new:
+            self.to_verify.put(submission)
+        else:
+            self._notify(submission.chat_id, "🚫 Это фото уже использовалось в квесте. Сделайте новое фото и отправьте его.")
+
+    def _next_batch(self):
+        batch = [self.to_verify.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.to_verify.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _verify_loop(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                verdicts = self.verifier.verify_batch(batch)
+            except Exception as e:
+                logging.error(f"Quest photo verifier failed on {len(batch)} photos: {e}")
+                verdicts = []
+                time.sleep(self.batch_wait)
+            # Photos without a verdict (the verifier failed or returned too few) are retried
+            for submission in batch[len(verdicts):]:
+                self._retry(submission)
+            for submission, verdict in zip(batch, verdicts):
+                if verdict is None:
+                    submission.photo_bytes = None
+                    continue
+                try:
+                    self.apply_verdict(submission.submission_id, verdict, self.verifier.name)
+                    submission.photo_bytes = None
+                except Exception as e:
+                    logging.error(f"Error applying verdict to quest photo {submission.submission_id}: {e}")
+                    self._retry(submission)
+
+    def _retry(self, submission):
+        """Hand a photo to the verifier again, or leave it pending for the /quest_photos screen"""
+        submission.attempts += 1
+        if submission.attempts < QUEST_PHOTO_VERIFY_ATTEMPTS:
+            self.to_verify.put(submission)
+            return
+        submission.photo_bytes = None
+        logging.warning(f"Quest photo {submission.submission_id} failed verification "
+                        f"{submission.attempts} times, left for admin review")
+
+    def apply_verdict(self, submission_id, approved, reviewer):
+        """Approve or reject a pending photo and advance the quest; False if it was already reviewed"""
+        with unit_of_work(write=True):
+            # Compare-and-set so two reviewers cannot both apply a verdict
+            claimed = db.session.execute(
+                update(QuestPhotoSubmission)
+                .where(QuestPhotoSubmission.id == submission_id, QuestPhotoSubmission.status == 'pending')
+                .values(status='approved' if approved else 'rejected', reviewed_by=reviewer, reviewed_at=datetime.utcnow())
+            ).rowcount
+            if not claimed:
+                return False
+
+            row = db.session.get(QuestPhotoSubmission, submission_id)
+            chat_id = row.chat_id
+            if approved:
+                quest_progress = db.session.get(QuestProgress, row.quest_progress_id)
+                # Commits the verdict together with the step completion
+                success, result = quest_manager.advance_quest_step(quest_progress, "photo", row.photo_file_id, step_number=row.step)
+                completed = success and quest_progress.completed
+                if not success:
+                    # The step is no longer open (e.g. completed meanwhile); rejecting frees the photo
+                    logging.info(f"Approved quest photo {submission_id} did not advance progress: {result}")
+                    row.status = 'rejected'
+
+        if not approved:
+            self._notify(chat_id, "❌ Фото не прошло проверку. Сделайте новое фото по заданию и отправьте его еще раз.")
+            return True
+        if not success:
+            self._notify(chat_id, "⚠️ Фото не засчитано: это задание уже неактуально. Откройте «🧩 Квест» в меню, чтобы увидеть текущее задание.")
+            return True
+
+        if completed:
+            self._notify(chat_id, "🎉 Фото принято, квест завершен! Откройте «🧩 Квест» в меню, чтобы получить код приза.")
+        else:
+            self._notify(chat_id, "✅ Фото принято! Откройте «🧩 Квест» в меню, чтобы увидеть следующее задание.")
+        return True
+
+    def _notify(self, chat_id, text):
+        try:
+            self.bot.send_message(chat_id, text)
+        except Exception as e:
+            logging.error(f"Error notifying {chat_id} about a quest photo: {e}")
+
+quest_photo_pipeline = QuestPhotoPipeline()
@@ -0,0 +1,178 @@
+import os
+import time
+import threading
+from sqlalchemy import select, insert, update, delete, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import User, Registration, SlotInventory, SlotWaitlist
+from unit_of_work import on_commit
+
+# Columns of the uq_registration_user_slot unique index
+SLOT_KEY = ['user_id', 'activity_type', 'day', 'time_slot']
+
+ACTIVITY_TYPES = ["dance", "yoga"]
+
+# Seats per activity slot, used when the inventory rows are first created
+SLOT_CAPACITY = int(os.getenv("SLOT_CAPACITY", "30"))
+
+# Seconds the remaining-seats snapshot shown on buttons may be stale
+SLOT_SNAPSHOT_TTL = float(os.getenv("SLOT_SNAPSHOT_TTL", "2"))
+
+def _insert_ignore(model, values, index_elements):
+    """INSERT ... ON CONFLICT DO NOTHING; returns True if a new row was added"""
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect in ('sqlite', 'postgresql'):
+        dialect_insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        stmt = dialect_insert(model).values(**values).on_conflict_do_nothing(index_elements=index_elements)
+        return db.session.execute(stmt).rowcount == 1
+
+    # Other databases: rely on the unique index and a savepoint
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(model).values(**values))
+        return True
+    except IntegrityError:
+        return False
+
+def insert_registration(user_id, activity_type, day, time_slot):
+    """Insert-or-conflict on the unique slot index; does not commit"""
+    values = dict(user_id=user_id, activity_type=activity_type, day=day, time_slot=time_slot)
+    return _insert_ignore(Registration, values, SLOT_KEY)
+
+def _slot_filter(activity_type, day, time_slot):
+    return (
+        SlotInventory.activity_type == activity_type,
+        SlotInventory.day == day,
+        SlotInventory.time_slot == time_slot,
+    )
+
+def _take_seat(activity_type, day, time_slot):
+    """Atomically take one seat; False when the slot is full"""
+    stmt = (
+        update(SlotInventory)
+        .where(*_slot_filter(activity_type, day, time_slot), SlotInventory.taken < SlotInventory.capacity)
+        .values(taken=SlotInventory.taken + 1)
+    )
+    return db.session.execute(stmt).rowcount == 1
+
+def _release_seat(activity_type, day, time_slot):
+    db.session.execute(
+        update(SlotInventory)
+        .where(*_slot_filter(activity_type, day, time_slot), SlotInventory.taken > 0)
+        .values(taken=SlotInventory.taken - 1)
+    )
+
+def ensure_slots(days, time_slots, capacity=SLOT_CAPACITY):
+    """Create inventory rows for every activity slot that does not have one yet.
+
+    New rows start with the registrations that already exist for the slot.
+    Runs in the caller's write unit of work.
+    """
+    existing = dict(
+        ((a, d, t), count) for a, d, t, count in db.session.execute(
+            select(Registration.activity_type, Registration.day, Registration.time_slot, func.count())
+            .group_by(Registration.activity_type, Registration.day, Registration.time_slot)
+        )
+    )
+    for activity_type in ACTIVITY_TYPES:
+        for day in days:
+            for time_slot in time_slots:
+                taken = existing.get((activity_type, day, time_slot), 0)
+                _insert_ignore(SlotInventory, dict(
+                    activity_type=activity_type, day=day, time_slot=time_slot, capacity=capacity, taken=taken
+                ), ['activity_type', 'day', 'time_slot'])
+
+def register(user_id, activity_type, day, time_slot):
+    """Register a user for a slot in the caller's unit of work.
+
+    The registration row is inserted first and the seat taken with a
+    conditional UPDATE; when no seat is left the row is removed again and the
+    user goes to the waitlist. Returns 'registered', 'duplicate' or 'waitlisted'.
+    """
+    if not insert_registration(user_id, activity_type, day, time_slot):
+        return 'duplicate'
+
+    if _take_seat(activity_type, day, time_slot):
+        on_commit(slot_snapshot.invalidate)
+        return 'registered'
+
+    db.session.execute(delete(Registration).filter_by(
+        user_id=user_id, activity_type=activity_type, day=day, time_slot=time_slot
+    ))
+    _insert_ignore(SlotWaitlist, dict(
+        user_id=user_id, activity_type=activity_type, day=day, time_slot=time_slot
+    ), SLOT_KEY)
+    return 'waitlisted'
+
+def release_registrations(user_id):
+    """Delete a user's registrations and waitlist entries, handing freed seats to the waitlist.
+
+    Runs in the caller's unit of work. Returns [(telegram_id, activity_type, day, time_slot)] for promoted users.
+    """
+    slots = db.session.execute(
+        select(Registration.activity_type, Registration.day, Registration.time_slot).filter_by(user_id=user_id)
+    ).all()
+    db.session.execute(delete(Registration).filter_by(user_id=user_id))
+    db.session.execute(delete(SlotWaitlist).filter_by(user_id=user_id))
+
+    promoted = []
+    for activity_type, day, time_slot in slots:
+        _release_seat(activity_type, day, time_slot)
+        # The first waitlisted user who is not yet registered gets the freed seat.
+        # The seat is taken before anyone leaves the waitlist, and a waitlist
+        # entry is only removed once its registration row exists.
+        if not _take_seat(activity_type, day, time_slot):
+            continue
+        waiting = db.session.execute(
+            select(SlotWaitlist.id, SlotWaitlist.user_id, User.telegram_id)
+            .join(User, SlotWaitlist.user_id == User.id)
+            .filter_by(activity_type=activity_type, day=day, time_slot=time_slot)
+            .order_by(SlotWaitlist.id)
+        ).all()
+        for entry in waiting:
+            registered = insert_registration(entry.user_id, activity_type, day, time_slot)
+            # Either way the entry is done: promoted now, or already registered
+            db.session.execute(delete(SlotWaitlist).filter_by(id=entry.id))
+            if registered:
+                promoted.append((entry.telegram_id, activity_type, day, time_slot))
+                break
+        else:
+            # Nobody could take the seat; give it back
+            _release_seat(activity_type, day, time_slot)
+
+    on_commit(slot_snapshot.invalidate)
+    return promoted
+
+class SlotSnapshot:
+    """Short-TTL cache of remaining seats, read when rendering the registration keyboard"""
+
+    def __init__(self, ttl=SLOT_SNAPSHOT_TTL):
+        self.ttl = ttl
+        self.remaining = {}
+        # Bumped whenever the remaining seats change, so screens built from them can be cached
+        self.version = 0
+        self.expires_at = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        """{(activity_type, day, time_slot): seats left}; must be called in an app context"""
+        with self.lock:
+            if time.monotonic() >= self.expires_at:
+                rows = db.session.execute(select(
+                    SlotInventory.activity_type, SlotInventory.day, SlotInventory.time_slot,
+                    SlotInventory.capacity - SlotInventory.taken
+                )).all()
+                remaining = {(a, d, t): left for a, d, t, left in rows}
+                if remaining != self.remaining:
+                    self.remaining = remaining
+                    self.version += 1
+                self.expires_at = time.monotonic() + self.ttl
+            return self.remaining
+
+    def invalidate(self):
+        with self.lock:
+            self.expires_at = 0
+
+slot_snapshot = SlotSnapshot()
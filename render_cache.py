@@ -0,0 +1,76 @@
+import hashlib
+import threading
+from telebot import types
+
+def render_fingerprint(text, reply_markup=None, **kwargs):
+    """Digest of everything an edit would send for a message.
+
+    Telegram trims surrounding whitespace from message text, so the text is
+    compared trimmed.
+    """
+    if isinstance(reply_markup, types.JsonSerializable):
+        reply_markup = reply_markup.to_json()
+    options = sorted((key, repr(value)) for key, value in kwargs.items() if value is not None)
+    payload = f"{(text or '').strip()}\x00{reply_markup}\x00{options}"
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).digest()
+
+def message_fingerprint(message):
+    """Fingerprint of what a message from an update currently shows"""
+    return render_fingerprint(message.text or message.caption, message.reply_markup)
+
+class RenderCache:
+    """What the tapped message shows, per handler thread, so identical edits can be skipped.
+
+    The content comes from the callback update itself (Telegram sends the
+    message as it is now), so every process sees the same truth; nothing is
+    remembered once the update is handled.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.suppressed = 0
+        self.not_modified = 0
+
+    def track(self, message):
+        """Start handling an update that was tapped on message"""
+        if isinstance(message, types.InaccessibleMessage):
+            # Telegram no longer sends the content of old messages
+            self.clear()
+            return
+        self.local.key = (str(message.chat.id), message.message_id)
+        self.local.fingerprint = message_fingerprint(message)
+
+    def clear(self):
+        self.local.key = None
+        self.local.fingerprint = None
+
+    def is_current(self, key, fingerprint):
+        """True (and counted as suppressed) if the message already shows this content"""
+        if getattr(self.local, 'key', None) == key and self.local.fingerprint == fingerprint:
+            with self.lock:
+                self.suppressed += 1
+            return True
+        return False
+
+    def remember(self, key, fingerprint, not_modified=False):
+        if getattr(self.local, 'key', None) == key:
+            self.local.fingerprint = fingerprint
+        with self.lock:
+            if not_modified:
+                self.not_modified += 1
+            else:
+                self.sent += 1
+
+    def forget(self, key):
+        if getattr(self.local, 'key', None) == key:
+            self.local.fingerprint = None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "edits_sent": self.sent,
+                "edits_suppressed": self.suppressed,
+                "not_modified_errors": self.not_modified,
+            }
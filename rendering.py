@@ -0,0 +1,47 @@
+from functools import lru_cache
+from PIL import Image, ImageDraw
+
+# Masks are drawn at this multiple of the target size and downsampled for anti-aliasing
+MASK_SUPERSAMPLE = 4
+
+def hex_to_rgb(color):
+    """Convert '#RRGGBB' to an (r, g, b) tuple"""
+    return tuple(int(color[i:i+2], 16) for i in (1, 3, 5))
+
+def vertical_gradient(color, size, max_alpha=0.8):
+    """Build a solid-colour RGBA layer whose alpha fades from top to bottom"""
+    height = size[1]
+    # 256x256 ramp from 0 (top) to 255 (bottom), squeezed to one column of the target height
+    ramp = Image.linear_gradient('L').resize((1, height), Image.Resampling.BILINEAR)
+    column = Image.new('RGBA', (1, height), hex_to_rgb(color) + (0,))
+    column.putalpha(ramp.point(lambda v: int((255 - v) * max_alpha)))
+    # Stretch the single column across the full width in one pass
+    return column.resize(size, Image.Resampling.NEAREST)
+
+def add_border(img, color, width=20):
+    """Draw a solid frame of the given width around the image in place"""
+    img_width, img_height = img.size
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([(0, 0), (img_width, width)], fill=color)
+    draw.rectangle([(0, img_height - width), (img_width, img_height)], fill=color)
+    draw.rectangle([(0, 0), (width, img_height)], fill=color)
+    draw.rectangle([(img_width - width, 0), (img_width, img_height)], fill=color)
+    return img
+
+@lru_cache(maxsize=64)
+def circle_mask(size):
+    """Anti-aliased elliptical mask filling the given size; shared, do not modify"""
+    width, height = size
+    big = Image.new('L', (width * MASK_SUPERSAMPLE, height * MASK_SUPERSAMPLE), 0)
+    ImageDraw.Draw(big).ellipse((0, 0, big.width - 1, big.height - 1), fill=255)
+    return big.resize(size, Image.Resampling.LANCZOS)
+
+@lru_cache(maxsize=64)
+def rounded_mask(size, radius):
+    """Anti-aliased rounded-rectangle mask; shared, do not modify"""
+    width, height = size
+    big = Image.new('L', (width * MASK_SUPERSAMPLE, height * MASK_SUPERSAMPLE), 0)
+    ImageDraw.Draw(big).rounded_rectangle(
+        (0, 0, big.width - 1, big.height - 1), radius=radius * MASK_SUPERSAMPLE, fill=255
+    )
+    return big.resize(size, Image.Resampling.LANCZOS)
@@ -0,0 +1,49 @@
+import threading
+from collections import namedtuple
+from telebot import types
+
+Screen = namedtuple('Screen', ['text', 'markup'])
+
+class PrebuiltMarkup(types.JsonSerializable):
+    """Reply markup serialized once; telebot sends to_json() unchanged"""
+
+    def __init__(self, markup):
+        self.json = markup.to_json()
+
+    def to_json(self):
+        return self.json
+
+class ScreenRegistry:
+    """Screens (text plus keyboard) built on first use and then served from memory.
+
+    Builders registered with @screen(name) return (text, InlineKeyboardMarkup).
+    Screens that depend on data pass a version; a new version rebuilds the
+    screen and replaces the old one.
+    """
+
+    def __init__(self):
+        self.builders = {}
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def screen(self, name):
+        def register(builder):
+            self.builders[name] = builder
+            return builder
+        return register
+
+    def get(self, name, *args, version=None):
+        """Cached Screen for name (and args); builder args are part of the cache key"""
+        key = (name, args)
+        cached = self.cache.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+        text, markup = self.builders[name](*args)
+        screen = Screen(text, PrebuiltMarkup(markup))
+        with self.lock:
+            self.cache[key] = (version, screen)
+        return screen
+
+    def invalidate(self):
+        with self.lock:
+            self.cache.clear()
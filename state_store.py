@@ -0,0 +1,206 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import ConversationState
+from unit_of_work import unit_of_work
+
+# 'sql' shares states between bot workers through the database; 'memory' keeps
+# them in this process and only suits a single polling process
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sql")
+
+# Seconds a conversation state lives unless it is set again
+STATE_TTL = int(os.getenv("STATE_TTL", "900"))
+
+# Expired states are deleted in batches of this size every interval
+STATE_SWEEP_INTERVAL = float(os.getenv("STATE_SWEEP_INTERVAL", "60"))
+STATE_SWEEP_BATCH = int(os.getenv("STATE_SWEEP_BATCH", "500"))
+
+# Lock shards of the in-memory backend
+STATE_SHARDS = 16
+
+class MemoryStateStore:
+    """Per-process states with TTL; keys are spread over independently locked shards"""
+
+    def __init__(self, ttl=STATE_TTL, shards=STATE_SHARDS):
+        self.ttl = ttl
+        self.shards = [(threading.Lock(), {}) for _ in range(shards)]
+
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def _live(self, states, key, now):
+        entry = states.get(key)
+        if entry and entry[1] <= now:
+            del states[key]
+            return None
+        return entry[0] if entry else None
+
+    def get(self, key):
+        key = str(key)
+        lock, states = self._shard(key)
+        with lock:
+            return self._live(states, key, time.monotonic())
+
+    def set(self, key, value, ttl=None):
+        key = str(key)
+        lock, states = self._shard(key)
+        with lock:
+            states[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+
+    def delete(self, key):
+        key = str(key)
+        lock, states = self._shard(key)
+        with lock:
+            states.pop(key, None)
+
+    def compare_and_set(self, key, expected, value, ttl=None):
+        """Set value (None deletes) only if the current state equals expected; True on success"""
+        key = str(key)
+        lock, states = self._shard(key)
+        with lock:
+            if self._live(states, key, time.monotonic()) != expected:
+                return False
+            if value is None:
+                states.pop(key, None)
+            else:
+                states[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            return True
+
+    def sweep(self, limit=STATE_SWEEP_BATCH):
+        """Drop up to limit expired states; returns how many were removed"""
+        now = time.monotonic()
+        removed = 0
+        for lock, states in self.shards:
+            with lock:
+                expired = [key for key, (_, expires_at) in states.items() if expires_at <= now][:limit - removed]
+                for key in expired:
+                    del states[key]
+            removed += len(expired)
+            if removed >= limit:
+                break
+        return removed
+
+class SqlStateStore:
+    """States in the conversation_state table, shared by every bot worker using the database.
+
+    Writes join the current update's unit of work and commit with it.
+    """
+
+    def __init__(self, ttl=STATE_TTL):
+        self.ttl = ttl
+
+    def _expires_at(self, ttl):
+        return datetime.utcnow() + timedelta(seconds=self.ttl if ttl is None else ttl)
+
+    def get(self, key):
+        with unit_of_work():
+            return db.session.scalar(select(ConversationState.value).where(
+                ConversationState.key == str(key), ConversationState.expires_at > datetime.utcnow()
+            ))
+
+    def set(self, key, value, ttl=None):
+        values = dict(key=str(key), value=value, expires_at=self._expires_at(ttl))
+        with unit_of_work(write=True):
+            dialect = db.session.get_bind().dialect.name
+            if dialect in ('sqlite', 'postgresql'):
+                dialect_insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+                stmt = dialect_insert(ConversationState).values(**values)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=['key'], set_=dict(value=stmt.excluded.value, expires_at=stmt.excluded.expires_at)
+                )
+                db.session.execute(stmt)
+            else:
+                db.session.merge(ConversationState(**values))
+
+    def delete(self, key):
+        with unit_of_work(write=True):
+            db.session.execute(delete(ConversationState).where(ConversationState.key == str(key)))
+
+    def compare_and_set(self, key, expected, value, ttl=None):
+        """Set value (None deletes) only if the current state equals expected; True on success"""
+        key = str(key)
+        now = datetime.utcnow()
+        with unit_of_work(write=True):
+            if expected is None:
+                # Expired rows count as absent; the primary key makes the insert the atomic step
+                db.session.execute(delete(ConversationState).where(
+                    ConversationState.key == key, ConversationState.expires_at <= now
+                ))
+                if value is None:
+                    changed = db.session.scalar(select(ConversationState.key).where(ConversationState.key == key)) is None
+                else:
+                    try:
+                        with db.session.begin_nested():
+                            db.session.execute(insert(ConversationState).values(
+                                key=key, value=value, expires_at=self._expires_at(ttl)
+                            ))
+                        changed = True
+                    except IntegrityError:
+                        changed = False
+            else:
+                current = (
+                    ConversationState.key == key,
+                    ConversationState.value == expected,
+                    ConversationState.expires_at > now,
+                )
+                if value is None:
+                    stmt = delete(ConversationState).where(*current)
+                else:
+                    stmt = update(ConversationState).where(*current).values(value=value, expires_at=self._expires_at(ttl))
+                changed = db.session.execute(stmt).rowcount == 1
+            return changed
+
+    def sweep(self, limit=STATE_SWEEP_BATCH):
+        """Delete up to limit expired rows; returns how many were removed"""
+        with unit_of_work(write=True):
+            expired = select(ConversationState.key).where(
+                ConversationState.expires_at <= datetime.utcnow()
+            ).limit(limit)
+            removed = db.session.execute(
+                delete(ConversationState).where(ConversationState.key.in_(expired))
+            ).rowcount
+            return removed
+
+STATE_BACKENDS = {
+    'memory': MemoryStateStore,
+    'sql': SqlStateStore,
+}
+
+class StateSweeper:
+    """Background thread deleting expired states in batches instead of on every message"""
+
+    def __init__(self, store, interval=STATE_SWEEP_INTERVAL, batch_size=STATE_SWEEP_BATCH):
+        self.store = store
+        self.interval = interval
+        self.batch_size = batch_size
+        self.started = False
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        threading.Thread(target=self._run, name="state-sweeper", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                total = 0
+                while True:
+                    removed = self.store.sweep(self.batch_size)
+                    total += removed
+                    if removed < self.batch_size:
+                        break
+                if total:
+                    logging.info(f"Swept {total} expired conversation states")
+            except Exception as e:
+                logging.error(f"Error sweeping conversation states: {e}")
+
+conversation_states = STATE_BACKENDS[STATE_BACKEND]()
+state_sweeper = StateSweeper(conversation_states)
@@ -0,0 +1,59 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from sqlalchemy import select, func, case
+from app import db
+from models import User, Registration, QuestProgress, StickerGeneration
+
+# Seconds a computed stats snapshot is served before the database is queried again
+STATS_TTL = float(os.getenv("STATS_TTL", "3"))
+
+def compute_stats():
+    """All dashboard counters in a single aggregate query"""
+    registrations = select(
+        func.count().label('total'),
+        func.coalesce(func.sum(case((Registration.activity_type == 'dance', 1), else_=0)), 0).label('dance'),
+        func.coalesce(func.sum(case((Registration.activity_type == 'yoga', 1), else_=0)), 0).label('yoga'),
+    ).subquery()
+    stmt = select(
+        select(func.count()).select_from(User).scalar_subquery().label('total_users'),
+        registrations.c.total,
+        registrations.c.dance,
+        registrations.c.yoga,
+        select(func.count()).select_from(QuestProgress)
+            .where(QuestProgress.completed == True).scalar_subquery().label('completed_quests'),
+        select(func.count()).select_from(StickerGeneration).scalar_subquery().label('generated_stickers'),
+    ).select_from(registrations)
+    row = db.session.execute(stmt).one()
+    return {
+        'total_users': row.total_users,
+        'total_registrations': row.total,
+        'dance_registrations': row.dance,
+        'yoga_registrations': row.yoga,
+        'completed_quests': row.completed_quests,
+        'generated_stickers': row.generated_stickers,
+    }
+
+class StatsCache:
+    """Short-TTL snapshot of compute_stats() shared by the dashboard routes"""
+
+    def __init__(self, ttl=STATS_TTL):
+        self.ttl = ttl
+        self.stats = None
+        self.etag = None
+        self.expires_at = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Return (stats, etag); at most one query per TTL per process"""
+        with self.lock:
+            if time.monotonic() >= self.expires_at:
+                stats = compute_stats()
+                self.stats = stats
+                self.etag = hashlib.md5(json.dumps(stats, sort_keys=True).encode('utf-8')).hexdigest()
+                self.expires_at = time.monotonic() + self.ttl
+            return self.stats, self.etag
+
+stats_cache = StatsCache()
@@ -0,0 +1,147 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+# Disk cache for background-removed cutouts and finished stickers
+STICKER_CACHE_DIR = os.getenv(
+    "STICKER_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance", "sticker_cache")
+)
+STICKER_CACHE_MAX_BYTES = int(os.getenv("STICKER_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+class DiskLRUCache:
+    """Size-bounded LRU cache of byte blobs stored as files.
+
+    The in-memory index keeps recency order and sizes; the least recently
+    used files are deleted once the total exceeds max_bytes.
+    """
+
+    def __init__(self, directory=STICKER_CACHE_DIR, max_bytes=STICKER_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        """Rebuild the index from files on disk, oldest access first"""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path) and not name.endswith(".tmp"):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self.index[name] = size
+            self.total_bytes += size
+        self._evict()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def _name(key):
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        name = self._name(key)
+        with self.lock:
+            if name not in self.index:
+                self.misses += 1
+                return None
+            self.index.move_to_end(name)
+        try:
+            with open(self._path(name), "rb") as f:
+                data = f.read()
+            os.utime(self._path(name))
+        except OSError:
+            with self.lock:
+                self.total_bytes -= self.index.pop(name, 0)
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        name = self._name(key)
+        tmp_path = self._path(name + ".tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(name))
+        except OSError as e:
+            logging.error(f"Error writing sticker cache entry: {e}")
+            return
+        with self.lock:
+            self.total_bytes -= self.index.pop(name, 0)
+            self.index[name] = len(data)
+            self.total_bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.index:
+            name, size = self.index.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.index),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+class StickerCache:
+    """Content-addressed cutouts and stickers keyed by file_unique_id + content hash"""
+
+    def __init__(self, store=None):
+        self.store = store or DiskLRUCache()
+
+    @staticmethod
+    def content_key(file_unique_id, photo_bytes):
+        return f"{file_unique_id}-{hashlib.sha256(photo_bytes).hexdigest()[:32]}"
+
+    def remember_photo(self, file_unique_id, content_key):
+        """Map the Telegram id to its content key so repeats can skip the download"""
+        self.store.put(f"photo:{file_unique_id}", content_key.encode("utf-8"))
+
+    def lookup_photo(self, file_unique_id):
+        data = self.store.get(f"photo:{file_unique_id}")
+        return data.decode("utf-8") if data else None
+
+    def get_cutout(self, content_key):
+        return self.store.get(f"cutout:{content_key}")
+
+    def put_cutout(self, content_key, cutout_bytes):
+        self.store.put(f"cutout:{content_key}", cutout_bytes)
+
+    def get_sticker(self, content_key, template_name, mode):
+        return self.store.get(f"sticker:{content_key}:{template_name}:{mode}")
+
+    def put_sticker(self, content_key, template_name, mode, sticker_bytes):
+        self.store.put(f"sticker:{content_key}:{template_name}:{mode}", sticker_bytes)
+
+    def get_file_id(self, content_key, template_name, mode):
+        """Telegram file_id of this sticker if it has already been uploaded"""
+        data = self.store.get(f"file_id:{content_key}:{template_name}:{mode}")
+        return data.decode("utf-8") if data else None
+
+    def put_file_id(self, content_key, template_name, mode, file_id):
+        self.store.put(f"file_id:{content_key}:{template_name}:{mode}", file_id.encode("utf-8"))
+
+    def stats(self):
+        return self.store.stats()
@@ -4,12 +4,16 @@ import logging
 import aiohttp
 import asyncio
 import random
+import threading
+import time
 from PIL import Image, ImageDraw, ImageFont
 import base64
+from rendering import vertical_gradient, add_border, circle_mask
 
 # API tokens
 REMOVE_BG_TOKEN = os.getenv("REMOVE_BG_TOKEN", "WLMDgqhpcCGFGD7bgiaKzuJo")
 REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN", "r8_7miai9DTh96AVgIZZCjS6Jq5d4kJHsv0WmoRz")
+REMOVE_BG_URL = os.getenv("REMOVE_BG_URL", "https://api.remove.bg/v1.0/removebg")
 
 # Festival templates (we'll generate these programmatically since we can't include binary files)
 TEMPLATES = [
@@ -23,31 +27,77 @@ TEMPLATES = [
 FESTIVAL_TEXT = "Хорошие истории начинаются с тебя"
 AVITO_TEXT = "Avito × Dikaya Myata"
 
+# Template sizes used by generate_sticker and generate_simple_sticker
+TEMPLATE_SIZES = [(800, 800), (600, 800)]
+
+# Output encoding: png_fast, webp_lossless, webp or tg_sticker (512px WebP sent with send_sticker)
+STICKER_OUTPUT_MODE = os.getenv("STICKER_OUTPUT_MODE", "png_fast")
+OUTPUT_MODES = ("png_fast", "webp_lossless", "webp", "tg_sticker")
+if STICKER_OUTPUT_MODE not in OUTPUT_MODES:
+    raise ValueError(f"STICKER_OUTPUT_MODE must be one of {', '.join(OUTPUT_MODES)}, got {STICKER_OUTPUT_MODE!r}")
+
+# Telegram requires one side of a sticker to be exactly 512px
+TG_STICKER_SIDE = 512
+
+# Per-mode encode statistics: mode -> {"count", "total_ms", "total_bytes"}
+_encode_stats = {}
+_encode_stats_lock = threading.Lock()
+
+# generate_simple_sticker template and the area left for the photo above the text
+SIMPLE_TEMPLATE_SIZE = (600, 800)
+SIMPLE_PHOTO_AREA = (SIMPLE_TEMPLATE_SIZE[0] - 100, SIMPLE_TEMPLATE_SIZE[1] - 200)
+
+# Fonts are loaded once per process instead of on every template render
+_fonts = None
+_fonts_lock = threading.Lock()
+
+# Rendered templates keyed by (template name, size)
+_template_cache = {}
+_template_cache_lock = threading.Lock()
+
+def get_fonts():
+    """Load the festival fonts once and reuse them"""
+    global _fonts
+    if _fonts is None:
+        with _fonts_lock:
+            if _fonts is None:
+                try:
+                    font_large = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 36)
+                    font_small = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 24)
+                except:
+                    font_large = ImageFont.load_default()
+                    font_small = ImageFont.load_default()
+                _fonts = (font_large, font_small)
+    return _fonts
+
+def get_festival_template(template_info, size=(800, 800)):
+    """Get a cached festival template; callers must copy() before drawing on it"""
+    key = (template_info["name"], tuple(size))
+    template_img = _template_cache.get(key)
+    if template_img is None:
+        with _template_cache_lock:
+            template_img = _template_cache.get(key)
+            if template_img is None:
+                template_img = create_festival_template(template_info, size)
+                _template_cache[key] = template_img
+    return template_img
+
+def warm_template_cache():
+    """Pre-render every template in every size used by the generators"""
+    for template_info in TEMPLATES:
+        for size in TEMPLATE_SIZES:
+            get_festival_template(template_info, size)
+    logging.info(f"Template cache warmed: {len(_template_cache)} templates")
+
 def create_festival_template(template_info, size=(800, 800)):
     """Create a festival template programmatically"""
-    img = Image.new('RGBA', size, (255, 255, 255, 0))
+    # Gradient background and decorative border
+    img = vertical_gradient(template_info["color"], size)
+    add_border(img, template_info["color"], width=20)
     draw = ImageDraw.Draw(img)
     
-    # Create gradient background
-    for y in range(size[1]):
-        alpha = int(255 * (1 - y / size[1]) * 0.8)
-        color = tuple(int(template_info["color"][i:i+2], 16) for i in (1, 3, 5)) + (alpha,)
-        draw.rectangle([(0, y), (size[0], y+1)], fill=color)
-    
-    # Add decorative border
-    border_width = 20
-    draw.rectangle([(0, 0), (size[0], border_width)], fill=template_info["color"])
-    draw.rectangle([(0, size[1]-border_width), (size[0], size[1])], fill=template_info["color"])
-    draw.rectangle([(0, 0), (border_width, size[1])], fill=template_info["color"])
-    draw.rectangle([(size[0]-border_width, 0), (size[0], size[1])], fill=template_info["color"])
-    
     # Add festival text at bottom
-    try:
-        font_large = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 36)
-        font_small = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 24)
-    except:
-        font_large = ImageFont.load_default()
-        font_small = ImageFont.load_default()
+    font_large, font_small = get_fonts()
     
     # Main text
     bbox = draw.textbbox((0, 0), FESTIVAL_TEXT, font=font_large)
@@ -70,14 +120,64 @@ def create_festival_template(template_info, size=(800, 800)):
     
     return img
 
+def encode_sticker(img, mode=None):
+    """Encode a finished sticker; returns (bytes, encode time in ms)"""
+    mode = mode or STICKER_OUTPUT_MODE
+    start = time.perf_counter()
+    output_buffer = io.BytesIO()
+    
+    if mode == "png_fast":
+        img.save(output_buffer, format='PNG', compress_level=1)
+    elif mode == "webp_lossless":
+        img.save(output_buffer, format='WEBP', lossless=True, method=0)
+    elif mode == "webp":
+        img.save(output_buffer, format='WEBP', quality=85, method=2)
+    elif mode == "tg_sticker":
+        scale = TG_STICKER_SIDE / max(img.size)
+        sticker_img = img.resize(
+            (round(img.width * scale), round(img.height * scale)), Image.Resampling.LANCZOS
+        )
+        sticker_img.save(output_buffer, format='WEBP', quality=85, method=2)
+    else:
+        raise ValueError(f"Unknown sticker output mode: {mode}")
+    
+    return output_buffer.getvalue(), (time.perf_counter() - start) * 1000
+
+def record_encode(mode, encode_ms, size):
+    """Add one encode to the per-mode statistics"""
+    with _encode_stats_lock:
+        stats = _encode_stats.setdefault(mode, {"count": 0, "total_ms": 0.0, "total_bytes": 0})
+        stats["count"] += 1
+        stats["total_ms"] += encode_ms
+        stats["total_bytes"] += size
+    logging.info(f"Encoded sticker as {mode}: {size} bytes in {encode_ms:.1f} ms")
+
+def get_encode_stats():
+    """Average encode time and output size per mode"""
+    with _encode_stats_lock:
+        return {
+            mode: {
+                "count": stats["count"],
+                "avg_ms": stats["total_ms"] / stats["count"],
+                "avg_bytes": stats["total_bytes"] // stats["count"],
+            }
+            for mode, stats in _encode_stats.items()
+        }
+
+def removebg_form(image_bytes):
+    """Multipart body for a Remove.bg request"""
+    form = aiohttp.FormData()
+    form.add_field('image_file', image_bytes, filename='photo.jpg', content_type='image/jpeg')
+    return form
+
 async def remove_background(image_bytes):
     """Remove background using Remove.bg API"""
     try:
         async with aiohttp.ClientSession() as session:
             async with session.post(
-                'https://api.remove.bg/v1.0/removebg',
+                REMOVE_BG_URL,
                 headers={'X-Api-Key': REMOVE_BG_TOKEN},
-                data=aiohttp.FormData()._add_field('image_file', image_bytes, content_type='image/jpeg')
+                data=removebg_form(image_bytes)
             ) as response:
                 if response.status == 200:
                     return await response.read()
@@ -140,8 +240,8 @@ async def generate_sticker(photo_bytes):
         template_info = random.choice(TEMPLATES)
         logging.info(f"Using template: {template_info['name']}")
         
-        # Step 3: Create template
-        background_img = create_festival_template(template_info)
+        # Step 3: Get pre-rendered template
+        background_img = get_festival_template(template_info)
         
         # Step 4: Composite images
         final_img = composite_images(background_img, no_bg_bytes)
@@ -151,34 +251,77 @@ async def generate_sticker(photo_bytes):
             return None, None
         
         # Step 5: Convert to bytes
-        output_buffer = io.BytesIO()
-        final_img.save(output_buffer, format='PNG', quality=95)
-        output_buffer.seek(0)
+        sticker_bytes, encode_ms = encode_sticker(final_img)
+        record_encode(STICKER_OUTPUT_MODE, encode_ms, len(sticker_bytes))
         
         logging.info("Sticker generated successfully")
-        return output_buffer.getvalue(), template_info['name']
+        return sticker_bytes, template_info['name']
         
     except Exception as e:
         logging.error(f"Error generating sticker: {e}")
         return None, None
 
+def pick_photo_size(photo_sizes, area=SIMPLE_PHOTO_AREA):
+    """Pick the smallest Telegram PhotoSize that still fills the photo area"""
+    for photo_size in sorted(photo_sizes, key=lambda p: p.width * p.height):
+        if photo_size.width >= area[0] or photo_size.height >= area[1]:
+            return photo_size
+    return max(photo_sizes, key=lambda p: p.width * p.height)
+
+def load_photo(photo_bytes, area):
+    """Decode a photo as RGB, letting the decoder downscale towards the fitted size.
+
+    JPEGs are decoded with Image.draft (DCT scaling), other formats are
+    shrunk with Image.reduce before the final LANCZOS resize.
+    """
+    start = time.perf_counter()
+    img = Image.open(io.BytesIO(photo_bytes))
+    full_width, full_height = img.size
+    scale = min(area[0] / full_width, area[1] / full_height)
+    target = (max(1, int(full_width * scale)), max(1, int(full_height * scale)))
+    
+    if img.format == 'JPEG':
+        img.draft('RGB', target)
+    img = img.convert('RGB')
+    
+    factor = min(img.width // target[0], img.height // target[1])
+    if factor >= 2:
+        img = img.reduce(factor)
+    
+    decode_ms = (time.perf_counter() - start) * 1000
+    logging.info(
+        f"Decoded photo {full_width}x{full_height} as {img.width}x{img.height} "
+        f"({full_width * full_height / (img.width * img.height):.1f}x fewer pixels) in {decode_ms:.1f} ms"
+    )
+    return img
+
 # Alternative simple sticker generator if APIs fail
-def generate_simple_sticker(photo_bytes, template_info):
+def generate_simple_sticker(photo_bytes, template_info, mode=None):
     """Generate a simple sticker without background removal"""
+    mode = mode or STICKER_OUTPUT_MODE
+    template_img = compose_simple_sticker(photo_bytes, template_info)
+    if template_img is None:
+        return None
+    
+    sticker_bytes, encode_ms = encode_sticker(template_img, mode)
+    record_encode(mode, encode_ms, len(sticker_bytes))
+    return sticker_bytes
+
+def compose_simple_sticker(photo_bytes, template_info):
+    """Paste the user photo, circle-masked, onto the template"""
     try:
-        # Load user photo
-        user_img = Image.open(io.BytesIO(photo_bytes)).convert('RGB')
+        # Copy pre-rendered template
+        template_img = get_festival_template(template_info, size=SIMPLE_TEMPLATE_SIZE).copy()
+        template_width, template_height = template_img.size
+        
+        # Available space for photo (leave room for text)
+        available_width, available_height = SIMPLE_PHOTO_AREA
         
-        # Create template
-        template_img = create_festival_template(template_info, size=(600, 800))
+        # Load user photo, decoded close to the size it will be shown at
+        user_img = load_photo(photo_bytes, SIMPLE_PHOTO_AREA)
         
         # Resize user photo to fit in upper portion
         user_width, user_height = user_img.size
-        template_width, template_height = template_img.size
-        
-        # Available space for photo (leave room for text)
-        available_height = template_height - 200
-        available_width = template_width - 100
         
         # Scale to fit
         scale_w = available_width / user_width
@@ -190,10 +333,8 @@ def generate_simple_sticker(photo_bytes, template_info):
         
         user_img = user_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
         
-        # Create circular mask
-        mask = Image.new('L', (new_width, new_height), 0)
-        draw = ImageDraw.Draw(mask)
-        draw.ellipse((0, 0, new_width, new_height), fill=255)
+        # Cached anti-aliased circular mask for this size
+        mask = circle_mask((new_width, new_height))
         
         # Apply circular mask
         output = Image.new('RGBA', (new_width, new_height), (0, 0, 0, 0))
@@ -206,13 +347,35 @@ def generate_simple_sticker(photo_bytes, template_info):
         
         template_img.paste(output, (x, y), output)
         
-        # Convert to bytes
-        output_buffer = io.BytesIO()
-        template_img.save(output_buffer, format='PNG', quality=95)
-        output_buffer.seek(0)
-        
-        return output_buffer.getvalue()
+        return template_img
         
     except Exception as e:
         logging.error(f"Error generating simple sticker: {e}")
         return None
+
+def get_template_by_name(template_name):
+    """Look up a template definition by its name"""
+    for template_info in TEMPLATES:
+        if template_info["name"] == template_name:
+            return template_info
+    return None
+
+def render_sticker_job(photo_bytes, template_name, mode=None, cutout_bytes=None):
+    """Worker-process entry point for the sticker job queue.
+
+    With a background-removed cutout the person is composited onto the full
+    template, otherwise the simple circle-masked sticker is produced.
+    Returns (sticker bytes, mode, encode ms) or None; encode statistics are
+    recorded by the caller since workers run in separate processes.
+    """
+    mode = mode or STICKER_OUTPUT_MODE
+    template_info = get_template_by_name(template_name)
+    if cutout_bytes:
+        template_img = composite_images(get_festival_template(template_info), cutout_bytes)
+    else:
+        template_img = compose_simple_sticker(photo_bytes, template_info)
+    if template_img is None:
+        return None
+    
+    sticker_bytes, encode_ms = encode_sticker(template_img, mode)
+    return sticker_bytes, mode, encode_ms
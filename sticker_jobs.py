@@ -0,0 +1,280 @@
+import os
+import logging
+import queue
+import random
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from app import db
+from models import StickerGeneration
+from user_cache import user_cache
+from unit_of_work import unit_of_work
+from sticker_generator import TEMPLATES, STICKER_OUTPUT_MODE, render_sticker_job, warm_template_cache, record_encode
+
+# Maximum number of photos waiting for a worker
+STICKER_QUEUE_SIZE = int(os.getenv("STICKER_QUEUE_SIZE", "50"))
+
+# Web worker processes (gunicorn reads WEB_CONCURRENCY as its default --workers);
+# each one runs its own sticker pool
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# Sticker render processes on this machine (defaults to the number of cores),
+# split between the web workers so the cores are not oversubscribed
+STICKER_WORKERS = max(1, (int(os.getenv("STICKER_WORKERS", "0")) or os.cpu_count() or 1) // WEB_CONCURRENCY)
+
+STICKER_CAPTION = "🎉 Ваш персональный стикер готов!\n\n\"Хорошие истории начинаются с тебя\" ✨"
+
+def send_sticker_file(bot, chat_id, sticker, mode, caption=None):
+    """Send sticker bytes or an existing file_id; returns the Telegram file_id"""
+    if mode == "tg_sticker":
+        sent = bot.send_sticker(chat_id, sticker)
+        if caption:
+            bot.send_message(chat_id, caption)
+        return sent.sticker.file_id
+    sent = bot.send_photo(chat_id, sticker, caption=caption)
+    return sent.photo[-1].file_id
+
+class StickerJob:
+    def __init__(self, user_id, chat_id, photo_file_id, largest_file_size=None, photo_unique_id=None):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.photo_file_id = photo_file_id
+        self.photo_unique_id = photo_unique_id
+        self.largest_file_size = largest_file_size
+        self.template_name = random.choice(TEMPLATES)["name"]
+        self.mode = STICKER_OUTPUT_MODE
+        # Content key in the sticker cache, known once the photo is identified
+        self.content_key = None
+        # Telegram file_id of an identical sticker that was already uploaded
+        self.sticker_file_id = None
+        # Rendered without the cutout because background removal failed
+        self.fallback = False
+        # (photo bytes, cutout bytes) kept until the render finishes, to resubmit it to a new pool
+        self.render_args = None
+        self.resubmitted = False
+
+class StickerJobQueue:
+    """Bounded sticker job queue rendered by a process pool.
+
+    Handlers only call submit(). A dispatcher thread downloads photos and
+    hands them to the pool; a sender thread delivers finished stickers and
+    records the StickerGeneration row.
+    """
+
+    def __init__(self, bot, max_queue=STICKER_QUEUE_SIZE, workers=STICKER_WORKERS,
+                 background_service=None, cache=None):
+        self.bot = bot
+        self.background_service = background_service
+        self.cache = cache
+        self.workers = workers
+        self.pending = queue.Queue(maxsize=max_queue)
+        self.completed = queue.Queue()
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        # Limits photos downloaded ahead of the pool to one per worker
+        self.slots = threading.BoundedSemaphore(workers)
+        self.pool = None
+        self.started = False
+
+    def start(self):
+        """Start the worker pool and the dispatcher/sender threads"""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        self.pool = self._new_pool()
+        threading.Thread(target=self._dispatch_loop, name="sticker-dispatcher", daemon=True).start()
+        threading.Thread(target=self._send_loop, name="sticker-sender", daemon=True).start()
+        logging.info(f"Sticker job queue started with {self.workers} workers")
+
+    def submit(self, user_id, chat_id, photo_file_id, largest_file_size=None, photo_unique_id=None):
+        """Enqueue a sticker job.
+
+        Returns (status, position) where status is 'queued', 'duplicate'
+        or 'full' and position is the 1-based place in line.
+        """
+        with self.lock:
+            if user_id in self.in_flight:
+                return "duplicate", None
+            try:
+                self.pending.put_nowait(StickerJob(user_id, chat_id, photo_file_id, largest_file_size, photo_unique_id))
+            except queue.Full:
+                return "full", self.pending.qsize()
+            self.in_flight.add(user_id)
+            return "queued", self.pending.qsize()
+
+    def queue_depth(self):
+        return self.pending.qsize()
+
+    def _dispatch_loop(self):
+        while True:
+            job = self.pending.get()
+            self.slots.acquire()
+            try:
+                self._dispatch(job)
+            except Exception as e:
+                logging.error(f"Error dispatching sticker job for {job.user_id}: {e}")
+                self.slots.release()
+                self._finish(job, None)
+
+    def _dispatch(self, job):
+        """Serve the job from the cache where possible, otherwise download and render"""
+        if self.cache and job.photo_unique_id:
+            job.content_key = self.cache.lookup_photo(job.photo_unique_id)
+            if job.content_key and self._serve_cached(job):
+                return
+
+        file_info = self.bot.get_file(job.photo_file_id)
+        photo_bytes = self.bot.download_file(file_info.file_path)
+        if job.largest_file_size:
+            logging.info(
+                f"Downloaded {len(photo_bytes)} bytes for {job.user_id} "
+                f"(largest variant {job.largest_file_size}, saved {job.largest_file_size - len(photo_bytes)})"
+            )
+
+        if self.cache and job.photo_unique_id and not job.content_key:
+            job.content_key = self.cache.content_key(job.photo_unique_id, photo_bytes)
+            self.cache.remember_photo(job.photo_unique_id, job.content_key)
+            if self._serve_cached(job):
+                return
+
+        if self.background_service:
+            removal = self.background_service.submit(photo_bytes)
+            removal.add_done_callback(
+                lambda f, job=job, photo_bytes=photo_bytes: self._render(job, photo_bytes, f)
+            )
+        else:
+            self._render(job, photo_bytes)
+
+    def _serve_cached(self, job):
+        """Complete the job from a cached sticker or re-composite a cached cutout"""
+        job.sticker_file_id = self.cache.get_file_id(job.content_key, job.template_name, job.mode)
+        sticker_bytes = None if job.sticker_file_id else self.cache.get_sticker(job.content_key, job.template_name, job.mode)
+        if job.sticker_file_id or sticker_bytes:
+            future = Future()
+            future.set_result((sticker_bytes, job.mode, None))
+            self.completed.put((job, future, None))
+            return True
+
+        if self.background_service:
+            cutout_bytes = self.cache.get_cutout(job.content_key)
+            if cutout_bytes:
+                self._submit_render(job, None, cutout_bytes)
+                return True
+        return False
+
+    def _render(self, job, photo_bytes, removal=None):
+        """Hand the photo (and cutout, if background removal succeeded) to the pool.
+
+        Runs as a done-callback, where exceptions are swallowed, so any error
+        gives the job's slot and in-flight entry back here.
+        """
+        submitted = False
+        try:
+            cutout_bytes = None
+            # exception() raises CancelledError on a cancelled future, so check that first
+            if removal is not None and not removal.cancelled() and removal.exception() is None:
+                cutout_bytes = removal.result()
+                if cutout_bytes and self.cache and job.content_key:
+                    try:
+                        self.cache.put_cutout(job.content_key, cutout_bytes)
+                    except Exception as e:
+                        logging.error(f"Error caching cutout for {job.user_id}: {e}")
+            job.fallback = self.background_service is not None and not cutout_bytes
+            self._submit_render(job, photo_bytes, cutout_bytes)
+            submitted = True
+        except Exception as e:
+            logging.error(f"Error preparing sticker job for {job.user_id}: {e}")
+        finally:
+            if not submitted:
+                self.slots.release()
+                self._finish(job, None)
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=warm_template_cache)
+
+    def _replace_pool(self, broken):
+        """Swap in a fresh pool after a worker process died; every failed job calls this, only one replaces it"""
+        with self.lock:
+            if self.pool is not broken:
+                return
+            logging.error("Sticker worker pool broke, starting a new one")
+            self.pool = self._new_pool()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _submit_render(self, job, photo_bytes, cutout_bytes):
+        job.render_args = (photo_bytes, cutout_bytes)
+        try:
+            pool = self.pool
+            try:
+                future = pool.submit(render_sticker_job, photo_bytes, job.template_name, job.mode, cutout_bytes)
+            except BrokenProcessPool:
+                self._replace_pool(pool)
+                job.resubmitted = True
+                pool = self.pool
+                future = pool.submit(render_sticker_job, photo_bytes, job.template_name, job.mode, cutout_bytes)
+            future.add_done_callback(lambda f, job=job, pool=pool: self.completed.put((job, f, pool)))
+        except Exception as e:
+            logging.error(f"Error submitting sticker job for {job.user_id}: {e}")
+            try:
+                self.slots.release()
+            finally:
+                self._finish(job, None)
+
+    def _send_loop(self):
+        while True:
+            job, future, pool = self.completed.get()
+            if not job.resubmitted and not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+                # A worker process died, taking this job with it; render it once more on a new pool
+                logging.warning(f"Resubmitting sticker job for {job.user_id} after the worker pool broke")
+                self._replace_pool(pool)
+                job.resubmitted = True
+                self._submit_render(job, *job.render_args)
+                continue
+            self.slots.release()
+            job.render_args = None
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.error(f"Sticker worker failed for {job.user_id}: {e}")
+                result = None
+            self._finish(job, result)
+
+    def _finish(self, job, result):
+        """Deliver the result and record the generation"""
+        try:
+            if not result:
+                self.bot.send_message(job.chat_id, "❌ Не удалось обработать фото. Попробуйте другое изображение.")
+                return
+
+            sticker_bytes, mode, encode_ms = result
+            # A fallback render is not cached, so the next try gets the full template
+            cacheable = self.cache and job.content_key and not job.fallback
+            if encode_ms is not None:
+                record_encode(mode, encode_ms, len(sticker_bytes))
+                if cacheable:
+                    self.cache.put_sticker(job.content_key, job.template_name, mode, sticker_bytes)
+
+            # Resends go by file_id so the bytes are uploaded only once
+            file_id = send_sticker_file(
+                self.bot, job.chat_id, job.sticker_file_id or sticker_bytes, mode, caption=STICKER_CAPTION
+            )
+            if cacheable and not job.sticker_file_id:
+                self.cache.put_file_id(job.content_key, job.template_name, mode, file_id)
+
+            identity = user_cache.get(job.user_id)
+            if identity:
+                with unit_of_work(write=True):
+                    sticker_gen = StickerGeneration(
+                        user_id=identity.id,
+                        template_used=job.template_name,
+                        original_photo_file_id=job.photo_file_id,
+                        generated_sticker_file_id=file_id,
+                        output_mode=mode
+                    )
+                    db.session.add(sticker_gen)
+        except Exception as e:
+            logging.error(f"Error delivering sticker to {job.user_id}: {e}")
+        finally:
+            with self.lock:
+                self.in_flight.discard(job.user_id)
@@ -0,0 +1,190 @@
+import os
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+from rate_limit import TokenBucket
+
+# Base URL of the Bot API, e.g. http://127.0.0.1:8081 for a local or fake server
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# Keep-alive connections kept open to the Bot API
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "32"))
+
+# Outgoing messages per second for the whole bot, and per chat (with a small burst)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+
+# Share of the global rate bulk sends (broadcasts) may use, so replies to users
+# always have the rest
+TELEGRAM_BULK_RATE = float(os.getenv("TELEGRAM_BULK_RATE", "20"))
+
+# Retries of a request answered with 429 Too Many Requests
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+
+# Threads sending fire-and-forget requests such as answerCallbackQuery
+TELEGRAM_ASYNC_WORKERS = int(os.getenv("TELEGRAM_ASYNC_WORKERS", "4"))
+
+# Bot API methods that count against the global and per-chat message limits.
+# Edits are left out, so menu screens stay instant while a user taps through
+THROTTLED_PREFIXES = ("send", "copy", "forward")
+
+# Upper bounds (ms) of the latency histogram buckets
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+def api_method_name(url):
+    return url.rsplit('/', 1)[-1]
+
+def request_chat_id(params):
+    if not params:
+        return None
+    return params.get('chat_id')
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram for one API method"""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.total_ms = 0.0
+        self.count = 0
+
+    def observe(self, elapsed_ms):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+        self.total_ms += elapsed_ms
+        self.count += 1
+
+    def snapshot(self):
+        buckets = {f"le_{bound}": n for bound, n in zip(LATENCY_BUCKETS_MS, self.counts)}
+        buckets["le_inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0,
+            "buckets": buckets,
+        }
+
+class OutboundClient:
+    """Every Bot API request goes through here once install() is called.
+
+    Requests share one pooled keep-alive session. Message-sending methods
+    wait for a global and a per-chat token bucket, and a 429 pauses the
+    global bucket for retry_after before retrying. Sends made inside bulk()
+    also wait for the smaller bulk bucket, so a broadcast never takes the
+    whole global rate. Latency is recorded per API method.
+    """
+
+    def __init__(self, pool_size=TELEGRAM_POOL_SIZE, global_rate=TELEGRAM_GLOBAL_RATE,
+                 chat_rate=TELEGRAM_CHAT_RATE, chat_burst=TELEGRAM_CHAT_BURST,
+                 max_retries=TELEGRAM_MAX_RETRIES, async_workers=TELEGRAM_ASYNC_WORKERS,
+                 bulk_rate=TELEGRAM_BULK_RATE):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.transport = self.session.request
+        self.global_bucket = TokenBucket(global_rate)
+        self.bulk_bucket = TokenBucket(min(bulk_rate, global_rate))
+        self.local = threading.local()
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.max_retries = max_retries
+        self.background = ThreadPoolExecutor(max_workers=async_workers, thread_name_prefix="tg-async")
+        self.histograms = {}
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    def install(self, api_url=TELEGRAM_API_URL):
+        """Route telebot's requests (and file downloads) through this client"""
+        if api_url:
+            base = api_url.rstrip('/')
+            apihelper.API_URL = base + "/bot{0}/{1}"
+            apihelper.FILE_URL = base + "/file/bot{0}/{1}"
+        # A sender installed earlier (e.g. a mocked API) becomes the transport
+        if apihelper.CUSTOM_REQUEST_SENDER and apihelper.CUSTOM_REQUEST_SENDER != self.send:
+            self.transport = apihelper.CUSTOM_REQUEST_SENDER
+        apihelper.CUSTOM_REQUEST_SENDER = self.send
+        apihelper.session = self.session
+
+    def _chat_bucket(self, chat_id):
+        with self.lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                if len(self.chat_buckets) > 50000:
+                    self.chat_buckets.clear()
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            return bucket
+
+    @contextmanager
+    def bulk(self):
+        """Mark the Bot API calls of this thread as bulk sends for the block"""
+        self.local.bulk = True
+        try:
+            yield
+        finally:
+            self.local.bulk = False
+
+    def send(self, method, url, **kwargs):
+        """CUSTOM_REQUEST_SENDER entry point; returns the HTTP response telebot expects"""
+        api_method = api_method_name(url)
+        if api_method.startswith(THROTTLED_PREFIXES):
+            chat_id = request_chat_id(kwargs.get('params'))
+            if chat_id is not None:
+                self._chat_bucket(str(chat_id)).acquire()
+            if getattr(self.local, 'bulk', False):
+                self.bulk_bucket.acquire()
+            self.global_bucket.acquire()
+
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = self.transport(method, url, **kwargs)
+            finally:
+                self._observe(api_method, (time.perf_counter() - start) * 1000)
+            if response.status_code != 429 or attempt >= self.max_retries:
+                return response
+            attempt += 1
+            retry_after = self._retry_after(response)
+            logging.warning(f"Telegram 429 on {api_method}, retrying in {retry_after}s (attempt {attempt})")
+            with self.lock:
+                self.retries += 1
+            self.global_bucket.pause(retry_after)
+            time.sleep(retry_after)
+
+    def _retry_after(self, response):
+        try:
+            return response.json().get('parameters', {}).get('retry_after', 1)
+        except ValueError:
+            return 1
+
+    def _observe(self, api_method, elapsed_ms):
+        with self.lock:
+            histogram = self.histograms.get(api_method)
+            if histogram is None:
+                histogram = self.histograms[api_method] = LatencyHistogram()
+            histogram.observe(elapsed_ms)
+
+    def fire_and_forget(self, fn, *args, **kwargs):
+        """Run a Bot API call in the background, logging instead of raising errors"""
+        def run():
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                logging.error(f"Background Telegram call {getattr(fn, '__name__', fn)} failed: {e}")
+        self.background.submit(run)
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "retries_429": self.retries,
+                "chat_buckets": len(self.chat_buckets),
+                "methods": {name: histogram.snapshot() for name, histogram in sorted(self.histograms.items())},
+            }
+
+outbound_client = OutboundClient()
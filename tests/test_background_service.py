@@ -0,0 +1,99 @@
+"""BackgroundRemovalService and its circuit breaker against a stub Remove.bg server"""
+import time
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from background_service import BackgroundRemovalService, CircuitBreaker
+
+class StubRemoveBg(BaseHTTPRequestHandler):
+    """Answers every POST with the class-level status after an optional delay"""
+    protocol_version = "HTTP/1.1"
+    status = 200
+    delay = 0
+    calls = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with StubRemoveBg.lock:
+            StubRemoveBg.calls += 1
+        time.sleep(StubRemoveBg.delay)
+        body = b"cutout" if StubRemoveBg.status == 200 else b"{}"
+        self.send_response(StubRemoveBg.status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class BackgroundRemovalServiceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubRemoveBg)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}/v1.0/removebg"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubRemoveBg.status = 200
+        StubRemoveBg.delay = 0
+        StubRemoveBg.calls = 0
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+        self.service = BackgroundRemovalService(api_url=self.url, api_key="test", timeout=5,
+                                                retries=1, breaker=self.breaker)
+        self.service.start()
+
+    def tearDown(self):
+        self.service.stop()
+
+    def test_returns_cutout(self):
+        self.assertEqual(self.service.remove(b"photo"), b"cutout")
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_rejected_image_keeps_breaker_closed(self):
+        StubRemoveBg.status = 400
+        self.assertIsNone(self.service.remove(b"photo"))
+        self.assertEqual(StubRemoveBg.calls, 1)
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_opens_after_failures_and_probes_after_cool_down(self):
+        StubRemoveBg.status = 503
+        self.assertIsNone(self.service.remove(b"photo"))
+        self.assertIsNone(self.service.remove(b"photo"))
+        self.assertEqual(self.breaker.state, "open")
+
+        calls = StubRemoveBg.calls
+        self.assertIsNone(self.service.remove(b"photo"))
+        self.assertEqual(StubRemoveBg.calls, calls)
+
+        time.sleep(0.25)
+        StubRemoveBg.status = 200
+        self.assertEqual(self.service.remove(b"photo"), b"cutout")
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_unexpected_error_ends_the_probe(self):
+        self.breaker.opened_at = time.monotonic() - 1
+        self.service.session.post = None  # calling it raises TypeError
+        with self.assertRaises(TypeError):
+            self.service.remove(b"photo")
+        self.assertFalse(self.breaker.probing)
+        self.assertEqual(self.breaker.state, "open")
+
+    def test_cancelled_probe_ends_the_probe(self):
+        self.breaker.opened_at = time.monotonic() - 1
+        StubRemoveBg.delay = 1
+        removal = self.service.submit(b"photo")
+        time.sleep(0.2)
+        removal.cancel()
+        time.sleep(0.1)
+        self.assertTrue(removal.cancelled())
+        self.assertFalse(self.breaker.probing)
+
+if __name__ == "__main__":
+    unittest.main()
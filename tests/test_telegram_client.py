@@ -0,0 +1,137 @@
+"""OutboundClient against a fake Bot API server on 127.0.0.1"""
+import json
+import time
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import telebot
+from telebot import apihelper
+from telegram_client import OutboundClient
+
+class FakeBotApi(BaseHTTPRequestHandler):
+    """Answers like api.telegram.org; the first sendMessage to chat 429 gets a 429"""
+    protocol_version = "HTTP/1.1"
+    calls = []
+    lock = threading.Lock()
+
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        api_method = self.path.split('?', 1)[0].rsplit('/', 1)[-1]
+        query = dict(part.split('=', 1) for part in self.path.partition('?')[2].split('&') if '=' in part)
+        chat_id = query.get('chat_id')
+        with FakeBotApi.lock:
+            FakeBotApi.calls.append((api_method, chat_id, time.monotonic()))
+            first = sum(1 for method, chat, _ in FakeBotApi.calls if (method, chat) == (api_method, chat_id)) == 1
+        if api_method == 'sendMessage' and chat_id == '429' and first:
+            self._reply(429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                              'parameters': {'retry_after': 1}})
+            return
+        result = {'message_id': 1, 'date': 0, 'chat': {'id': int(chat_id or 1), 'type': 'private'}, 'text': 'ok'}
+        self._reply(200, {'ok': True, 'result': result})
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+class OutboundClientTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBotApi)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.api_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        FakeBotApi.calls = []
+        self.saved = (apihelper.API_URL, apihelper.FILE_URL, apihelper.CUSTOM_REQUEST_SENDER, apihelper.session)
+        apihelper.CUSTOM_REQUEST_SENDER = None
+        self.bot = telebot.TeleBot("1:test", threaded=False)
+
+    def tearDown(self):
+        apihelper.API_URL, apihelper.FILE_URL, apihelper.CUSTOM_REQUEST_SENDER, apihelper.session = self.saved
+
+    def client(self, **kwargs):
+        options = dict(global_rate=1000, chat_rate=1000, chat_burst=10, bulk_rate=1000)
+        options.update(kwargs)
+        client = OutboundClient(**options)
+        client.install(self.api_url)
+        return client
+
+    def sent(self, api_method):
+        return [call for call in FakeBotApi.calls if call[0] == api_method]
+
+    def test_retries_after_429(self):
+        client = self.client()
+        start = time.monotonic()
+        message = self.bot.send_message(429, "hello")
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(message.text, "ok")
+        self.assertEqual(len(self.sent('sendMessage')), 2)
+        self.assertGreaterEqual(elapsed, 0.9)
+        self.assertEqual(client.metrics()["retries_429"], 1)
+
+    def test_gives_up_after_max_retries(self):
+        client = self.client(max_retries=0)
+        with self.assertRaises(apihelper.ApiTelegramException) as raised:
+            self.bot.send_message(429, "hello")
+        self.assertEqual(raised.exception.error_code, 429)
+        self.assertEqual(client.metrics()["retries_429"], 0)
+
+    def test_throttles_messages_per_chat(self):
+        self.client(chat_rate=4, chat_burst=1)
+        start = time.monotonic()
+        for _ in range(3):
+            self.bot.send_message(7, "hello")
+        same_chat = time.monotonic() - start
+
+        start = time.monotonic()
+        for chat_id in (8, 9, 10):
+            self.bot.send_message(chat_id, "hello")
+        other_chats = time.monotonic() - start
+
+        # Burst of one, then a token every 0.25 s
+        self.assertGreaterEqual(same_chat, 0.45)
+        self.assertLess(other_chats, 0.2)
+
+    def test_edits_are_not_throttled(self):
+        self.client(global_rate=1, chat_rate=1, chat_burst=1)
+        start = time.monotonic()
+        for _ in range(5):
+            self.bot.edit_message_text("menu", chat_id=7, message_id=1)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(len(self.sent('editMessageText')), 5)
+
+    def test_bulk_sends_leave_the_rest_of_the_global_rate(self):
+        client = self.client(global_rate=100, bulk_rate=2)
+        start = time.monotonic()
+        with client.bulk():
+            for chat_id in range(4):
+                self.bot.send_message(chat_id + 100, "broadcast")
+        bulk = time.monotonic() - start
+
+        start = time.monotonic()
+        for chat_id in range(4):
+            self.bot.send_message(chat_id + 200, "reply")
+        interactive = time.monotonic() - start
+
+        # Two tokens up front, then one every 0.5 s
+        self.assertGreaterEqual(bulk, 0.9)
+        self.assertLess(interactive, 0.3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import logging
+from contextlib import contextmanager
+from flask import has_app_context
+from app import app, db
+
+@contextmanager
+def unit_of_work(write=False):
+    """One transaction around a handler's database work.
+
+    Opens an app context when there is none, commits once when the outermost
+    block exits and rolls back if it raises. Nested blocks join the outer
+    transaction, so helpers called from a handler never commit on their own.
+    Handlers leave the block before calling the Bot API, so no lock is held
+    during a Telegram round-trip and replies only describe committed data.
+
+    Pass write=True when the block may write: on SQLite only those units take
+    the write lock, lookups run as plain WAL reads next to them.
+    """
+    if not has_app_context():
+        with app.app_context():
+            with unit_of_work(write) as session:
+                yield session
+        return
+
+    session = db.session()
+    current = session.info.get('unit_of_work')
+    if current:
+        if write and current != 'write':
+            raise RuntimeError("A writing unit of work cannot join a read-only one; open the outer one with write=True")
+        yield session
+        return
+
+    session.info['unit_of_work'] = 'write' if write else 'read'
+    try:
+        if write and not session.in_transaction() and session.get_bind().dialect.name == 'sqlite':
+            # BEGIN IMMEDIATE, see configure_sqlite in app.py
+            session.connection(execution_options={"sqlite_begin_immediate": True})
+        yield session
+        session.commit()
+    except BaseException:
+        session.rollback()
+        session.info.pop('on_commit', None)
+        raise
+    finally:
+        session.info.pop('unit_of_work', None)
+
+    for callback in session.info.pop('on_commit', []):
+        try:
+            callback()
+        except Exception as e:
+            logging.error(f"Error in after-commit callback {getattr(callback, '__name__', callback)}: {e}")
+
+def on_commit(callback):
+    """Run callback once the current unit of work commits; dropped if it rolls back.
+
+    Used for side effects that must not see uncommitted data, such as
+    refreshing in-memory caches. Outside a unit of work it runs immediately.
+    """
+    if has_app_context() and db.session.info.get('unit_of_work'):
+        db.session.info.setdefault('on_commit', []).append(callback)
+    else:
+        callback()
@@ -0,0 +1,117 @@
+import os
+import time
+import threading
+from collections import OrderedDict, namedtuple
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import User
+from unit_of_work import unit_of_work, on_commit
+
+# Maximum number of telegram_id -> identity entries kept in memory
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+
+# Seconds a cached identity is trusted; changes made by another process (an
+# admin flag set from the dashboard, a reset) are seen after this at the latest
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+UserIdentity = namedtuple("UserIdentity", ["id", "is_admin"])
+
+class UserIdentityCache:
+    """Process-wide LRU cache from telegram_id to (user.id, is_admin), with a TTL.
+
+    Invalidation on update only reaches this process, so admin commands check
+    the flag in the database with is_admin() instead of trusting the cache.
+    """
+
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, telegram_id, identity):
+        with self.lock:
+            self.entries[telegram_id] = (identity, time.monotonic() + self.ttl)
+            self.entries.move_to_end(telegram_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def _cached(self, telegram_id):
+        with self.lock:
+            entry = self.entries.get(telegram_id)
+            if entry is not None and entry[1] > time.monotonic():
+                self.entries.move_to_end(telegram_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def get(self, telegram_id):
+        """Identity for a telegram_id, or None if the user never pressed /start"""
+        telegram_id = str(telegram_id)
+        identity = self._cached(telegram_id)
+        if identity is not None:
+            return identity
+        return self._load(telegram_id)
+
+    def _load(self, telegram_id):
+        with unit_of_work():
+            row = db.session.query(User.id, User.is_admin).filter_by(telegram_id=telegram_id).first()
+        if row is None:
+            return None
+        identity = UserIdentity(row.id, bool(row.is_admin))
+        self._remember(telegram_id, identity)
+        return identity
+
+    def is_admin(self, telegram_id):
+        """Admin flag read from the database (and refreshed in the cache), for admin commands"""
+        identity = self._load(str(telegram_id))
+        return bool(identity and identity.is_admin)
+
+    def upsert(self, from_user):
+        """Return the identity for a Telegram user, creating the User row if needed"""
+        telegram_id = str(from_user.id)
+        identity = self._cached(telegram_id)
+        if identity is not None:
+            return identity
+
+        identity = self._load(telegram_id)
+        if identity is not None:
+            return identity
+
+        with unit_of_work(write=True):
+            db_user = User(
+                telegram_id=telegram_id,
+                username=from_user.username,
+                first_name=from_user.first_name,
+                last_name=from_user.last_name
+            )
+            try:
+                with db.session.begin_nested():
+                    db.session.add(db_user)
+            except IntegrityError:
+                # Another worker created the same user first
+                db_user = User.query.filter_by(telegram_id=telegram_id).first()
+            identity = UserIdentity(db_user.id, bool(db_user.is_admin))
+            # A new row is only cached once the update's transaction commits
+            on_commit(lambda: self._remember(telegram_id, identity))
+        return identity
+
+    def invalidate(self, telegram_id):
+        with self.lock:
+            self.entries.pop(str(telegram_id), None)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+user_cache = UserIdentityCache()
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_changed_user(mapper, connection, target):
+    """Drop cached identities when a User row changes anywhere (e.g. admin flag)"""
+    user_cache.invalidate(target.telegram_id)
@@ -0,0 +1,35 @@
+import hmac
+from flask import request, abort, jsonify
+from telebot import types
+from app import app
+from bot import bot, WEBHOOK_SECRET, configure_webhook
+from sticker_generator import get_encode_stats
+
+@app.route('/telegram/webhook', methods=['POST'])
+def telegram_webhook():
+    """Receive Telegram updates and hand them to the worker pool"""
+    if not WEBHOOK_SECRET:
+        abort(404)
+
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(token.encode('utf-8'), WEBHOOK_SECRET.encode('utf-8')):
+        abort(403)
+
+    update = types.Update.de_json(request.get_data(as_text=True))
+    if update is None:
+        abort(400)
+
+    # Only enqueues; handlers run on the dispatcher threads
+    bot.process_new_updates([update])
+    return '', 200
+
+@app.route('/api/bot_metrics')
+def bot_metrics():
+    """Dispatcher queue depth, per-handler latency, suppressed edits, Bot API latency and sticker encodes"""
+    return jsonify(dict(bot.dispatcher.metrics(), render=bot.render_cache.stats(),
+                        telegram_api=bot.outbound.metrics(), sticker_encode=get_encode_stats()))
+
+@app.cli.command('set-webhook')
+def set_webhook_command():
+    """Register WEBHOOK_URL with Telegram (run once per deploy)"""
+    configure_webhook()
@@ -0,0 +1,30 @@
+"""Production entry point for webhook mode.
+
+    flask --app wsgi set-webhook
+    WEB_CONCURRENCY=4 gunicorn --threads 8 --bind 0.0.0.0:5000 wsgi:app
+
+Threads keep the webhook answered while dashboard tabs hold short stats streams
+(see SSE_STREAM_SECONDS in admin_routes.py). WEB_CONCURRENCY also divides the
+sticker render processes between the workers (see STICKER_WORKERS).
+"""
+import threading
+from app import app
+import webhook_routes
+from bot import start_bot_services
+
+_services_lock = threading.Lock()
+_services_started = False
+
+@app.before_request
+def ensure_bot_services():
+    """Start the sticker queue and background services in this worker on its first request.
+
+    Nothing starts at import, so CLI commands such as set-webhook stay lightweight.
+    """
+    global _services_started
+    if _services_started:
+        return
+    with _services_lock:
+        if not _services_started:
+            start_bot_services()
+            _services_started = True